@@ -0,0 +1,4 @@
+from time import monotonic
+
+# when the admin CLI started loading; see STARTUP_STATS in admin.cli
+LOAD_STARTED_AT = monotonic()
@@ -1,29 +1,48 @@
-import io
+import sys
 import json
+import shlex
 import random
 import logging
+import subprocess
 
 from os import getenv
 from uuid import UUID
-from time import sleep
-from typing import Optional
+from time import sleep, monotonic
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional, TYPE_CHECKING
 from datetime import datetime
+from statistics import median
 from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
-from pydantic import UUID4
-from paramiko.ed25519key import Ed25519Key
 from ipaddress import IPv4Network
 from fabric import Connection, task
-from google.cloud import secretmanager
-from wireguard_tools import WireguardKey
+from fabric.tasks import Task
+from invoke.exceptions import Exit
 from tenacity import retry, stop_after_attempt, wait_fixed
 
-from common.crypto import create_secret_box
+from common import tracing
+from common.profiling import profiled
+from common.session import INTERACTIVE, CRITICAL
 from common.util import api, project_id, create_sshkey
-from common.constants import INSTANCE_NAME_PREFIX, SSH_KEYFILE_PATH
-from common.tunnel import write_wireguard_config, start_wireguard_tunnel, device_ip, server_ip
-from admin.cloud import create_ts_instance, list_ts_instances, get_ts_instance_public_ip, destroy_ts_resources
-from common.models import TunnelState, WireguardTunnel, WireguardPeer, TunnelServerLaunchDetails, SupportSecretBoxContents
+from common.constants import SSH_KEYFILE_PATH, NAT_PROBE_PORT
+from common.tunnel import write_wireguard_config, start_wireguard_tunnel, device_ip, server_ip, admin_ip
+from admin import LOAD_STARTED_AT
+from admin.credentials import load_token, save_token, forget_token
+from admin.ssh_session import DeviceSession, load_session, save_session, close_session, ssh_args, run_remote, direct_config, direct_interface
+from admin.transfer import TransferStats, download, upload
+from admin.mirror import connect_mirror, reset_mirror, get_cursor, apply_changes, get_mirrored_tunnel, query_tunnels
+
+# The Google Cloud clients take seconds to import, and the pydantic models a good
+# fraction of one; tasks import them as they need them, so that `fab show` doesn't
+# pay for what `fab create` uses.
+if TYPE_CHECKING:
+    from pydantic import UUID4
+    import sqlite3
+    from requests import Response
+    from wireguard_tools import WireguardKey
+    from common.models import WireguardTunnel
 
 SUPPORT_TUNNEL_API = getenv(
     "SUPPORT_TUNNEL_API",
@@ -35,62 +54,331 @@ ADMIN_AUTH_TOKEN_NAME = getenv(
     "support-tunnel-admin-token-prod"
 )
 
-PROJECT_ID = project_id()
-
 DEBUG = getenv("DEBUG", False)  # any value set here will turn on debugging
+# any value set here makes `fab create` place tunnels on shared tunnel servers
+SHARED_TUNNEL_SERVERS = bool(getenv("SHARED_TUNNEL_SERVERS", False))
+# any value set here prints how many cloud API calls each task made, and how long they took
+CLOUD_API_STATS = getenv("CLOUD_API_STATS", False)
+# any value set here prints how long each task took to load, and to run
+STARTUP_STATS = getenv("STARTUP_STATS", False)
+# a directory to write a profile of every task run to, if set; see common.profiling
+PROFILE_DIR = getenv("PROFILE_DIR")
+# tunnels fetched per request when syncing the local mirror
+MIRROR_SYNC_PAGE = int(getenv("MIRROR_SYNC_PAGE", 500))
+# seconds behind its cursor each mirror sync reads again, to catch writes that
+# committed after later ones had already been synced
+MIRROR_SYNC_REWIND = float(getenv("MIRROR_SYNC_REWIND", 300))
 logging.basicConfig(level=logging.DEBUG if DEBUG else logging.WARNING)
 
 
-@lru_cache(1)
 @retry(stop=stop_after_attempt(5), wait=wait_fixed(2))
-def token() -> str:
+def fetch_token() -> str:
     """ Gets an API key token from Google Secret Manager, to use to authenticate this service.
         This is nice because we can assume we already have some sort of auth to GCP... but less nice
         because it does not identify a single user, cannot be revoked for a single user, and
         ties us to GCP just a smidge. Opted for this because it's super easy implementation
         and also super easy to rip out in favor of another auth methanism when the day comes.
     """
+    from google.cloud import secretmanager
+
     sm_client = secretmanager.SecretManagerServiceClient()
     resp = sm_client.access_secret_version(request={
-        "name": f"projects/{PROJECT_ID}/secrets/{ADMIN_AUTH_TOKEN_NAME}/versions/latest"
+        "name": f"projects/{project_id()}/secrets/{ADMIN_AUTH_TOKEN_NAME}/versions/latest"
     })
     return resp.payload.data.decode("UTF-8")
 
 
+@lru_cache(1)
+def token() -> str:
+    """ The API key token, from the on-disk cache if it's fresh, or else from Secret Manager. """
+    t = load_token(ADMIN_AUTH_TOKEN_NAME)
+    if not t:
+        t = fetch_token()
+        save_token(ADMIN_AUTH_TOKEN_NAME, t)
+    return t
+
+
 def auth_header() -> dict:
     return {'admin-auth-token': token()}
 
 
+def admin_api(method: str, path: str, **kwargs) -> "Response":
+    """ Calls the admin API. If it rejects our token, the token was probably rotated
+        or revoked since we cached it; fetch it afresh and try once more.
+    """
+    headers = kwargs.pop("headers", {})
+    res = api.request(method, f"{SUPPORT_TUNNEL_API}{path}", headers={**headers, **auth_header()}, **kwargs)
+    if res.status_code == 401:
+        logging.info("the API rejected our token; fetching it afresh")
+        forget_token()
+        token.cache_clear()
+        res = api.request(method, f"{SUPPORT_TUNNEL_API}{path}", headers={**headers, **auth_header()}, **kwargs)
+    return res
+
+
 def get_tunnel(tunnel_id) -> Optional[dict]:
-    res = api.get(
-        f"{SUPPORT_TUNNEL_API}/admin/tunnel/{tunnel_id}", headers=auth_header())
+    res = admin_api("GET", f"/admin/tunnel/{tunnel_id}", policy=INTERACTIVE)
     if res and res.text:
         return json.loads(res.text)
     return None
 
 
-@task
-def show(c, tunnel_id):
-    """ Show a single tunnel's details """
-    t = get_tunnel(tunnel_id)
-    print(json.dumps(t))
+class AdminTask(Task):
+    """ A fabric Task that reports the cloud API calls its body made, if
+        CLOUD_API_STATS is set, and how long it took to load and run, if
+        STARTUP_STATS is set. Tasks called by other tasks, like `stop` calling
+        `gc`, are counted towards the outermost one. Each task is traced; see
+        common.tracing, and profiled if PROFILE_DIR is set; see common.profiling.
+    """
+    depth = 0
+
+    def __call__(self, *args, **kwargs):
+        AdminTask.depth += 1
+        called_at = monotonic()
+        tracing.set_service_name("support-tunnel-admin")
+        try:
+            with tracing.span(f"fab {self.name}", tunnel_id=kwargs.get("tunnel_id")), \
+                    profiled(f"fab-{self.name}", PROFILE_DIR):
+                return super().__call__(*args, **kwargs)
+        finally:
+            AdminTask.depth -= 1
+            if CLOUD_API_STATS and not AdminTask.depth:
+                from admin.cloud import report_cloud_api_calls
+                report_cloud_api_calls(f"fab {self.name}")
+            if STARTUP_STATS and not AdminTask.depth:
+                print(f"fab {self.name}: started {(called_at - LOAD_STARTED_AT) * 1000:.0f} ms after loading began, "
+                      f"ran for {monotonic() - called_at:.2f}s", file=sys.stderr)
+
+
+_oslogin_user: Dict[str, str] = {}
+
+
+def oslogin_user(c) -> str:
+    """ Sets up local SSH config for our tunnel servers and returns our OS Login
+        username. Only done once per process.
+    """
+    if 'username' not in _oslogin_user:
+        # things get hacky when being concerned with local ssh keys and all -
+        # the below configures things to "just work", every time.
+        c.run("gcloud compute config-ssh", hide="both")
+        user_from_oslogin = c.run("gcloud compute os-login describe-profile --format=json", hide="both")
+        _oslogin_user['username'] = json.loads(user_from_oslogin.stdout)['posixAccounts'][0]['username']
+    return _oslogin_user['username']
+
+
+def ts_connection(c, host) -> Connection:
+    """ Returns a connection to a tunnel server, as our OS Login user. """
+    return Connection(
+        host=str(host),
+        user=oslogin_user(c),
+        connect_kwargs={"auth_timeout": 120} # long for 2FA
+    )
+
+
+def shared_interface(tunnel_id) -> str:
+    """ The WireGuard interface for a tunnel on a shared tunnel server. Interface
+        names are limited to 15 characters.
+    """
+    return f"support-{UUID(str(tunnel_id)).hex[:7]}"
+
+
+def ts_ssh_keyfile(tunnel_id, shared: bool) -> Path:
+    """ Where a tunnel's SSH key lives on its tunnel server. Shared tunnel servers
+        keep one per tunnel.
+    """
+    return SSH_KEYFILE_PATH.with_name(f"{SSH_KEYFILE_PATH.name}-{tunnel_id}") if shared else SSH_KEYFILE_PATH
+
+
+def free_wg_port(ts: Connection) -> int:
+    """ Picks a WireGuard port that no interface on the tunnel server listens on. """
+    res = ts.run("sudo wg show all listen-port", hide="both", warn=True)
+    taken = {int(line.split()[1]) for line in res.stdout.splitlines()} if res else set()
+    # the below port range is also defined in the firewall rules for the hosts
+    # in opentofu; its top is kept for the NAT probe echo service
+    return random.choice([p for p in range(20000, NAT_PROBE_PORT) if p not in taken])
+
+
+def refill_pool_in_background(zone: str):
+    """ Tops up the warm pool in a zone from a detached `fab pool-fill`, which keeps
+        going after this process exits.
+    """
+    subprocess.Popen([sys.executable, "-m", "fabric", "pool-fill", "--zone", zone],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+
+
+def start_direct_peer(c, tunnel_id, t: "WireguardTunnel"):
+    """ Brings up this workstation's side of a `--direct` tunnel. """
+    conf = direct_config(tunnel_id)
+    conf.parent.mkdir(parents=True, exist_ok=True)
+    conf.parent.chmod(0o700)
+    conf.touch(mode=0o600)
+    conf.write_text(t.to_WireguardConfig().to_wgconfig(wgquick_format=True))
+    c.run(f"sudo wg-quick up {conf}", hide="both")
+
+
+def stop_direct_peer(c, tunnel_id):
+    """ Takes down this workstation's side of a `--direct` tunnel, if it has one. """
+    conf = direct_config(tunnel_id)
+    if conf.exists():
+        c.run(f"sudo wg-quick down {conf}", warn=True, hide="both")
+        conf.unlink()
+
+
+def remove_shared_tunnel(c, tunnel_id):
+    """ Hot-removes a tunnel's interface and SSH key from its shared tunnel server,
+        then gives up its spot there.
+    """
+    from admin.provider import cloud_provider
 
+    provider = cloud_provider()
+    interface = shared_interface(tunnel_id)
+    keyfile = ts_ssh_keyfile(tunnel_id, shared=True)
+    try:
+        ts = ts_connection(c, provider.public_ip(provider.get(tunnel_id)))
+        ts.run(f"sudo systemctl disable --now wg-quick@{interface}", warn=True, hide="both")
+        ts.run(f"sudo rm -f /etc/wireguard/{interface}.conf {keyfile} {keyfile}.pub", hide="both")
+    except Exception as e:
+        logging.warning(f"failed to clean up tunnel {tunnel_id} on its shared tunnel server: {str(e)}")
+    remaining = provider.release_shared(tunnel_id)
+    print(f"removed tunnel {tunnel_id} from its shared tunnel server; {remaining} tunnels remain there")
+
+
+# Sets PersistentKeepalive to `ka` in the [Peer] block whose PublicKey is `key`,
+# adding it at the end of that block if missing, and leaves other peers be.
+SET_PEER_KEEPALIVE_AWK = """
+function flush() { if (mine && !set) print "PersistentKeepalive = " ka; mine = 0; set = 0 }
+/^\\[/ { flush() }
+/^PublicKey *=/ && $3 == key { mine = 1 }
+mine && /^PersistentKeepalive *=/ { $0 = "PersistentKeepalive = " ka; set = 1 }
+{ print }
+END { flush() }
+"""
+
+
+def ts_keepalive_behind(t: dict) -> bool:
+    """ Whether a running tunnel's server still keeps alive at another interval than
+        its device reported.
+    """
+    from common.models import TunnelState
+
+    return (t['state'] == TunnelState.running and bool(t.get('keepalive')) and bool(t.get('ts_public_ip'))
+            and t['keepalive'] != t.get('ts_keepalive'))
 
-@task
-def list(c):
-    """ List tunnels from upstream API's db. """
-    res = api.get(f"{SUPPORT_TUNNEL_API}/admin/tunnel/list",
-                  headers=auth_header())
+
+def sync_ts_keepalive(ts: Connection, t: dict):
+    """ Sets the tunnel server's keepalive towards a device to the interval the
+        device reported, so that neither end wakes the link more often than the
+        device's NAT needs, and records it with the API. Only the device's peer is
+        touched; admin peers, and other tunnels on a shared server, keep theirs.
+    """
+    from common.models import TunnelServerTelemetry
+
+    peer, keepalive = t['device_wg_public_key'], int(t['keepalive'])
+    # peer lines are: interface, public key, preshared key, endpoint, allowed ips, ...
+    res = ts.run("sudo wg show all dump", hide="both")
+    interfaces = [fields[0] for fields in (line.split("\t") for line in res.stdout.splitlines())
+                  if len(fields) > 2 and fields[1] == peer]
+    if not interfaces:
+        raise ValueError(f"tunnel {t['tunnel_id']} has no peer on {t['ts_public_ip']}")
+    interface = interfaces[0]
+    ts.run(f"sudo wg set {interface} peer {shlex.quote(peer)} persistent-keepalive {keepalive}", hide="both")
+    # keep the on-disk config in step, so the interval survives a restart; it holds
+    # the private key, so the new copy is never readable by anyone else
+    conf = f"/etc/wireguard/{interface}.conf"
+    rewrite = (f"umask 077; awk -v key={shlex.quote(peer)} -v ka={keepalive} {shlex.quote(SET_PEER_KEEPALIVE_AWK)} "
+               f"{conf} > {conf}.new && chmod 0500 {conf}.new && mv {conf}.new {conf}")
+    ts.run(f"sudo sh -c {shlex.quote(rewrite)}", hide="both")
+
+    post_data = TunnelServerTelemetry(tunnel_id=t['tunnel_id'], ts_keepalive=keepalive).model_dump_json()
+    res = admin_api("POST", "/admin/tunnel/telemetry", data=post_data,
+                    headers={"Content-Type": "application/json"}, timeout=60)
     res.raise_for_status()
-    print(res.text)
+    print(f"tunnel {t['tunnel_id']}: tunnel server keepalive set to {keepalive}s")
 
-@task
-def create(c, tunnel_id: Optional[UUID4] = None, preshared_key: Optional[WireguardKey] = None):
+
+def sync_mirror(full: bool = False) -> "sqlite3.Connection":
+    """ Brings the local tunnel mirror up to date with the API and returns it.
+        `full` rebuilds it from scratch.
+    """
+    conn = connect_mirror()
+    if full:
+        reset_mirror(conn)
+    rewind = MIRROR_SYNC_REWIND
+    while True:
+        res = admin_api("GET", "/admin/tunnel/changes",
+                        params={'since': get_cursor(conn), 'limit': MIRROR_SYNC_PAGE, 'rewind': rewind},
+                        timeout=60, policy=INTERACTIVE)
+        rewind = 0  # later pages carry on from where the last one ended
+        res.raise_for_status()
+        changes = json.loads(res.text)
+        apply_changes(conn, changes['tunnels'], changes['cursor'])
+        if len(changes['tunnels']) < MIRROR_SYNC_PAGE:
+            return conn
+
+
+def parse_filter(filter: Optional[str]) -> Dict[str, str]:
+    """ Parses a comma separated list of field=text pairs. """
+    pairs = [pair.partition("=") for pair in (filter or "").split(",") if pair]
+    return {field.strip(): text for field, _, text in pairs}
+
+
+@task(klass=AdminTask)
+def show(c, tunnel_id, sync=True):
+    """ Show a single tunnel's details, from the local mirror after syncing it. """
+    t = get_mirrored_tunnel(sync_mirror() if sync else connect_mirror(), tunnel_id)
+    print(json.dumps(t or get_tunnel(tunnel_id)))
+
+
+@task(klass=AdminTask)
+def list(c, state=None, filter=None, sort="created_at", reverse=False, limit=0, json_output=False, sync=True, full=False):
+    """ List tunnels, from the local mirror after syncing it.
+
+        Selects tunnels in `state`, a TunnelState name, and matching `filter`, a
+        comma separated list of field=text pairs like `description=acme`, sorted by
+        the field `sort`. `--json-output` prints the full records, `--no-sync` skips
+        syncing, and `--full` rebuilds the mirror.
+    """
+    from common.models import TunnelState
+
+    conn = sync_mirror(full) if sync else connect_mirror()
+    tunnels = query_tunnels(conn, TunnelState[state] if state else None, parse_filter(filter),
+                            sort, bool(reverse), int(limit) or None)
+    if json_output:
+        print(json.dumps(tunnels))
+        return
+    for t in tunnels:
+        print(f"{t['tunnel_id']}  {TunnelState(t['state']).name:<9}  {t['created_at'][:19]}  "
+              f"{t['expires'][:19]}  {t.get('ts_zone') or '-':<15}  {t.get('description') or ''}")
+    print(f"{len(tunnels)} tunnels")
+
+@task(klass=AdminTask)
+def create(c, tunnel_id: Optional["UUID4"] = None, preshared_key: Optional["WireguardKey"] = None, mtu: Optional[int] = None, shared: bool = SHARED_TUNNEL_SERVERS, zone: Optional[str] = None, direct: bool = False):
     """ Create a tunnel server.
 
         This launches a cloud server, configures it using the device's information,
-        and posts further configuration data back to the API.
+        and posts further configuration data back to the API. `mtu` sets the tunnel
+        server's WireGuard MTU; by default wg-quick derives it from the VPC's MTU.
+
+        If WARM_POOL_SIZE is set, a booted server is claimed from the warm pool
+        instead, and the pool is refilled in the background. With `shared`, the
+        tunnel gets its own interface on a tunnel server hosting other tunnels.
+
+        The tunnel server goes in `zone` if given, or else the zone in TS_ZONES
+        nearest the location hint the device sent.
+
+        With `direct`, this workstation joins the tunnel as a WireGuard peer of the
+        tunnel server, which relays between it and the device. `fab connect` then
+        reaches the device in one hop, rather than via SSH to the tunnel server.
+        This needs wireguard-tools and sudo locally.
     """
+    from wireguard_tools import WireguardKey
+    from common.crypto import create_secret_box
+    from common.models import TunnelState, WireguardTunnel, WireguardPeer, TunnelServerLaunchDetails, SupportSecretBoxContents
+    from admin.provider import cloud_provider
+    from admin.cloud import destroy_ts_resources, wait_for_ts_ready, claim_pool_instance, place_shared_tunnel
+    from admin.cloud import instance_public_ip, instance_zone, choose_zone, WARM_POOL_SIZE
+
     try:
         if not tunnel_id:
             tunnel_id = UUID(input('tunnel id: ').strip())
@@ -99,21 +387,36 @@ def create(c, tunnel_id: Optional[UUID4] = None, preshared_key: Optional[Wiregua
     except Exception as e:
         logging.exception(f"could not use the supplied inputs: {str(e)}")
         return 1
+    tracing.set_attributes(tunnel_id=str(tunnel_id))
 
-    res = api.get(
-        f"{SUPPORT_TUNNEL_API}/admin/tunnel/{tunnel_id}", headers=auth_header())
+    res = admin_api("GET", f"/admin/tunnel/{tunnel_id}", policy=INTERACTIVE)
     res.raise_for_status()
     device_details = json.loads(res.text)
     assert device_details['state'] < TunnelState.completed, "Tunnel has completed. Please create a new tunnel."
-
-    # Create the cloud instance
-    print("creating a tunnel server")
-    i = create_ts_instance(tunnel_id)
-    # and wait a bit for SSH to come up. This would be nice:
-    # https://github.com/fabric/fabric/issues/1808
-    sleep(60)  # seconds
+    zone = zone or choose_zone(device_details.get('location_hint'))
+    print(f"placing tunnel server in {zone} (device location hint: {device_details.get('location_hint')})")
+
+    # Find room on a shared cloud instance, claim a warm one, or create one
+    launched_at = monotonic()
+    i = None if shared or not WARM_POOL_SIZE else claim_pool_instance(tunnel_id, zone)
+    pooled = i is not None
+    if shared:
+        i = place_shared_tunnel(tunnel_id, IPv4Network(device_details['network']), zone)
+        print(f"placed tunnel on shared tunnel server {i.name}")
+    elif i:
+        print(f"claimed warm tunnel server {i.name}")
+        refill_pool_in_background(zone)
+    else:
+        print("creating a tunnel server")
+        i = cloud_provider().create(tunnel_id, zone)
 
     try:
+        # and wait for its startup script to finish and SSH to come up.
+        wait_for_ts_ready(tunnel_id)
+        ts_ready_seconds = monotonic() - launched_at
+        print(f"tunnel server ready {ts_ready_seconds:.1f}s after {'claim' if pooled else 'launch'}")
+        ts = ts_connection(c, instance_public_ip(i))
+
         # Create our wireguard primitives
         device_peer = WireguardPeer(
             public_key=WireguardKey(device_details['device_wg_public_key']),
@@ -123,7 +426,7 @@ def create(c, tunnel_id: Optional[UUID4] = None, preshared_key: Optional[Wiregua
         )
         private_key = WireguardKey.generate()
         t = WireguardTunnel(
-            interface=f"support-{random.randint(10,9999)}",
+            interface=shared_interface(tunnel_id) if shared else f"support-{random.randint(10,9999)}",
             private_key=private_key,
             public_key=private_key.public_key(),
             my_ip=server_ip(
@@ -131,23 +434,33 @@ def create(c, tunnel_id: Optional[UUID4] = None, preshared_key: Optional[Wiregua
             ),
             network=IPv4Network(device_details['network']),
             preshared_key=WireguardKey(preshared_key),
-            # the below port range is also defined in the firewall rules for the hosts
-            # in opentofu
-            port=random.randint(20000, 65534),
-            peers=[device_peer]
+            port=free_wg_port(ts),
+            peers=[device_peer],
+            mtu=mtu
         )
+        admin_tunnel = None
+        if direct:
+            admin_key = WireguardKey.generate()
+            t.relay = True
+            t.peers.append(WireguardPeer(public_key=admin_key.public_key(), allowed_ip=admin_ip(t.network)))
+            admin_tunnel = WireguardTunnel(
+                interface=direct_interface(tunnel_id),
+                private_key=admin_key,
+                public_key=admin_key.public_key(),
+                my_ip=admin_ip(t.network),
+                network=t.network,
+                preshared_key=t.preshared_key,
+                port=random.randint(20000, 65534),
+                peers=[WireguardPeer(
+                    public_key=t.public_key,
+                    allowed_ip=server_ip(t.network),
+                    port=t.port,
+                    public_ip=instance_public_ip(i),
+                )],
+                mtu=mtu
+            )
 
         print("configuring tunnel server")
-        ts = Connection(
-            host=str(get_ts_instance_public_ip(tunnel_id)),
-            connect_kwargs={"auth_timeout": 120} # long for 2FA
-        )
-
-        # things get hacky when being concerned with local ssh keys and all - 
-        # the below configures things to "just work", every time.
-        c.run("gcloud compute config-ssh", hide="both")
-        user_from_oslogin = c.run("gcloud compute os-login describe-profile --format=json", hide="both")
-        ts.user = json.loads(user_from_oslogin.stdout)['posixAccounts'][0]['username']
 
         # Configure the cloud instance's tunnel
         write_wireguard_config(ts, t)
@@ -156,7 +469,7 @@ def create(c, tunnel_id: Optional[UUID4] = None, preshared_key: Optional[Wiregua
         start_wireguard_tunnel(ts, t)
 
         # create our shared ssh key
-        ssh_pubkey = create_sshkey(ts)
+        ssh_pubkey = create_sshkey(ts, ts_ssh_keyfile(tunnel_id, shared))
 
         # create a b64 secretbox with the ssh public key in it
         # using a secretbox, encrypted with this TS's privkey and the device's pubkey,
@@ -171,103 +484,392 @@ def create(c, tunnel_id: Optional[UUID4] = None, preshared_key: Optional[Wiregua
         post_data = TunnelServerLaunchDetails(
             tunnel_id=tunnel_id,
             ts_instance_id=str(i.id), # i.id is naturally an int
-            ts_public_ip=get_ts_instance_public_ip(tunnel_id),
+            ts_public_ip=instance_public_ip(i),
             ts_wg_public_key=str(t.public_key),
             ts_wg_port=t.port,
-            support_secret_box=sb
+            support_secret_box=sb,
+            ts_ready_seconds=ts_ready_seconds,
+            ts_pooled=pooled,
+            ts_zone=instance_zone(i)
         ).model_dump_json()
 
-        res = api.post(f"{SUPPORT_TUNNEL_API}/admin/tunnel/details",
-                       data=post_data, timeout=60, headers=auth_header())
+        res = admin_api("POST", "/admin/tunnel/details", data=post_data,
+                        headers={"Content-Type": "application/json"}, timeout=60, policy=CRITICAL)
         res.raise_for_status()
 
+        if admin_tunnel:
+            start_direct_peer(c, tunnel_id, admin_tunnel)
+            print(f"joined the tunnel directly on {admin_tunnel.interface}, as {admin_tunnel.my_ip.ip}")
+
         print("tunnel server created! It may take up to 5 minutes for the remote device to check back in, but when it does you can run the following command to log into it:")
         print(f"fab connect {tunnel_id}")
     except Exception as e:
         logging.exception(f"failed to configure tunnel server: {str(e)}")
-        destroy_ts_resources(tunnel_id)
+        if shared:
+            remove_shared_tunnel(c, tunnel_id)
+        else:
+            destroy_ts_resources(tunnel_id)
         raise e
 
 
-@task
-def gc(c):
-    """ Garbage collect all resources. """
+@task(klass=AdminTask)
+def build_image(c):
+    """ Build a tunnel server image with its packages preinstalled.
+
+        New tunnel servers boot from the latest image in TS_IMAGE_FAMILY. Rebuild
+        every so often to pick up security updates.
+    """
+    from admin.cloud import build_ts_image, TS_IMAGE_FAMILY
+
+    print(f"building a new image in family {TS_IMAGE_FAMILY}; this takes a few minutes")
+    image_name = build_ts_image()
+    print(f"built {image_name}")
+
+
+@task(klass=AdminTask)
+def pool_fill(c, size=None, zone=None):
+    """ Top up the warm pool in a zone to `size` unclaimed tunnel servers; by
+        default WARM_POOL_SIZE, in ZONE.
+    """
+    from admin.cloud import fill_pool, WARM_POOL_SIZE, ZONE
+
+    launched = fill_pool(int(size or WARM_POOL_SIZE), zone or ZONE)
+    print(f"launched {launched} warm pool members")
+
+
+@task(klass=AdminTask)
+def pool_status(c):
+    """ Show the warm pool, and how quickly claimed servers were ready compared to cold ones. """
+    from admin.cloud import list_pool_instances, WARM_POOL_SIZE
+
+    members = list_pool_instances()
+    print(f"{len(members)} unclaimed warm pool members (target {WARM_POOL_SIZE}):")
+    for n in members:
+        print(f"  {n.name} {n.status} since {n.creation_timestamp}")
+
+    res = admin_api("GET", "/admin/tunnel/list", timeout=60, policy=INTERACTIVE)
+    res.raise_for_status()
+    for label, pooled in (("claimed", True), ("cold", False)):
+        ready = [t['ts_ready_seconds'] for t in json.loads(res.text)
+                 if t.get('ts_ready_seconds') is not None and bool(t.get('ts_pooled')) == pooled]
+        if ready:
+            print(f"{label}: median {median(ready):.1f}s to ready over {len(ready)} tunnels")
+
+
+@task(klass=AdminTask)
+def gc(c, parallelism=8):
+    """ Garbage collect all resources, and trim the warm pool to WARM_POOL_SIZE per zone.
+
+        Tunnels are fetched once, and API updates and instance deletions are sent
+        `parallelism` at a time.
+    """
+    from common.models import TunnelState
+    from admin.provider import cloud_provider
+
+    start = monotonic()
     # TODO: actually cast things into a model for this response
-    res = api.get(f"{SUPPORT_TUNNEL_API}/admin/tunnel/list",
-                  headers=auth_header(), timeout=60)
+    res = admin_api("GET", "/admin/tunnel/list", timeout=60, policy=INTERACTIVE)
     res.raise_for_status()
-    all_tunnels = json.loads(res.text)
+    tunnels = {t['tunnel_id']: t for t in json.loads(res.text)}
+    finished = [TunnelState.completed, TunnelState.timedout]
+
+    def is_finished(tunnel_id) -> bool:
+        t = tunnels.get(tunnel_id)
+        return not t or t['state'] in finished
 
     # find all things expired but not stopped, and stop them
-    for t in all_tunnels:
-        if datetime.fromisoformat(t['expires']) < datetime.now() and t['state'] not in [TunnelState.completed, TunnelState.timedout]:
-            print(
-                f"tunnel {t['tunnel_id']} expired {t['expires']}; updating API.")
-            api.delete(
-                f"{SUPPORT_TUNNEL_API}/admin/tunnel/{t['tunnel_id']}", headers=auth_header(), timeout=60)
-
-    # find all server resources not associated with a running Tunnel
-    running_nodes = list_ts_instances()
-    for n in running_nodes:
-        tunnel_id = n.name.removeprefix(f"{INSTANCE_NAME_PREFIX}-")
-        t = get_tunnel(tunnel_id)
-        if not t or t['state'] in [TunnelState.completed, TunnelState.timedout]:
-            print(
-                f"tunnel {tunnel_id} may have running resources. destroying instance id {n.id}")
-            destroy_ts_resources(tunnel_id)
+    expired = [t for t in tunnels.values()
+               if datetime.fromisoformat(t['expires']) < datetime.now() and t['state'] not in finished]
+    for t in expired:
+        print(f"tunnel {t['tunnel_id']} expired {t['expires']}; updating API.")
+    with ThreadPoolExecutor(max_workers=int(parallelism)) as pool:
+        responses = pool.map(lambda t: admin_api("DELETE", f"/admin/tunnel/{t['tunnel_id']}", timeout=60), expired)
+        for t, r in zip(expired, responses):
+            if r.ok:
+                t['state'] = TunnelState.completed  # so its resources are collected below
+
+    # find all server resources not associated with a running Tunnel, and warm pool
+    # members that are surplus or stale
+    provider = cloud_provider()
+    doomed = {n.name: (n, "warm pool member") for n in provider.retire_pool()}
+    for n in provider.list():
+        hosted = provider.hosted_tunnel_ids(n)
+        if hosted is not None:
+            # remove finished tunnels from shared servers one by one; the last one out deletes it
+            for tunnel_id in hosted:
+                if is_finished(tunnel_id):
+                    remove_shared_tunnel(c, tunnel_id)
+            if not hosted:
+                # emptied out, but its deletion failed or never happened
+                print(f"shared tunnel server {n.name} hosts nothing. destroying instance id {n.id}")
+                doomed[n.name] = (n, "empty shared tunnel server")
+            continue
+        tunnel_id = provider.tunnel_id(n)
+        if not tunnel_id:
+            continue  # an unclaimed warm pool member
+        if is_finished(tunnel_id):
+            print(f"tunnel {tunnel_id} may have running resources. destroying instance id {n.id}")
+            doomed[n.name] = (n, f"tunnel {tunnel_id}")
+    results = provider.destroy([n for n, _ in doomed.values()], parallelism=int(parallelism))
+
+    failed = {name: error for name, error in results.items() if error}
+    for name, error in failed.items():
+        print(f"failed to delete {name} ({doomed[name][1]}): {error}")
+    print(f"gc: {len(expired)} tunnels expired, {len(results) - len(failed)} instances deleted, "
+          f"{len(failed)} failed, in {monotonic() - start:.1f}s")
 
 
-@task
+@task(klass=AdminTask)
 def stop(c, tunnel_id):
     """ Stops a single tunnel. """
-    res = api.delete(f"{SUPPORT_TUNNEL_API}/admin/tunnel/{tunnel_id}",
-                     headers=auth_header(), timeout=60)
+    res = admin_api("DELETE", f"/admin/tunnel/{tunnel_id}", timeout=60)
     res.raise_for_status()
+    close_session(tunnel_id)
+    stop_direct_peer(c, tunnel_id)
     # being lazy and overzealous at the same time - we'll just garbage-college its resources.
     gc(c)
 
-@task
-def connect(c, tunnel_id, command="/bin/bash", pty=True):
-    """ Connect to a remote device, identified by a tunnel. """
+@task(klass=AdminTask)
+def tune_keepalive(c, tunnel_id=None):
+    """ Match tunnel servers' keepalives to the intervals their devices settled on,
+        after `inv tune-keepalive` on the device. Without a tunnel_id, does so for
+        every running tunnel whose server is behind; each server may prompt for 2FA.
+        `fab connect` and the other device commands also do this for their tunnel,
+        over the connection to its tunnel server they make anyway.
+    """
+    if tunnel_id:
+        t = get_tunnel(tunnel_id)
+        assert t, f"Tunnel {tunnel_id} not found"
+        tunnels = [t]
+    else:
+        res = admin_api("GET", "/admin/tunnel/list", timeout=60, policy=INTERACTIVE)
+        res.raise_for_status()
+        tunnels = json.loads(res.text)
+    behind = [t for t in tunnels if ts_keepalive_behind(t)]
+    if not behind:
+        print("every tunnel server's keepalive already matches its device's")
+    for t in behind:
+        try:
+            ts = ts_connection(c, t['ts_public_ip'])
+            sync_ts_keepalive(ts, t)
+            ts.close()
+        except Exception as e:
+            logging.warning(f"failed to set the tunnel server keepalive for tunnel {t['tunnel_id']}: {str(e)}")
+
+
+def device_session(c, tunnel_id, reuse: bool = True) -> DeviceSession:
+    """ Returns the cached SSH session for a tunnel, or sets up a new one: checks the
+        tunnel with the API, finds its tunnel server and fetches the device key from it.
+    """
+    from common.models import TunnelState
+    from admin.provider import cloud_provider
+
+    session = load_session(tunnel_id) if reuse else None
+    if session:
+        return session
+
     # Care should be exercised here; we're taking data from a remote source and using it to
     # run shell commands. Validate every last bit of data.
     t = get_tunnel(tunnel_id)
+    assert t, f"Tunnel {tunnel_id} not found"
     assert TunnelState(t['state']) == TunnelState.running, "Device has not yet connected"
     dip = device_ip(IPv4Network(t['network'])).ip
     assert t['support_user'].isalnum()
     assert t['support_user'].isascii()
     support_user = t['support_user']
 
-    # set up local
-    c.run("gcloud compute config-ssh", hide="both")
-    user_from_oslogin = c.run("gcloud compute os-login describe-profile --format=json", hide="both")
-    ts_user = json.loads(user_from_oslogin.stdout)['posixAccounts'][0]['username']
-
     # set up connection to bastion
-    ts = Connection(
-        host = str(get_ts_instance_public_ip(tunnel_id)),
-        user = ts_user,
-        connect_kwargs={"auth_timeout": 120} # long for 2FA
-    )
+    provider = cloud_provider()
+    i = provider.get(tunnel_id, t.get('ts_zone'))
+    ts = ts_connection(c, provider.public_ip(i))
 
     # grab the ssh private key on the tunnel server
-    ssh_privkey = ts.run(f"sudo cat {SSH_KEYFILE_PATH}", hide="both")
+    shared = provider.hosted_tunnel_ids(i) is not None
+    ssh_privkey = ts.run(f"sudo cat {ts_ssh_keyfile(tunnel_id, shared)}", hide="both")
     assert ssh_privkey
-
-    # set up connection to destination device
-    device = Connection(
-        host=str(dip),
-        user=support_user,
-        gateway=ts,
-        connect_kwargs = {
-            "pkey": Ed25519Key.from_private_key(io.StringIO(ssh_privkey.stdout)),
-        }
+    if ts_keepalive_behind(t):
+        # we're on the tunnel server anyway; no extra 2FA prompt
+        try:
+            sync_ts_keepalive(ts, t)
+        except Exception as e:
+            logging.warning(f"failed to set the tunnel server keepalive for tunnel {tunnel_id}: {str(e)}")
+    ts.close()
+
+    session = DeviceSession(
+        tunnel_id=str(tunnel_id),
+        ts_host=str(ts.host),
+        ts_user=ts.user,
+        device_host=str(dip),
+        device_user=support_user,
     )
+    save_session(session, ssh_privkey.stdout)
+    return session
+
+
+@task(klass=AdminTask)
+def connect(c, tunnel_id, command="/bin/bash", pty=True, reuse=True):
+    """ Connect to a remote device, identified by a tunnel.
+
+        Connections are kept open for SSH_SESSION_IDLE seconds after use, so later
+        calls against the same tunnel start straight away. `--no-reuse` starts over.
+    """
+    session = device_session(c, tunnel_id, reuse)
+    rc = subprocess.call(ssh_args(session, f"sudo {command}", pty=pty))
+    if rc:
+        raise Exit(code=rc)
+
 
-    # and finally execute a shell
-    device.sudo(command, pty=pty)
+@task(klass=AdminTask)
+def disconnect(c, tunnel_id):
+    """ Close the cached SSH session to a remote device. """
+    close_session(tunnel_id)
 
-@task
+@task(klass=AdminTask)
 def command(c, tunnel_id, command):
     """ Run an arbitrary command on the remote device """
     connect(c, tunnel_id, command, pty=False)
+
+
+@task(klass=AdminTask)
+def forward(c, tunnel_id, local_port=8080, remote_port=80, remote_host="localhost", socks=None):
+    """ Forward a local port to a port on or behind the remote device, until interrupted.
+
+        By default http://localhost:8080 reaches the device's web UI. `--socks <port>`
+        also starts a SOCKS proxy on that local port, through which a browser can
+        reach anything the device can. Every connection shares one SSH transport,
+        which is re-established if the link drops.
+    """
+    forwards = ["-L", f"127.0.0.1:{int(local_port)}:{remote_host}:{int(remote_port)}"]
+    if socks:
+        forwards += ["-D", f"127.0.0.1:{int(socks)}"]
+    print(f"forwarding localhost:{local_port} to {remote_host}:{remote_port} on the device"
+          + (f", SOCKS proxy on localhost:{socks}" if socks else "") + "; ^C to stop")
+    while True:
+        session = device_session(c, tunnel_id)
+        started = monotonic()
+        # a dedicated connection, rather than the shared one, so that it lives as long as
+        # the forward does and a busy forward doesn't slow down interactive sessions
+        rc = subprocess.call(ssh_args(session, pty=False, multiplex=False, extra=[
+            "-N",
+            "-o", "ExitOnForwardFailure=yes",
+            "-o", "ServerAliveInterval=15",
+            "-o", "ServerAliveCountMax=3",
+            *forwards,
+        ]))
+        # 255 is a dropped or failed connection; anything else is ssh being told to stop.
+        # Only reconnect if it had been working, not if it failed to start at all.
+        if rc != 255 or monotonic() - started < 10:
+            raise Exit(code=rc)
+        logging.warning("connection to the device dropped; reconnecting")
+        sleep(2)
+
+
+def transfer(c, tunnel_id, attempts, resume, do_transfer) -> TransferStats:
+    """ Runs a transfer, resuming it up to `attempts` times if the link drops. """
+    for attempt in range(1, int(attempts) + 1):
+        session = device_session(c, tunnel_id)
+        try:
+            return do_transfer(session, resume or attempt > 1)
+        except IOError as e:
+            if attempt == int(attempts):
+                raise Exit(str(e), code=1)
+            logging.warning(f"{e} (attempt {attempt}/{attempts})")
+    raise AssertionError("unreachable")
+
+
+@task(klass=AdminTask)
+def get(c, tunnel_id, remote_path, local_path=None, resume=True, attempts=3):
+    """ Copy a file off the remote device.
+
+        The file is streamed and gzipped on the wire. If it is cut off, rerun the same
+        command to pick up where it stopped; `--no-resume` starts over.
+    """
+    local = Path(local_path or Path(remote_path).name)
+    stats = transfer(c, tunnel_id, attempts, resume, lambda session, resume: download(session, remote_path, local, resume))
+    print(f"{remote_path} -> {local}: {stats}")
+
+
+@task(klass=AdminTask)
+def put(c, tunnel_id, local_path, remote_path, resume=True, attempts=3):
+    """ Copy a file onto the remote device, as root.
+
+        The file is streamed and gzipped on the wire. If it is cut off, rerun the same
+        command to pick up where it stopped; `--no-resume` starts over.
+    """
+    local = Path(local_path)
+    stats = transfer(c, tunnel_id, attempts, resume, lambda session, resume: upload(session, local, remote_path, resume))
+    print(f"{local} -> {remote_path}: {stats}")
+
+
+def select_tunnels(state: Optional[str] = None, filter: Optional[str] = None) -> List[dict]:
+    """ Fetches tunnels from the mirror that are in `state`, a TunnelState name, and
+        whose fields contain the text of every `field=text` pair in the comma
+        separated `filter`.
+    """
+    from common.models import TunnelState
+
+    return query_tunnels(sync_mirror(), TunnelState[state] if state else None, parse_filter(filter))
+
+
+@task(klass=AdminTask)
+def fanout(c, command, state="running", filter=None, parallelism=8, timeout=60, json_lines=False):
+    """ Run a command on many remote devices at once.
+
+        Runs on every tunnel in `state` matching `filter`, a comma separated list of
+        field=text pairs like `description=acme`. Output lines are prefixed with the
+        tunnel id, or printed as JSON lines with `--json-lines`, and a summary of
+        exit codes and durations follows. Commands still running after `timeout`
+        seconds are killed.
+    """
+    tunnels = select_tunnels(state, filter)
+    print_lock = Lock()
+
+    def emit(record: dict):
+        with print_lock:
+            if json_lines:
+                print(json.dumps(record), flush=True)
+            elif 'line' in record:
+                print(f"[{record['tunnel_id'][:8]}] {record['line']}", flush=True)
+            else:
+                print(f"[{record['tunnel_id'][:8]}] {record['error']}", flush=True)
+
+    # Sessions are set up one at a time, as the tunnel servers may prompt for 2FA;
+    # after that every command goes over an open connection and needs no input.
+    sessions: Dict[str, DeviceSession] = {}
+    for t in tunnels:
+        try:
+            session = device_session(c, t['tunnel_id'])
+            subprocess.run(ssh_args(session, "true"), check=True, timeout=180)
+            sessions[t['tunnel_id']] = session
+        except Exception as e:
+            emit({'tunnel_id': t['tunnel_id'], 'error': f"unreachable: {str(e)}"})
+
+    def run(tunnel_id: str):
+        return run_remote(sessions[tunnel_id], f"sudo {command}", float(timeout),
+                          lambda stream, line: emit({'tunnel_id': tunnel_id, 'stream': stream, 'line': line}))
+
+    with ThreadPoolExecutor(max_workers=int(parallelism)) as pool:
+        results = dict(zip(sessions, pool.map(run, sessions)))
+
+    durations = [seconds for _, seconds in results.values()]
+    summary = {
+        'tunnels': len(tunnels),
+        'unreachable': len(tunnels) - len(sessions),
+        'succeeded': sum(1 for rc, _ in results.values() if rc == 0),
+        'failed': {tunnel_id: rc for tunnel_id, (rc, _) in results.items() if rc},
+        'timed_out': [tunnel_id for tunnel_id, (rc, _) in results.items() if rc is None],
+        'seconds': {
+            'median': round(median(durations), 2) if durations else None,
+            'max': round(max(durations), 2) if durations else None,
+        },
+    }
+    if json_lines:
+        print(json.dumps({'summary': summary}))
+        return
+    print(f"{summary['succeeded']}/{summary['tunnels']} succeeded, {len(summary['failed'])} failed, "
+          f"{len(summary['timed_out'])} timed out, {summary['unreachable']} unreachable; "
+          f"median {summary['seconds']['median']}s, max {summary['seconds']['max']}s")
+    for tunnel_id, rc in summary['failed'].items():
+        print(f"  {tunnel_id}: exit code {rc}")
+    for tunnel_id in summary['timed_out']:
+        print(f"  {tunnel_id}: timed out after {timeout}s")
@@ -1,65 +1,283 @@
+import sys
+import socket
 import logging
 
 from os import getenv
-from typing import List
-from ipaddress import IPv4Address
+from secrets import token_hex
+from typing import Any, Dict, List, Tuple, Optional
+from datetime import datetime, timezone
+from collections import defaultdict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import IPv4Address, IPv4Network
+from time import sleep, monotonic
 
 from pydantic import UUID4
 from google.cloud import compute_v1
+from google.api_core.exceptions import NotFound
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 from common.util import project_id
-from common.constants import INSTANCE_NAME_PREFIX
+from common.constants import INSTANCE_NAME_PREFIX, NAT_PROBE_PORT, WG_MAX_KEEPALIVE
 
 ZONE = getenv("ZONE", "us-central1-b")
-REGION = ZONE[0:-2]
+# zones tunnel servers may be placed in, comma separated; each one's region needs a
+# ts-ENV subnet (see opentofu's ts_regions). ZONE is the fallback.
+TS_ZONES = [z.strip() for z in getenv("TS_ZONES", ZONE).split(",") if z.strip()]
+# any value set here swaps GCP for admin.fake_compute, an in-memory stand-in
+FAKE_COMPUTE = getenv("FAKE_COMPUTE", False)
 ENV = getenv("ENV", "prod")
-PROJECT_ID = project_id()
+# the guest attribute the startup script sets once it has finished
+READY_ATTRIBUTE = "support-tunnel/ready"
+# packages every tunnel server needs; baked into TS_IMAGE_FAMILY by `fab build-image`
+TS_PACKAGES = ["wireguard", "wireguard-tools", "fail2ban", "apparmor", "tmux"]
+TS_IMAGE_FAMILY = getenv("TS_IMAGE_FAMILY", f"support-tunnel-{ENV}")
+# deliberately not prefixed with INSTANCE_NAME_PREFIX, so `fab gc` leaves it be
+IMAGE_BUILDER_NAME_PREFIX = "ts-image-builder"
+
+# Warm pool: generic, booted tunnel servers waiting to be claimed by `fab create`.
+# Members are named POOL_NAME_PREFIX-<random>, labelled POOL_LABEL and IMAGE_LABEL
+# (the image they booted from). Claiming one adds a TUNNEL_ID_LABEL; the instance
+# keeps its pool name. `fab gc` retires surplus and stale members by setting
+# POOL_LABEL to "retired", then deletes them.
+WARM_POOL_SIZE = int(getenv("WARM_POOL_SIZE", 0))  # 0 disables the pool
+POOL_NAME_PREFIX = f"{INSTANCE_NAME_PREFIX}-pool"
+POOL_LABEL = "support-tunnel-pool"
+IMAGE_LABEL = "support-tunnel-image"
+TUNNEL_ID_LABEL = "tunnel-id"
+# members older than this many hours are replaced, to keep up with OS updates
+POOL_MAX_AGE_HOURS = float(getenv("POOL_MAX_AGE_HOURS", 24 * 7))
+# members whose startup script hasn't finished this many seconds after launch are replaced
+POOL_READY_TIMEOUT = float(getenv("POOL_READY_TIMEOUT", 15 * 60))
+
+# Shared tunnel servers host many tunnels, each on its own WireGuard interface. They
+# are named SHARED_NAME_PREFIX-<random>, labelled SHARED_LABEL, and carry a
+# HOSTED_LABEL_PREFIX<tunnel id> and a NETWORK_LABEL_PREFIX<tunnel id> label per
+# hosted tunnel. GCP allows 64 labels, so no more than 30 tunnels fit. Releasing
+# the last tunnel adds DRAINING_LABEL, and nothing is placed there again.
+SHARED_TS_CAPACITY = int(getenv("SHARED_TS_CAPACITY", 16))
+SHARED_NAME_PREFIX = f"{INSTANCE_NAME_PREFIX}-shared"
+SHARED_LABEL = "support-tunnel-shared"
+HOSTED_LABEL_PREFIX = "hosts-"
+NETWORK_LABEL_PREFIX = "net-"
+DRAINING_LABEL = "support-tunnel-draining"
+
+# how long get_ts_instance() trusts what it last fetched for a tunnel
+INSTANCE_CACHE_TTL = float(getenv("INSTANCE_CACHE_TTL", 10))
+
+# IANA timezone prefixes a device may hint with, most specific first, and the GCP
+# region prefixes nearest to each, in order of preference
+TIMEZONE_REGIONS = [
+    ("America/Los_Angeles", ["us-west"]),
+    ("America/Vancouver", ["us-west", "northamerica-"]),
+    ("America/Phoenix", ["us-west"]),
+    ("America/Denver", ["us-west", "us-central"]),
+    ("America/Chicago", ["us-central", "us-south"]),
+    ("America/Toronto", ["northamerica-northeast", "us-east"]),
+    ("America/New_York", ["us-east", "northamerica-northeast"]),
+    ("America/Sao_Paulo", ["southamerica-east"]),
+    ("America/Argentina", ["southamerica-"]),
+    ("America/", ["us-central", "us-east", "us-"]),
+    ("Europe/", ["europe-"]),
+    ("Africa/", ["africa-", "europe-", "me-"]),
+    ("Asia/Tokyo", ["asia-northeast1"]),
+    ("Asia/Kolkata", ["asia-south"]),
+    ("Asia/Singapore", ["asia-southeast1"]),
+    ("Asia/", ["asia-", "me-"]),
+    ("Australia/", ["australia-"]),
+    ("Pacific/Auckland", ["australia-"]),
+]
 
 jinja2_env = Environment(loader=FileSystemLoader(
     "admin/templates"), autoescape=select_autoescape())
 
-def get_instance_image() -> str:
+# seconds taken by each cloud API call this process has made, by "Client.method"
+cloud_api_calls: Dict[str, List[float]] = defaultdict(list)
+
+class InstrumentedClient:
+    """ Wraps a GCP client, timing every call made through it into cloud_api_calls.
+        Polling that happens inside `operation.result()` is not counted.
+    """
+    def __init__(self, client: Any):
+        self._client = client
+        self._name = type(client).__name__
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._client, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            start = monotonic()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                cloud_api_calls[f"{self._name}.{name}"].append(monotonic() - start)
+        return timed
+
+@lru_cache(1)
+def instances_client() -> Any:
+    """ A process-wide InstancesClient, so channel and auth setup happen once. """
+    if FAKE_COMPUTE:
+        from admin.fake_compute import FakeInstancesClient
+        return InstrumentedClient(FakeInstancesClient())
+    return InstrumentedClient(compute_v1.InstancesClient())
+
+@lru_cache(1)
+def images_client() -> Any:
+    """ A process-wide ImagesClient, so channel and auth setup happen once. """
+    if FAKE_COMPUTE:
+        from admin.fake_compute import FakeImagesClient
+        return InstrumentedClient(FakeImagesClient())
+    return InstrumentedClient(compute_v1.ImagesClient())
+
+def report_cloud_api_calls(label: str):
+    """ Prints a summary of cloud_api_calls to stderr, then resets it. """
+    total = sum(len(t) for t in cloud_api_calls.values())
+    print(f"{label}: {total} cloud API calls, {sum(sum(t) for t in cloud_api_calls.values()):.2f}s", file=sys.stderr)
+    for call, times in sorted(cloud_api_calls.items()):
+        print(f"  {call}: {len(times)} calls, {sum(times):.2f}s total, {max(times):.2f}s max", file=sys.stderr)
+    cloud_api_calls.clear()
+
+# tunnel id -> (fetched at, instance)
+_instance_cache: Dict[str, Tuple[float, compute_v1.Instance]] = {}
+
+def invalidate_ts_instance(tunnel_id: Optional[UUID4] = None):
+    """ Forgets the cached instance for a tunnel, or every cached instance. Anything
+        that creates, deletes or relabels an instance should call this.
+    """
+    if tunnel_id is None:
+        _instance_cache.clear()
+    else:
+        _instance_cache.pop(str(tunnel_id), None)
+
+def get_base_image() -> str:
     """ Returns a str representing the latest Debian 12, in the format wanted by AttachedDiskInitializeParams """
-    image_client = compute_v1.ImagesClient()
+    image_client = images_client()
     i = image_client.get_from_family(project='debian-cloud', family='debian-12')
     return f"projects/debian-cloud/global/images/{i.name}"
 
+@lru_cache(1)
+def get_instance_image() -> str:
+    """ Returns the latest prebaked tunnel server image from TS_IMAGE_FAMILY, falling
+        back to stock Debian 12 if none has been built. Cached for the life of the
+        process.
+    """
+    image_client = images_client()
+    try:
+        i = image_client.get_from_family(project=project_id(), family=TS_IMAGE_FAMILY)
+        return f"projects/{project_id()}/global/images/{i.name}"
+    except NotFound:
+        logging.warning(f"no images in family {TS_IMAGE_FAMILY}; using stock Debian. Run `fab build-image` to speed up launches.")
+        return get_base_image()
+
+def instance_image_name() -> str:
+    """ Returns the name of the image new tunnel servers boot from. """
+    return get_instance_image().rsplit("/", 1)[-1]
+
 def get_instance_size() -> str:
     """ Returns a size representing the cheapest available instance """
     # At present this is e2-micro. Automagically determining this is time-consuming.
     return 'e2-micro'
 
-def get_ts_instance(tunnel_id: UUID4) -> compute_v1.Instance:
-    """ Given a tunnel id, fetch a Node record for its tunnel server. """
-    instance_client = compute_v1.InstancesClient()
-    return instance_client.get(project=PROJECT_ID, zone=ZONE, instance=f"{INSTANCE_NAME_PREFIX}-{tunnel_id}")
+def choose_zone(hint: Optional[str], candidates: List[str] = TS_ZONES) -> str:
+    """ Picks the candidate zone nearest a device, from the location hint it sent with
+        its tunnel request: a GCP region or zone, or an IANA timezone like
+        Europe/Berlin. Falls back to the first candidate.
+    """
+    if hint:
+        for zone in candidates:
+            if zone.startswith(hint):
+                return zone
+        for timezone, region_prefixes in TIMEZONE_REGIONS:
+            if not hint.startswith(timezone):
+                continue
+            for prefix in region_prefixes:
+                for zone in candidates:
+                    if zone.startswith(prefix):
+                        return zone
+    return candidates[0]
+
+def instance_zone(i: compute_v1.Instance) -> str:
+    """ Returns the zone an instance lives in; the API gives it as a URL. """
+    return i.zone.rsplit("/", 1)[-1]
+
+def instance_age(i: compute_v1.Instance) -> float:
+    """ Returns the seconds since an instance was created, or 0 if unknown. """
+    if not i.creation_timestamp:
+        return 0
+    return (datetime.now(timezone.utc) - datetime.fromisoformat(i.creation_timestamp)).total_seconds()
+
+def _list_instances(filter: str = "") -> List[compute_v1.Instance]:
+    """ Lists instances across every zone, with one aggregated call. """
+    instance_client = instances_client()
+    pages = instance_client.aggregated_list(request=compute_v1.AggregatedListInstancesRequest(
+        project=project_id(), filter=filter))
+    return [i for _, scoped in pages for i in scoped.instances]
+
+def get_ts_instance(tunnel_id: UUID4, zone: Optional[str] = None) -> compute_v1.Instance:
+    """ Given a tunnel id, fetch a Node record for its tunnel server. Records are
+        cached for INSTANCE_CACHE_TTL seconds. Pass the zone, if known, to save a
+        search across zones.
+    """
+    cached = _instance_cache.get(str(tunnel_id))
+    if cached and monotonic() - cached[0] < INSTANCE_CACHE_TTL:
+        return cached[1]
+    i = _fetch_ts_instance(tunnel_id, zone)
+    _instance_cache[str(tunnel_id)] = (monotonic(), i)
+    return i
+
+def _fetch_ts_instance(tunnel_id: UUID4, zone: Optional[str] = None) -> compute_v1.Instance:
+    name = f"{INSTANCE_NAME_PREFIX}-{tunnel_id}"
+    if zone:
+        try:
+            return instances_client().get(project=project_id(), zone=zone, instance=name)
+        except NotFound:
+            pass
+    # it may be in another zone, a claimed warm pool member, which keeps its pool
+    # name, or a shared server
+    found = _list_instances(
+        f'(name = "{name}") OR (labels.{TUNNEL_ID_LABEL} = "{tunnel_id}") OR (labels.{HOSTED_LABEL_PREFIX}{tunnel_id} = "true")')
+    if not found:
+        raise NotFound(f"no tunnel server found for tunnel {tunnel_id}")
+    return found[0]
+
+def ts_tunnel_id(i: compute_v1.Instance) -> Optional[str]:
+    """ Returns the tunnel id a tunnel server belongs to, or None if it is an unclaimed
+        warm pool member or a shared server.
+    """
+    if TUNNEL_ID_LABEL in i.labels:
+        return i.labels[TUNNEL_ID_LABEL]
+    if i.name.startswith((POOL_NAME_PREFIX, SHARED_NAME_PREFIX)):
+        return None
+    # removeprefix() needs Python 3.9, and admin still runs on 3.7
+    prefix = f"{INSTANCE_NAME_PREFIX}-"
+    return i.name[len(prefix):] if i.name.startswith(prefix) else i.name
 
 def list_ts_instances() -> List[compute_v1.Instance]:
-    """ Lists tunnel server instances. At present, it just uses the 
+    """ Lists tunnel server instances in every zone. At present, it just uses the
         INSTANCE_NAME_PREFIX to determine if it is a tunnel server.
     """
-    instance_client = compute_v1.InstancesClient()
-    return [n for n in instance_client.list(project=PROJECT_ID, zone=ZONE) if n.name.startswith(INSTANCE_NAME_PREFIX)]
+    return [n for n in _list_instances() if n.name.startswith(INSTANCE_NAME_PREFIX)]
 
-def _create_ts_boot_disk() -> compute_v1.AttachedDisk:
+def _create_ts_boot_disk(source_image: Optional[str] = None, zone: str = ZONE) -> compute_v1.AttachedDisk:
     """ create a boot disk description for use with a tunnel server """
     disk = compute_v1.AttachedDisk()
     init_params = compute_v1.AttachedDiskInitializeParams()
-    init_params.source_image = get_instance_image()
+    init_params.source_image = source_image or get_instance_image()
     init_params.disk_size_gb = 10
-    init_params.disk_type = f"zones/{ZONE}/diskTypes/pd-standard"
+    init_params.disk_type = f"zones/{zone}/diskTypes/pd-standard"
     disk.initialize_params = init_params
     disk.auto_delete = True
     disk.boot = True
     return disk
 
-def _create_ts_network_interfaces() -> List[compute_v1.NetworkInterface]:
+def _create_ts_network_interfaces(zone: str = ZONE) -> List[compute_v1.NetworkInterface]:
     """ create a list of network interface descriptions """
     # create network interface & external access configs
     netiface = compute_v1.NetworkInterface()
     netiface.network = f"global/networks/support-tunnel-{ENV}"
-    netiface.subnetwork = f"regions/{REGION}/subnetworks/ts-{ENV}"
+    netiface.subnetwork = f"regions/{zone[0:-2]}/subnetworks/ts-{ENV}"
     access = compute_v1.AccessConfig()
     access.type_ = "ONE_TO_ONE_NAT"
     access.name = "External NAT"
@@ -73,38 +291,57 @@ def _ts_instance_metadata():
     """
     user_data_template = jinja2_env.get_template(
         "tunnel_server_user_data.sh.j2")
-    user_data = user_data_template.render()
+    user_data = user_data_template.render(ready_attribute=READY_ATTRIBUTE, packages=TS_PACKAGES,
+                                          nat_probe_port=NAT_PROBE_PORT, nat_probe_max_delay=WG_MAX_KEEPALIVE)
     return {
         "items": [
-            {"key": "startup-script", "value": user_data}
+            {"key": "startup-script", "value": user_data},
+            {"key": "enable-guest-attributes", "value": "TRUE"}
         ]
     }
 
-def create_ts_instance(tunnel_id: UUID4) -> compute_v1.Instance:
-    """ Handles creating a tunnel server. """
-    # TODO: set up automatic termination.. maybe? or something more sophisticated
-    # https://cloud.google.com/compute/docs/instances/limit-vm-runtime#gcloud_1
-
-    instance_client = compute_v1.InstancesClient()
-
-    logging.debug(f"creating ts instance for tunnel id {tunnel_id}")
+def _image_builder_metadata():
+    """ generate a GCP metadata blob for an image builder, whose startup script
+        installs TS_PACKAGES and powers off.
+    """
+    build_template = jinja2_env.get_template("tunnel_server_image_build.sh.j2")
+    return {
+        "items": [
+            {"key": "startup-script", "value": build_template.render(packages=TS_PACKAGES)}
+        ]
+    }
 
+def _ts_insert_request(name: str, labels: dict, zone: str = ZONE) -> compute_v1.InsertInstanceRequest:
+    """ create an insert request for a tunnel server instance """
     # create instance object
     i = compute_v1.Instance()
-    i.network_interfaces = _create_ts_network_interfaces()
-    i.name = f"{INSTANCE_NAME_PREFIX}-{tunnel_id}"
-    i.disks = [_create_ts_boot_disk()]
-    i.machine_type = f"zones/{ZONE}/machineTypes/{get_instance_size()}"
+    i.network_interfaces = _create_ts_network_interfaces(zone)
+    i.name = name
+    i.labels = labels
+    i.disks = [_create_ts_boot_disk(zone=zone)]
+    i.machine_type = f"zones/{zone}/machineTypes/{get_instance_size()}"
     i.metadata = _ts_instance_metadata()
     i.tags = compute_v1.types.Tags(items=["support-tunnel"]) # applies fw rule allowing 22 inbound
 
     # create the request
     req = compute_v1.InsertInstanceRequest()
-    req.zone = ZONE
-    req.project = PROJECT_ID
+    req.zone = zone
+    req.project = project_id()
     req.instance_resource = i
+    return req
+
+def create_ts_instance(tunnel_id: UUID4, zone: str = ZONE) -> compute_v1.Instance:
+    """ Handles creating a tunnel server. """
+    # TODO: set up automatic termination.. maybe? or something more sophisticated
+    # https://cloud.google.com/compute/docs/instances/limit-vm-runtime#gcloud_1
+
+    instance_client = instances_client()
+
+    logging.debug(f"creating ts instance for tunnel id {tunnel_id} in {zone}")
+    req = _ts_insert_request(f"{INSTANCE_NAME_PREFIX}-{tunnel_id}", {TUNNEL_ID_LABEL: str(tunnel_id)}, zone)
 
     # run it
+    invalidate_ts_instance(tunnel_id)
     try:
         operation = instance_client.insert(request=req)
         operation.result(timeout=120)
@@ -114,14 +351,271 @@ def create_ts_instance(tunnel_id: UUID4) -> compute_v1.Instance:
         logging.exception("failed to create a tunnel server instance!")
         raise e
 
-    return get_ts_instance(tunnel_id)
+    return get_ts_instance(tunnel_id, zone)
+
+def list_pool_instances(zone: Optional[str] = None) -> List[compute_v1.Instance]:
+    """ Lists unclaimed warm pool members, in one zone or all of them, oldest first. """
+    members = _list_instances(f'labels.{POOL_LABEL} = "true"')
+    unclaimed = [i for i in members
+                 if TUNNEL_ID_LABEL not in i.labels and zone in (None, instance_zone(i))]
+    return sorted(unclaimed, key=lambda i: i.creation_timestamp)
+
+def fill_pool(size: int = WARM_POOL_SIZE, zone: str = ZONE) -> int:
+    """ Launches warm pool members in a zone until `size` unclaimed ones exist there,
+        all at once. Returns the number launched.
+    """
+    instance_client = instances_client()
+    missing = size - len(list_pool_instances(zone))
+    operations = []
+    for _ in range(missing):
+        name = f"{POOL_NAME_PREFIX}-{token_hex(4)}"
+        logging.info(f"launching warm pool member {name} in {zone}")
+        labels = {POOL_LABEL: "true", IMAGE_LABEL: instance_image_name()}
+        operations.append(instance_client.insert(request=_ts_insert_request(name, labels, zone)))
+    for operation in operations:
+        try:
+            operation.result(timeout=120)
+        except Exception as e:
+            logging.warning(f"failed to launch a warm pool member: {str(e)}")
+    return max(missing, 0)
+
+def pool_retirement_reason(i: compute_v1.Instance, image: str) -> Optional[str]:
+    """ Returns why a warm pool member should be replaced, or None if it may stay. """
+    age = instance_age(i)
+    if age > POOL_MAX_AGE_HOURS * 3600:
+        return f"older than {POOL_MAX_AGE_HOURS:g} hours"
+    if i.labels.get(IMAGE_LABEL) != image:
+        return f"booted from {i.labels.get(IMAGE_LABEL) or 'an unknown image'}, not {image}"
+    if age > POOL_READY_TIMEOUT and not ts_startup_finished(i):
+        return f"not ready {POOL_READY_TIMEOUT:g}s after launch"
+    return None
+
+def retire_pool_instances(size: int = WARM_POOL_SIZE) -> List[compute_v1.Instance]:
+    """ Takes stale warm pool members out of the pool, and then the newest members of
+        any zone with more than `size` left, so they can be deleted. Returns them,
+        along with members retired earlier that still exist.
+
+        Retiring is a label update, so a member claimed in the meantime is left be.
+    """
+    image = instance_image_name()
+    retired = []
+    by_zone: Dict[str, List[compute_v1.Instance]] = defaultdict(list)
+    for i in list_pool_instances():
+        reason = pool_retirement_reason(i, image)
+        if reason:
+            retired.append((i, reason))
+        else:
+            by_zone[instance_zone(i)].append(i)
+    for zone, members in by_zone.items():
+        retired.extend((i, f"{zone} has more than {size} members") for i in members[size:])
+
+    for i, reason in retired:
+        logging.info(f"retiring warm pool member {i.name}: {reason}")
+    doomed = {i.name: i for i, _ in retired if _set_labels(i, {**i.labels, POOL_LABEL: "retired"})}
+    for i in _list_instances(f'labels.{POOL_LABEL} = "retired"'):
+        doomed.setdefault(i.name, i)
+    return list(doomed.values())
+
+def _set_labels(i: compute_v1.Instance, labels: dict) -> bool:
+    """ Replaces an instance's labels, as long as nobody else has changed them since
+        `i` was fetched; the label fingerprint makes this a compare-and-swap.
+        Returns whether the update went through.
+    """
+    instance_client = instances_client()
+    # labels decide which tunnels an instance serves, so any cached one may be stale now
+    invalidate_ts_instance()
+    try:
+        operation = instance_client.set_labels(
+            project=project_id(),
+            zone=instance_zone(i),
+            instance=i.name,
+            instances_set_labels_request_resource=compute_v1.InstancesSetLabelsRequest(
+                label_fingerprint=i.label_fingerprint, labels=labels)
+        )
+        operation.result(timeout=60)
+    except Exception as e:
+        logging.info(f"could not update labels on {i.name}: {str(e)}")
+        return False
+    return True
+
+def claim_pool_instance(tunnel_id: UUID4, zone: Optional[str] = None) -> Optional[compute_v1.Instance]:
+    """ Assigns a booted warm pool member in a zone to a tunnel. Returns None if there
+        are none.
+
+        If someone else claims the same member first, our label update is rejected and
+        we move on to the next one.
+    """
+    for i in list_pool_instances(zone):
+        if not ts_startup_finished(i):
+            continue  # still booting; a cold create may well be quicker
+        if _set_labels(i, {**i.labels, TUNNEL_ID_LABEL: str(tunnel_id)}):
+            return get_ts_instance(tunnel_id, instance_zone(i))
+    return None
+
+def hosted_tunnel_ids(i: compute_v1.Instance) -> List[str]:
+    """ Returns the ids of the tunnels a shared tunnel server hosts. """
+    return [k[len(HOSTED_LABEL_PREFIX):] for k in i.labels if k.startswith(HOSTED_LABEL_PREFIX)]
+
+def _network_label(network: IPv4Network) -> str:
+    """ Label values can't hold dots or slashes; 10.1.2.16/28 becomes 10-1-2-16_28. """
+    return str(network).replace(".", "-").replace("/", "_")
+
+def hosted_networks(i: compute_v1.Instance) -> List[IPv4Network]:
+    """ Returns the device networks of the tunnels a shared tunnel server hosts. """
+    return [IPv4Network(v.replace("_", "/").replace("-", "."))
+            for k, v in i.labels.items() if k.startswith(NETWORK_LABEL_PREFIX)]
+
+def list_shared_instances(zone: Optional[str] = None) -> List[compute_v1.Instance]:
+    """ Lists shared tunnel servers, in one zone or all of them. """
+    return [i for i in _list_instances(f'labels.{SHARED_LABEL} = "true"') if zone in (None, instance_zone(i))]
+
+def _can_host(i: compute_v1.Instance, network: IPv4Network, capacity: int) -> bool:
+    """ Whether a tunnel on `network` may be placed on a shared tunnel server. Empty
+        servers are being deleted, or about to be by `fab gc`, and each tunnel's
+        network gets routed to its own interface, so networks mustn't overlap.
+    """
+    hosted = len(hosted_tunnel_ids(i))
+    return (0 < hosted < capacity
+            and DRAINING_LABEL not in i.labels
+            and i.status not in ("STOPPING", "TERMINATED")
+            and not any(network.overlaps(n) for n in hosted_networks(i)))
+
+def place_shared_tunnel(tunnel_id: UUID4, network: IPv4Network, zone: str = ZONE, capacity: int = SHARED_TS_CAPACITY, attempts: int = 5) -> compute_v1.Instance:
+    """ Assigns a tunnel to a shared tunnel server in a zone, launching one if none
+        can take it.
+
+        Tunnels go to the fullest server with room to spare, so that tunnels pack onto
+        as few servers as possible and the rest empty out and get garbage collected.
+    """
+    labels = {f"{HOSTED_LABEL_PREFIX}{tunnel_id}": "true", f"{NETWORK_LABEL_PREFIX}{tunnel_id}": _network_label(network)}
+    for _ in range(attempts):
+        candidates = [i for i in list_shared_instances(zone) if _can_host(i, network, capacity)]
+        if not candidates:
+            break
+        i = max(candidates, key=lambda i: len(hosted_tunnel_ids(i)))
+        if _set_labels(i, {**i.labels, **labels}):
+            logging.debug(f"placed tunnel {tunnel_id} on {i.name} with {len(hosted_tunnel_ids(i))} others")
+            return get_ts_instance(tunnel_id, zone)
+        # someone else changed its labels first; look again
+
+    name = f"{SHARED_NAME_PREFIX}-{token_hex(4)}"
+    logging.debug(f"no shared tunnel server in {zone} can take {network}; launching {name}")
+    instance_client = instances_client()
+    invalidate_ts_instance(tunnel_id)
+    operation = instance_client.insert(request=_ts_insert_request(name, {SHARED_LABEL: "true", **labels}, zone))
+    operation.result(timeout=120)
+    if operation.error_code:
+        raise operation.exception() or RuntimeError(operation.error_message)
+    return get_ts_instance(tunnel_id, zone)
+
+def release_shared_tunnel(tunnel_id: UUID4, attempts: int = 5) -> int:
+    """ Removes a tunnel from its shared tunnel server's labels, deleting the server
+        once it hosts nothing. Returns the number of tunnels it still hosts.
+
+        The update that removes the last tunnel also marks the server as draining, so
+        no tunnel can be placed on it between that and its deletion.
+    """
+    mine = (f"{HOSTED_LABEL_PREFIX}{tunnel_id}", f"{NETWORK_LABEL_PREFIX}{tunnel_id}")
+    for _ in range(attempts):
+        i = get_ts_instance(tunnel_id)
+        labels = {k: v for k, v in i.labels.items() if k not in mine}
+        remaining = len(hosted_tunnel_ids(i)) - 1
+        if not remaining:
+            labels[DRAINING_LABEL] = "true"
+        if _set_labels(i, labels):
+            if not remaining:
+                logging.warning(f"shared tunnel server {i.name} is empty; deleting it")
+                instances_client().delete(project=project_id(), zone=instance_zone(i), instance=i.name).result()
+            return remaining
+    raise RuntimeError(f"could not release tunnel {tunnel_id} from its shared tunnel server")
+
+def instance_public_ip(i: compute_v1.Instance) -> IPv4Address:
+    """ Returns an instance's public IP. """
+    return IPv4Address(i.network_interfaces[0].access_configs[0].nat_i_p)
 
 def get_ts_instance_public_ip(tunnel_id: UUID4) -> IPv4Address:
     """ Using only the GCP API and our instance naming convention,
         determine a given tunnel_id's running server public IP.
     """
+    return instance_public_ip(get_ts_instance(tunnel_id))
+
+def ts_startup_finished(i: compute_v1.Instance) -> bool:
+    """ Whether the tunnel server's startup script has set its ready guest attribute. """
+    instance_client = instances_client()
+    try:
+        instance_client.get_guest_attributes(request={
+            "project": project_id(),
+            "zone": instance_zone(i),
+            "instance": i.name,
+            "variable_key": READY_ATTRIBUTE,
+        })
+        return True
+    except NotFound:
+        return False
+
+def ssh_answers(host: IPv4Address, port: int = 22, timeout: float = 5) -> bool:
+    """ Whether an SSH server at host:port is accepting connections and sends its banner. """
+    try:
+        with socket.create_connection((str(host), port), timeout=timeout) as s:
+            return s.recv(4).startswith(b"SSH-")
+    except OSError:
+        return False
+
+def wait_for_ts_ready(tunnel_id: UUID4, timeout: float = 600) -> float:
+    """ Polls, with backoff, until a tunnel server's startup script has finished and
+        SSH answers. Returns the number of seconds waited.
+    """
+    start = monotonic()
     i = get_ts_instance(tunnel_id)
-    return IPv4Address(i.network_interfaces[0].access_configs[0].nat_i_p)
+    host = instance_public_ip(i)
+    delay = 1.0
+    while not (ts_startup_finished(i) and ssh_answers(host)):
+        if monotonic() - start > timeout:
+            raise TimeoutError(f"tunnel server for {tunnel_id} not ready after {timeout}s")
+        sleep(delay)
+        delay = min(delay * 1.5, 10)
+    return monotonic() - start
+
+def build_ts_image() -> str:
+    """ Builds a new tunnel server image with TS_PACKAGES preinstalled, and adds it to
+        TS_IMAGE_FAMILY. This boots a temporary builder instance from stock Debian,
+        waits for its startup script to install everything and power off, and images
+        its disk. Returns the new image's name.
+    """
+    instance_client = instances_client()
+    image_client = images_client()
+    version = datetime.now().strftime("%Y%m%d%H%M%S")
+    builder_name = f"{IMAGE_BUILDER_NAME_PREFIX}-{version}"
+    image_name = f"{TS_IMAGE_FAMILY}-{version}"
+
+    i = compute_v1.Instance()
+    i.network_interfaces = _create_ts_network_interfaces()
+    i.name = builder_name
+    i.disks = [_create_ts_boot_disk(get_base_image())]
+    i.machine_type = f"zones/{ZONE}/machineTypes/{get_instance_size()}"
+    i.metadata = _image_builder_metadata()
+
+    logging.info(f"launching image builder {builder_name}")
+    operation = instance_client.insert(project=project_id(), zone=ZONE, instance_resource=i)
+    operation.result(timeout=120)
+
+    try:
+        # the build script powers the builder off once it's done
+        start = monotonic()
+        while instance_client.get(project=project_id(), zone=ZONE, instance=builder_name).status != "TERMINATED":
+            if monotonic() - start > 1200:
+                raise TimeoutError(f"image builder {builder_name} did not finish within 20 minutes")
+            sleep(10)
+
+        source_disk = instance_client.get(project=project_id(), zone=ZONE, instance=builder_name).disks[0].source
+        image = compute_v1.Image(name=image_name, family=TS_IMAGE_FAMILY, source_disk=source_disk)
+        logging.info(f"creating image {image_name} in family {TS_IMAGE_FAMILY}")
+        image_client.insert(project=project_id(), image_resource=image).result(timeout=600)
+    finally:
+        instance_client.delete(project=project_id(), zone=ZONE, instance=builder_name).result()
+
+    get_instance_image.cache_clear()
+    return image_name
 
 def destroy_ts_resources(tunnel_id: UUID4):
     """ Given a tunnel id, destroy its associated cloud resources.
@@ -129,13 +623,47 @@ def destroy_ts_resources(tunnel_id: UUID4):
         Right now, that's just an instance.
     """
     logging.warning(f"destroying resources associated with tunnel id {tunnel_id}")
-    compute_client = compute_v1.InstancesClient()
+    compute_client = instances_client()
     try:
+        i = get_ts_instance(tunnel_id)
+        if SHARED_LABEL in i.labels:
+            # other tunnels live there too; only give up our spot
+            release_shared_tunnel(tunnel_id)
+            return
+        invalidate_ts_instance(tunnel_id)
         operation = compute_client.delete(
-            project=PROJECT_ID,
-            zone=ZONE,
-            instance=f"{INSTANCE_NAME_PREFIX}-{tunnel_id}"
+            project=project_id(),
+            zone=instance_zone(i),
+            instance=i.name
         )
         operation.result() # TODO: handle errors better here
     except Exception as e:
         logging.warning(f"failed to delete cloud instance for tunnel id {tunnel_id}: {str(e)}")
+
+def delete_instances(instances: List[compute_v1.Instance], parallelism: int = 8, timeout: float = 300) -> Dict[str, Optional[str]]:
+    """ Deletes many instances at once. Up to `parallelism` delete requests are sent
+        concurrently, then the resulting operations are waited on together, so the
+        whole thing takes about as long as the slowest deletion.
+
+        Returns each instance's error message by name, or None if it was deleted.
+    """
+    compute_client = instances_client()
+    results: Dict[str, Optional[str]] = {}
+
+    def start(i: compute_v1.Instance):
+        logging.warning(f"deleting instance {i.name}")
+        return compute_client.delete(project=project_id(), zone=instance_zone(i), instance=i.name)
+
+    with ThreadPoolExecutor(max_workers=parallelism) as pool:
+        started = {i.name: pool.submit(start, i) for i in instances}
+    invalidate_ts_instance()
+
+    deadline = monotonic() + timeout
+    for name, future in started.items():
+        try:
+            future.result().result(timeout=max(deadline - monotonic(), 1))
+            results[name] = None
+        except Exception as e:
+            logging.warning(f"failed to delete instance {name}: {str(e)}")
+            results[name] = str(e)
+    return results
@@ -0,0 +1,57 @@
+""" An on-disk cache of the admin API token, so that each `fab` run doesn't pay for
+    a Secret Manager round trip (and the Google client imports that come with it).
+
+    The token is kept next to the SSH session cache, readable only by us, for
+    ADMIN_TOKEN_TTL seconds. A cache that is stale, names a different secret, or
+    whose permissions have been loosened is ignored. If the API rejects a cached
+    token, because it was rotated or revoked, callers forget it and fetch it afresh.
+"""
+import json
+import stat
+import logging
+
+from os import getenv, getuid
+from time import time
+from typing import Optional
+
+from admin.ssh_session import SESSION_DIR
+
+ADMIN_TOKEN_TTL = int(getenv("ADMIN_TOKEN_TTL", 8 * 3600))  # 0 disables the cache
+TOKEN_CACHE = SESSION_DIR / "admin_token.json"
+
+
+def load_token(name: str) -> Optional[str]:
+    """ Returns the cached token for secret `name`, if we have a fresh one. """
+    if not ADMIN_TOKEN_TTL:
+        return None
+    try:
+        st = TOKEN_CACHE.stat()
+        if st.st_uid != getuid() or stat.S_IMODE(st.st_mode) & 0o077:
+            logging.warning(f"ignoring {TOKEN_CACHE}, as others can read or own it")
+            return None
+        cached = json.loads(TOKEN_CACHE.read_text())
+    except (OSError, ValueError):
+        return None
+    if cached.get('name') != name or time() - cached.get('fetched_at', 0) > ADMIN_TOKEN_TTL:
+        return None
+    return cached.get('token')
+
+
+def save_token(name: str, token: str):
+    """ Caches the token for secret `name`, readable only by us. """
+    if not ADMIN_TOKEN_TTL:
+        return
+    SESSION_DIR.mkdir(parents=True, exist_ok=True)
+    SESSION_DIR.chmod(0o700)
+    TOKEN_CACHE.touch(mode=0o600)
+    TOKEN_CACHE.chmod(0o600)
+    TOKEN_CACHE.write_text(json.dumps({'name': name, 'token': token, 'fetched_at': time()}))
+
+
+def forget_token() -> None:
+    """ Drops the cached token. """
+    # unlink(missing_ok=True) needs Python 3.8, and admin still runs on 3.7
+    try:
+        TOKEN_CACHE.unlink()
+    except FileNotFoundError:
+        pass
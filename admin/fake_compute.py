@@ -0,0 +1,187 @@
+""" In-memory stand-ins for compute_v1.InstancesClient and ImagesClient.
+
+    Set FAKE_COMPUTE to any value and admin.cloud uses this instead of GCP, which
+    makes placement and lifecycle code exercisable without a project or credentials:
+
+        FAKE_COMPUTE=1 PROJECT_ID=fake python3 -c 'from admin.cloud import *; ...'
+
+    Only the calls admin.cloud makes are implemented, and only the subset of the
+    list filter syntax it uses: `field = "value"` terms joined by OR, where field is
+    `name` or `labels.<key>`.
+
+    For benchmarks, calls can be made to take time and operations to fail.
+    FAKE_COMPUTE_LATENCY gives the mean seconds per method, like
+    `insert=40,delete=30,get=0.1`; each call takes 50-150% of it. Inserts and
+    deletes return at once, and their operations finish after that time, as GCP's
+    do. FAKE_COMPUTE_FAILURE_RATE is the chance that an insert or delete operation
+    fails.
+"""
+import re
+import random
+
+from os import getenv
+from time import sleep, monotonic
+from secrets import token_hex
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from google.cloud import compute_v1
+from google.api_core.exceptions import NotFound, PreconditionFailed, ServiceUnavailable
+
+FILTER_TERM = re.compile(r'\(?\s*([\w.-]+)\s*=\s*"([^"]*)"\s*\)?')
+FAKE_COMPUTE_LATENCY = getenv("FAKE_COMPUTE_LATENCY", "")
+FAKE_COMPUTE_FAILURE_RATE = float(getenv("FAKE_COMPUTE_FAILURE_RATE", 0))
+
+
+def parse_latency(spec: str) -> Dict[str, float]:
+    """ Parses `method=seconds` pairs, comma separated. """
+    pairs = [pair.split("=") for pair in spec.split(",") if pair.strip()]
+    return {method.strip(): float(seconds) for method, seconds in pairs}
+
+
+class FakeOperation:
+    """ A zonal operation, which finishes at `done_at` and fails if given an error. """
+    def __init__(self, done_at: float = 0, error: Optional[Exception] = None):
+        self.done_at = done_at
+        self.error = error
+
+    @property
+    def error_code(self) -> int:
+        return self.error.code if self.error else 0  # type: ignore[attr-defined]
+
+    @property
+    def error_message(self) -> str:
+        return str(self.error or "")
+
+    def result(self, timeout: Optional[float] = None):
+        wait = self.done_at - monotonic()
+        if timeout is not None and wait > timeout:
+            sleep(timeout)
+            raise TimeoutError("operation did not finish in time")
+        sleep(max(wait, 0))
+        if self.error:
+            raise self.error
+        return None
+
+    def exception(self, timeout: Optional[float] = None):
+        return self.error
+
+
+def _matches(i: compute_v1.Instance, filter: str) -> bool:
+    if not filter:
+        return True
+    for field, value in FILTER_TERM.findall(filter):
+        if field == "name" and i.name == value:
+            return True
+        if field.startswith("labels.") and i.labels.get(field[len("labels."):]) == value:
+            return True
+    return False
+
+
+class FakeInstancesClient:
+    """ Keeps instances in a dict keyed by (zone, name). Instances come up RUNNING,
+        with a public IP, and are ready as soon as their insert operation is done.
+    """
+    def __init__(self, latency: Optional[Dict[str, float]] = None, failure_rate: float = FAKE_COMPUTE_FAILURE_RATE):
+        self.instances: Dict[Tuple[str, str], compute_v1.Instance] = {}
+        self.lock = Lock()
+        self.latency = parse_latency(FAKE_COMPUTE_LATENCY) if latency is None else latency
+        self.failure_rate = failure_rate
+
+    def _delay(self, method: str) -> float:
+        return self.latency.get(method, 0) * random.uniform(0.5, 1.5)
+
+    def _wait(self, method: str):
+        delay = self._delay(method)
+        if delay:
+            sleep(delay)
+
+    def _operation(self, method: str) -> FakeOperation:
+        """ An operation for `method`, which may be failed. Its effect is applied at
+            once, unless it failed, but it only completes after `method`'s latency.
+        """
+        error = None
+        if random.random() < self.failure_rate:
+            error = ServiceUnavailable(f"simulated {method} failure")
+        return FakeOperation(monotonic() + self._delay(method), error)
+
+    def get(self, project: str, zone: str, instance: str) -> compute_v1.Instance:
+        self._wait("get")
+        with self.lock:
+            if (zone, instance) not in self.instances:
+                raise NotFound(f"instance {zone}/{instance} not found")
+            return compute_v1.Instance(self.instances[(zone, instance)])
+
+    def list(self, project: Optional[str] = None, zone: Optional[str] = None, request=None):
+        zone = request.zone if request else zone
+        filter = request.filter if request else ""
+        self._wait("list")
+        with self.lock:
+            return [compute_v1.Instance(i) for (z, _), i in self.instances.items() if z == zone and _matches(i, filter)]
+
+    def aggregated_list(self, request: compute_v1.AggregatedListInstancesRequest):
+        scoped: Dict[str, compute_v1.InstancesScopedList] = {}
+        self._wait("aggregated_list")
+        with self.lock:
+            for (zone, _), i in self.instances.items():
+                if _matches(i, request.filter):
+                    scoped.setdefault(f"zones/{zone}", compute_v1.InstancesScopedList()).instances.append(compute_v1.Instance(i))
+        return scoped.items()
+
+    def insert(self, request: Optional[compute_v1.InsertInstanceRequest] = None, project: Optional[str] = None,
+               zone: Optional[str] = None, instance_resource: Optional[compute_v1.Instance] = None) -> FakeOperation:
+        if request:
+            project, zone, instance_resource = request.project, request.zone, request.instance_resource
+        assert zone and instance_resource
+        i = compute_v1.Instance(instance_resource)
+        i.id = random.getrandbits(63)
+        i.zone = f"https://www.googleapis.com/compute/v1/projects/{project}/zones/{zone}"
+        i.status = "RUNNING"
+        i.creation_timestamp = datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+        i.label_fingerprint = token_hex(8)
+        if i.network_interfaces and i.network_interfaces[0].access_configs:
+            # TEST-NET-3; never routable
+            i.network_interfaces[0].access_configs[0].nat_i_p = f"203.0.113.{random.randint(1, 254)}"
+        operation = self._operation("insert")
+        if not operation.error:
+            with self.lock:
+                self.instances[(zone, i.name)] = i
+        return operation
+
+    def delete(self, project: str, zone: str, instance: str) -> FakeOperation:
+        operation = self._operation("delete")
+        with self.lock:
+            if (zone, instance) not in self.instances:
+                raise NotFound(f"instance {zone}/{instance} not found")
+            if not operation.error:
+                del self.instances[(zone, instance)]
+        return operation
+
+    def set_labels(self, project: str, zone: str, instance: str,
+                   instances_set_labels_request_resource: compute_v1.InstancesSetLabelsRequest) -> FakeOperation:
+        req = instances_set_labels_request_resource
+        self._wait("set_labels")
+        with self.lock:
+            i = self.instances[(zone, instance)]
+            if req.label_fingerprint != i.label_fingerprint:
+                raise PreconditionFailed(f"labels of {zone}/{instance} have changed")
+            i.labels.clear()
+            i.labels.update(req.labels)
+            i.label_fingerprint = token_hex(8)
+        return FakeOperation()
+
+    def add_instances(self, instances: Dict[Tuple[str, str], compute_v1.Instance]):
+        """ Adds instances straight away, for seeding benchmarks. """
+        with self.lock:
+            self.instances.update(instances)
+
+    def get_guest_attributes(self, request: dict) -> compute_v1.GuestAttributes:
+        self.get(request["project"], request["zone"], request["instance"])
+        return compute_v1.GuestAttributes(variable_key=request["variable_key"], variable_value="ready")
+
+
+class FakeImagesClient:
+    """ Every image family has exactly one image in it. """
+    def get_from_family(self, project: str, family: str) -> compute_v1.Image:
+        return compute_v1.Image(name=f"{family}-fake", family=family)
@@ -0,0 +1,79 @@
+""" A local SQLite mirror of the API's tunnel table, so that `fab list` and `fab show`
+    can browse a long tunnel history without fetching all of it every time.
+
+    The mirror is brought up to date incrementally from the API's
+    /admin/tunnel/changes endpoint, which returns the tunnels changed since a
+    cursor; the cursor is kept in the mirror alongside the tunnels. Each sync reads
+    again from a little behind the cursor, in case of slow commits, and the rows it
+    gets twice replace themselves by tunnel_id. Each tunnel is
+    stored whole, as the JSON the API returned, so new API fields show up here
+    without a schema change.
+"""
+import json
+import sqlite3
+
+from typing import Any, Iterable, List, Optional
+
+from admin.ssh_session import SESSION_DIR
+
+MIRROR_DB = SESSION_DIR / "tunnels.db"
+
+
+def connect_mirror() -> sqlite3.Connection:
+    """ Opens the mirror, creating it if need be. """
+    SESSION_DIR.mkdir(parents=True, exist_ok=True)
+    SESSION_DIR.chmod(0o700)
+    conn = sqlite3.connect(MIRROR_DB)
+    conn.execute("CREATE TABLE IF NOT EXISTS tunnels (tunnel_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+
+def get_cursor(conn: sqlite3.Connection) -> Optional[str]:
+    row = conn.execute("SELECT value FROM meta WHERE key = 'cursor'").fetchone()
+    return row[0] if row else None
+
+
+def apply_changes(conn: sqlite3.Connection, tunnels: Iterable[dict], cursor: Optional[str]):
+    """ Stores changed tunnels and the cursor that follows them, atomically. """
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO tunnels (tunnel_id, data) VALUES (?, ?)",
+                         [(t['tunnel_id'], json.dumps(t)) for t in tunnels])
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('cursor', ?)", (cursor,))
+
+
+def reset_mirror(conn: sqlite3.Connection):
+    """ Forgets everything, so that the next sync starts from scratch. """
+    with conn:
+        conn.execute("DELETE FROM tunnels")
+        conn.execute("DELETE FROM meta")
+
+
+def get_mirrored_tunnel(conn: sqlite3.Connection, tunnel_id) -> Optional[dict]:
+    row = conn.execute("SELECT data FROM tunnels WHERE tunnel_id = ?", (str(tunnel_id),)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def query_tunnels(conn: sqlite3.Connection, state: Optional[int] = None, filters: Optional[dict] = None,
+                  sort: str = "created_at", reverse: bool = False, limit: Optional[int] = None) -> List[dict]:
+    """ Returns mirrored tunnels in `state`, whose fields contain the text of every
+        field: text pair in `filters` (case insensitively), sorted by the field `sort`.
+    """
+    for field in (sort, *(filters or {})):
+        if not field.isidentifier():
+            raise ValueError(f"not a tunnel field: {field}")
+    where: List[str] = ["1"]
+    params: List[Any] = []
+    if state is not None:
+        where.append("json_extract(data, '$.state') = ?")
+        params.append(state)
+    for field, text in (filters or {}).items():
+        where.append("lower(coalesce(json_extract(data, ?), '')) LIKE ?")
+        params += [f"$.{field}", f"%{text.lower()}%"]
+    q = (f"SELECT data FROM tunnels WHERE {' AND '.join(where)} "
+         f"ORDER BY json_extract(data, ?) {'DESC' if reverse else 'ASC'}, tunnel_id")
+    params.append(f"$.{sort}")
+    if limit:
+        q += " LIMIT ?"
+        params.append(limit)
+    return [json.loads(data) for data, in conn.execute(q, params)]
@@ -0,0 +1,97 @@
+""" The operations the admin CLI needs from a cloud, so that tunnel server lifecycles
+    can be driven, benchmarked and tested without caring which cloud is underneath.
+
+    Instances are handed around as the provider's own objects; callers only rely on
+    them having a `name` and `id`, and ask the provider anything else, such as
+    which tunnels an instance serves. GCP is the one real provider. For offline
+    runs, set FAKE_COMPUTE, and the GCP provider runs against admin.fake_compute
+    instead, with latencies and failure rates as configured there.
+"""
+from functools import lru_cache
+from ipaddress import IPv4Address
+from typing import Any, Dict, List, Optional
+
+from pydantic import UUID4
+from typing_extensions import Protocol
+
+
+class CloudProvider(Protocol):
+    def create(self, tunnel_id: UUID4, zone: Optional[str] = None) -> Any:
+        """ Launches a tunnel server for a tunnel, and returns it once launched. """
+
+    def get(self, tunnel_id: UUID4, zone: Optional[str] = None) -> Any:
+        """ Returns a tunnel's server, or raises if it has none. A zone, if known,
+            speeds the search up.
+        """
+
+    def list(self) -> List[Any]:
+        """ Returns every tunnel server. """
+
+    def destroy(self, instances: List[Any], parallelism: int = 8) -> Dict[str, Optional[str]]:
+        """ Deletes tunnel servers, returning each one's error message by name, or None if it went. """
+
+    def public_ip(self, instance: Any) -> IPv4Address:
+        """ Returns a tunnel server's public IP. """
+
+    def tunnel_id(self, instance: Any) -> Optional[str]:
+        """ Returns the tunnel a dedicated tunnel server belongs to, or None for an
+            unclaimed warm pool member or a shared tunnel server.
+        """
+
+    def hosted_tunnel_ids(self, instance: Any) -> Optional[List[str]]:
+        """ Returns the tunnels a shared tunnel server hosts, or None if it isn't shared. """
+
+    def release_shared(self, tunnel_id: UUID4) -> int:
+        """ Gives up a tunnel's place on its shared tunnel server, deleting the server
+            once it hosts nothing. Returns the number of tunnels still there.
+        """
+
+    def retire_pool(self, size: Optional[int] = None) -> List[Any]:
+        """ Takes surplus and stale warm pool members out of the pool, keeping `size`
+            per zone (by default the configured size). Returns the ones to destroy.
+        """
+
+
+class GcpProvider:
+    """ Tunnel servers as Compute Engine instances; see admin.cloud. """
+    def create(self, tunnel_id: UUID4, zone: Optional[str] = None) -> Any:
+        from admin.cloud import create_ts_instance, ZONE
+        return create_ts_instance(tunnel_id, zone or ZONE)
+
+    def get(self, tunnel_id: UUID4, zone: Optional[str] = None) -> Any:
+        from admin.cloud import get_ts_instance
+        return get_ts_instance(tunnel_id, zone)
+
+    def list(self) -> List[Any]:
+        from admin.cloud import list_ts_instances
+        return list_ts_instances()
+
+    def destroy(self, instances: List[Any], parallelism: int = 8) -> Dict[str, Optional[str]]:
+        from admin.cloud import delete_instances
+        return delete_instances(instances, parallelism=parallelism)
+
+    def public_ip(self, instance: Any) -> IPv4Address:
+        from admin.cloud import instance_public_ip
+        return instance_public_ip(instance)
+
+    def tunnel_id(self, instance: Any) -> Optional[str]:
+        from admin.cloud import ts_tunnel_id
+        return ts_tunnel_id(instance)
+
+    def hosted_tunnel_ids(self, instance: Any) -> Optional[List[str]]:
+        from admin.cloud import hosted_tunnel_ids, SHARED_LABEL
+        return hosted_tunnel_ids(instance) if SHARED_LABEL in instance.labels else None
+
+    def release_shared(self, tunnel_id: UUID4) -> int:
+        from admin.cloud import release_shared_tunnel
+        return release_shared_tunnel(tunnel_id)
+
+    def retire_pool(self, size: Optional[int] = None) -> List[Any]:
+        from admin.cloud import retire_pool_instances, WARM_POOL_SIZE
+        return retire_pool_instances(WARM_POOL_SIZE if size is None else size)
+
+
+@lru_cache(1)
+def cloud_provider() -> CloudProvider:
+    """ The provider for this process. """
+    return GcpProvider()
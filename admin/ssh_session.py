@@ -0,0 +1,191 @@
+""" A local cache of SSH sessions to devices, so that repeated `fab connect` and
+    `fab command` calls against a tunnel skip the slow setup: gcloud, the API, 2FA
+    on the tunnel server, and fetching the device key.
+
+    Each cached tunnel has a private directory holding what is needed to reach the
+    device, and OpenSSH control sockets for the tunnel server and device
+    connections in SOCKET_DIR. The sockets are multiplexed masters that linger for
+    SSH_SESSION_IDLE seconds after their last use, so a command run while they are
+    up only costs a round trip. After that, the cached details are forgotten as well.
+"""
+import json
+import shlex
+import shutil
+import logging
+import subprocess
+
+from os import getenv
+from uuid import UUID
+from pathlib import Path
+from threading import Thread
+from time import time, monotonic
+from typing import IO, Callable, List, NamedTuple, Optional, Tuple
+
+SESSION_DIR = Path(getenv("SUPPORT_TUNNEL_SESSION_DIR", Path.home() / ".cache" / "support_tunnel"))
+# Unix socket paths are limited to 104 bytes on macOS, and OpenSSH adds 17 more
+# while setting a master up, so control sockets get short names in a short path
+SOCKET_DIR = Path(getenv("SUPPORT_TUNNEL_SOCKET_DIR", Path.home() / ".ssh" / "st"))
+SSH_SESSION_IDLE = int(getenv("SSH_SESSION_IDLE", 600))
+# written by `gcloud compute config-ssh`, and registered with OS Login
+GCLOUD_SSH_KEY = Path.home() / ".ssh" / "google_compute_engine"
+
+
+class DeviceSession(NamedTuple):
+    """ Everything needed to reach a device through its tunnel server. """
+    tunnel_id: str
+    ts_host: str
+    ts_user: str
+    device_host: str
+    device_user: str
+
+
+def session_dir(tunnel_id) -> Path:
+    return SESSION_DIR / str(tunnel_id)
+
+
+def control_path(tunnel_id, hop: str) -> Path:
+    """ The control socket for a tunnel's `ts` or `device` connection. """
+    return SOCKET_DIR / f"{UUID(str(tunnel_id)).hex[:12]}-{hop}"
+
+
+def device_keyfile(tunnel_id) -> Path:
+    return session_dir(tunnel_id) / "device_key"
+
+
+def save_session(session: DeviceSession, device_private_key: str):
+    """ Caches a session's details and the device's private key, readable only by us. """
+    d = session_dir(session.tunnel_id)
+    d.mkdir(parents=True, exist_ok=True)
+    d.chmod(0o700)
+    keyfile = device_keyfile(session.tunnel_id)
+    keyfile.touch(mode=0o600)
+    keyfile.write_text(device_private_key)
+    (d / "session.json").write_text(json.dumps(session._asdict()))
+    SOCKET_DIR.mkdir(parents=True, exist_ok=True)
+    SOCKET_DIR.chmod(0o700)
+
+
+def load_session(tunnel_id) -> Optional[DeviceSession]:
+    """ Returns the cached session for a tunnel, unless it has sat idle for longer
+        than SSH_SESSION_IDLE, in which case it is closed and forgotten.
+    """
+    details = session_dir(tunnel_id) / "session.json"
+    try:
+        idle = time() - details.stat().st_mtime
+        session = DeviceSession(**json.loads(details.read_text()))
+    except (OSError, ValueError, TypeError):
+        return None
+    if idle > SSH_SESSION_IDLE:
+        logging.debug(f"session for tunnel {tunnel_id} idle for {idle:.0f}s; closing it")
+        close_session(tunnel_id)
+        return None
+    details.touch()
+    return session
+
+
+def direct_interface(tunnel_id) -> str:
+    """ The local WireGuard interface joining this workstation to a tunnel, when it
+        was created with `fab create --direct`. Interface names are limited to 15 characters.
+    """
+    return f"st-{UUID(str(tunnel_id)).hex[:12]}"
+
+
+def direct_config(tunnel_id) -> Path:
+    """ The wg-quick config for a tunnel's direct interface. It is kept outside the
+        session directory, as it outlives sessions.
+    """
+    return SESSION_DIR / "wireguard" / f"{direct_interface(tunnel_id)}.conf"
+
+
+def _ts_options(session: DeviceSession) -> List[str]:
+    d = session_dir(session.tunnel_id)
+    return [
+        "-o", "ControlMaster=auto",
+        "-o", f"ControlPath={control_path(session.tunnel_id, 'ts')}",
+        "-o", f"ControlPersist={SSH_SESSION_IDLE}",
+        "-o", f"IdentityFile={GCLOUD_SSH_KEY}",
+        "-o", "StrictHostKeyChecking=accept-new",
+        "-o", f"UserKnownHostsFile={d / 'known_hosts'}",
+        "-l", session.ts_user,
+    ]
+
+
+def ssh_args(session: DeviceSession, command: Optional[str] = None, pty: bool = False, extra: Optional[List[str]] = None,
+             multiplex: bool = True) -> List[str]:
+    """ Builds an `ssh` invocation that reaches the device through the tunnel server,
+        or straight over WireGuard for tunnels created with `--direct`, over the
+        control sockets if they are up and establishing them if not. With
+        `multiplex` off, the device connection is a separate one of its own; the
+        tunnel server hop is still shared.
+    """
+    d = session_dir(session.tunnel_id)
+    if direct_config(session.tunnel_id).exists():
+        # this workstation is a peer in the tunnel, so the device is one hop away
+        proxy = []
+    else:
+        # reach the device by forwarding through the tunnel server's master connection
+        # shlex.join() needs Python 3.8, and admin still runs on 3.7
+        ts_hop = ["ssh", *_ts_options(session), "-W", "%h:%p", session.ts_host]
+        proxy = ["-o", "ProxyCommand=" + " ".join(shlex.quote(a) for a in ts_hop)]
+    control = [
+        "-o", "ControlMaster=auto",
+        "-o", f"ControlPath={control_path(session.tunnel_id, 'device')}",
+        "-o", f"ControlPersist={SSH_SESSION_IDLE}",
+    ] if multiplex else ["-o", "ControlPath=none"]
+    args = [
+        "ssh",
+        *control,
+        *proxy,
+        "-o", f"IdentityFile={device_keyfile(session.tunnel_id)}",
+        "-o", "IdentitiesOnly=yes",
+        # tunnel networks are reused, so each tunnel gets its own known hosts
+        "-o", "StrictHostKeyChecking=accept-new",
+        "-o", f"UserKnownHostsFile={d / 'known_hosts'}",
+        "-l", session.device_user,
+        "-t" if pty else "-T",
+        *(extra or []),
+        session.device_host,
+    ]
+    if command:
+        args.append(command)
+    return args
+
+
+def close_session(tunnel_id):
+    """ Shuts down a tunnel's control sockets and forgets its cached details and key. """
+    for hop in ("device", "ts"):
+        sock = control_path(tunnel_id, hop)
+        if sock.exists():
+            # `-O exit` needs a destination, but only the socket matters
+            subprocess.run(["ssh", "-o", f"ControlPath={sock}", "-O", "exit", "_"], capture_output=True)
+    shutil.rmtree(session_dir(tunnel_id), ignore_errors=True)
+
+
+def run_remote(session: DeviceSession, command: str, timeout: float, on_line: Callable[[str, str], None]) -> Tuple[Optional[int], float]:
+    """ Runs a command on a device without prompting for anything, passing each line
+        of output to `on_line(stream, line)` as it arrives. Returns the exit code,
+        or None if the command was killed after `timeout` seconds, and the duration.
+    """
+    start = monotonic()
+    proc = subprocess.Popen(
+        ssh_args(session, command, extra=["-o", "BatchMode=yes"]),
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors="replace",
+    )
+
+    def pump(stream: str, pipe: IO[str]):
+        for line in pipe:
+            on_line(stream, line.rstrip("\n"))
+
+    readers = [Thread(target=pump, args=(name, pipe), daemon=True)
+               for name, pipe in (("stdout", proc.stdout), ("stderr", proc.stderr))]
+    for r in readers:
+        r.start()
+    try:
+        rc: Optional[int] = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        rc = None
+    for r in readers:
+        r.join(timeout=1)
+    return rc, monotonic() - start
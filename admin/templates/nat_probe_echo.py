@@ -0,0 +1,39 @@
+""" Echoes each UDP datagram back to its sender after the delay it asks for, so that
+    devices can measure how long their NAT keeps an idle UDP binding open; see
+    common.tunnel.probe_nat_binding_lifetime(). Replies are never larger than
+    requests, and only so many may be pending at once.
+"""
+import sys
+import socket
+import threading
+
+MAGIC = b"st-nat-probe"
+MAX_PENDING = 4096
+
+port, max_delay = int(sys.argv[1]), int(sys.argv[2])
+sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+sock.bind(("0.0.0.0", port))
+pending = threading.BoundedSemaphore(MAX_PENDING)
+
+
+def reply(data, addr):
+    try:
+        sock.sendto(data, addr)
+    except OSError:
+        pass
+    finally:
+        pending.release()
+
+
+while True:
+    data, addr = sock.recvfrom(64)
+    try:
+        magic, delay, _ = data.split(b" ", 2)
+        seconds = int(delay)
+    except ValueError:
+        continue
+    if magic != MAGIC or not 0 <= seconds <= max_delay or not pending.acquire(blocking=False):
+        continue
+    timer = threading.Timer(seconds, reply, (data, addr))
+    timer.daemon = True
+    timer.start()
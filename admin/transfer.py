@@ -0,0 +1,178 @@
+""" Streaming file transfer to and from devices, over the same cached SSH session
+    as `fab connect`.
+
+    Files move in chunks and are gzipped on the wire, so nothing is held in memory
+    whole. A transfer that breaks off can be resumed: downloads carry on from the
+    size of the partial local file, and uploads from the size of the partial remote one.
+    Either way, the partial copy is only kept if its SHA-256 matches that of the same
+    bytes of the source; otherwise the transfer starts over.
+"""
+import sys
+import zlib
+import shlex
+import hashlib
+import subprocess
+
+from pathlib import Path
+from typing import NamedTuple
+from time import monotonic
+
+from admin.ssh_session import DeviceSession, ssh_args
+
+CHUNK_SIZE = 256 * 1024
+# gzip level 1: most of the savings on logs, at a fraction of the CPU of the default
+COMPRESSION_LEVEL = 1
+
+
+class TransferStats(NamedTuple):
+    offset: int  # bytes already there, skipped by resuming
+    transferred: int  # file bytes moved this time
+    wire: int  # compressed bytes moved this time
+    seconds: float
+
+    def __str__(self) -> str:
+        rate = self.transferred / self.seconds / 1e6 if self.seconds else 0
+        ratio = self.transferred / self.wire if self.wire else 1
+        resumed = f", resumed at {self.offset} bytes" if self.offset else ""
+        return (f"{self.transferred} bytes in {self.seconds:.1f}s ({rate:.2f} MB/s, "
+                f"{ratio:.1f}x compression{resumed})")
+
+
+class _Progress:
+    """ Prints a running byte count and rate to stderr, at most once a second. """
+    def __init__(self, total: int):
+        self.total = total
+        self.start = self.last = monotonic()
+
+    def update(self, done: int):
+        now = monotonic()
+        if now - self.last >= 1:
+            self.last = now
+            rate = done / (now - self.start) / 1e6
+            print(f"\r{done}/{self.total or '?'} bytes, {rate:.2f} MB/s", end="", file=sys.stderr, flush=True)
+
+    def finish(self):
+        print(file=sys.stderr)
+
+
+def _remote(session: DeviceSession, command: str, **kwargs) -> subprocess.Popen:
+    return subprocess.Popen(ssh_args(session, command), **kwargs)
+
+
+def remote_size(session: DeviceSession, path: str) -> int:
+    """ The size of a file on the device, or 0 if it does not exist. """
+    res = subprocess.run(ssh_args(session, f"sudo stat -c %s {shlex.quote(path)} 2>/dev/null || echo 0"),
+                         capture_output=True, text=True, check=True)
+    return int(res.stdout.strip() or 0)
+
+
+def remote_prefix_sha256(session: DeviceSession, path: str, size: int) -> str:
+    """ The SHA-256 of the first `size` bytes of a file on the device, as hex. """
+    res = subprocess.run(ssh_args(session, f"sudo head -c {size} {shlex.quote(path)} | sha256sum"),
+                         capture_output=True, text=True, check=True)
+    return res.stdout.split()[0]
+
+
+def local_prefix_sha256(path: Path, size: int) -> str:
+    """ The SHA-256 of the first `size` bytes of a local file, as hex. """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while size > 0:
+            data = f.read(min(CHUNK_SIZE, size))
+            if not data:
+                break
+            digest.update(data)
+            size -= len(data)
+    return digest.hexdigest()
+
+
+def _prefix_matches(session: DeviceSession, remote_path: str, local_path: Path, offset: int) -> bool:
+    """ Whether the first `offset` bytes are the same on both ends, so a transfer may
+        resume from there.
+    """
+    if local_prefix_sha256(local_path, offset) == remote_prefix_sha256(session, remote_path, offset):
+        return True
+    print(f"the first {offset} bytes of {local_path} and {remote_path} differ; starting over", file=sys.stderr)
+    return False
+
+
+def download(session: DeviceSession, remote_path: str, local_path: Path, resume: bool = True) -> TransferStats:
+    """ Copies a file off the device into local_path, carrying on from the end of any
+        partial local copy if `resume` and it matches the start of the remote file.
+    """
+    offset = local_path.stat().st_size if resume and local_path.exists() else 0
+    total = remote_size(session, remote_path)
+    if offset > total:
+        raise ValueError(f"local {local_path} is larger than remote {remote_path}; not resuming")
+    if offset and not _prefix_matches(session, remote_path, local_path, offset):
+        offset = 0
+
+    start = monotonic()
+    progress = _Progress(total)
+    decompressor = zlib.decompressobj(wbits=31)  # gzip framing
+    wire = transferred = 0
+    proc = _remote(session, f"sudo tail -c +{offset + 1} {shlex.quote(remote_path)} | gzip -{COMPRESSION_LEVEL}",
+                   stdout=subprocess.PIPE)
+    assert proc.stdout
+    with open(local_path, "ab" if offset else "wb") as f:
+        while True:
+            chunk = proc.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            wire += len(chunk)
+            data = decompressor.decompress(chunk)
+            f.write(data)
+            transferred += len(data)
+            progress.update(offset + transferred)
+        f.write(decompressor.flush())
+    progress.finish()
+    if proc.wait() != 0 or not decompressor.eof:
+        raise IOError(f"download of {remote_path} broke off after {offset + transferred} bytes; run again to resume")
+    return TransferStats(offset, transferred, wire, monotonic() - start)
+
+
+def upload(session: DeviceSession, local_path: Path, remote_path: str, resume: bool = True) -> TransferStats:
+    """ Copies local_path onto the device, carrying on from the end of any partial
+        remote copy if `resume` and it matches the start of the local file.
+    """
+    total = local_path.stat().st_size
+    offset = remote_size(session, remote_path) if resume else 0
+    if offset > total:
+        raise ValueError(f"remote {remote_path} is larger than local {local_path}; not resuming")
+    if offset and not _prefix_matches(session, remote_path, local_path, offset):
+        offset = 0
+
+    start = monotonic()
+    progress = _Progress(total)
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, wbits=31)
+    wire = transferred = 0
+    truncate = "" if offset else "sudo truncate -s 0 {0} 2>/dev/null; "
+    proc = _remote(
+        session,
+        (truncate + "gunzip | sudo dd of={0} bs=64K seek={1} oflag=seek_bytes conv=notrunc status=none").format(
+            shlex.quote(remote_path), offset),
+        stdin=subprocess.PIPE,
+    )
+    assert proc.stdin
+    try:
+        with open(local_path, "rb") as f:
+            f.seek(offset)
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                chunk = compressor.compress(data)
+                proc.stdin.write(chunk)
+                wire += len(chunk)
+                transferred += len(data)
+                progress.update(offset + transferred)
+        chunk = compressor.flush()
+        proc.stdin.write(chunk)
+        wire += len(chunk)
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass
+    progress.finish()
+    if proc.wait() != 0 or remote_size(session, remote_path) != total:
+        raise IOError(f"upload of {local_path} broke off; run again to resume")
+    return TransferStats(offset, transferred, wire, monotonic() - start)
@@ -1,17 +1,19 @@
 from os import getenv
-from typing import Sequence
-from datetime import datetime
+from typing import Optional, Sequence
+from datetime import datetime, timedelta
 from hmac import compare_digest
 
 from pydantic import UUID4
 from ipaddress import IPv4Address
-from sqlmodel import Session, select
+from sqlmodel import Session, select, func, or_, and_
 from fastapi.security import APIKeyHeader
 from fastapi import APIRouter, Depends, HTTPException, status
 
+from common import tracing
 from api.utils import get_tunnel
+from api.cache import details_cache
 from api.models import engine, Tunnel
-from common.models import TunnelState, TunnelServerLaunchDetails
+from common.models import TunnelState, TunnelServerLaunchDetails, TunnelServerTelemetry
 
 
 ENV = getenv("ENV")
@@ -47,6 +49,38 @@ def list_tunnels() -> Sequence[Tunnel]:
         return tunnels
 
 
+@admin.get('/tunnel/changes')
+def list_tunnel_changes(since: Optional[str] = None, limit: int = 500, rewind: float = 0) -> dict:
+    """ Returns up to `limit` tunnels changed after the `since` cursor, oldest change
+        first, and the cursor to pass next time. Without a cursor, starts from the
+        beginning.
+
+        Change times are taken when a write is flushed, not when it commits, so a
+        slow commit can land behind a cursor that has already moved past it. Callers
+        pass `rewind` seconds on the first page of a sync to read again from that
+        far behind the cursor, and replace what they have by tunnel_id.
+    """
+    changed_at = func.coalesce(Tunnel.updated_at, Tunnel.created_at)
+    with Session(engine) as sesh:
+        q = select(Tunnel).order_by(changed_at, Tunnel.id).limit(min(limit, 5000))  # type: ignore[arg-type]
+        if since:
+            try:
+                ts, last_id = since.rsplit(",", 1)
+                cursor = (datetime.fromisoformat(ts), int(last_id))
+            except ValueError:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="malformed cursor")
+            if rewind > 0:
+                q = q.where(changed_at > cursor[0] - timedelta(seconds=rewind))
+            else:
+                # rows sharing a timestamp are told apart by id, so a page can end between them
+                q = q.where(or_(changed_at > cursor[0], and_(changed_at == cursor[0], Tunnel.id > cursor[1])))  # type: ignore
+        tunnels = sesh.exec(q).all()
+        if tunnels:
+            last = tunnels[-1]
+            since = f"{(last.updated_at or last.created_at).isoformat()},{last.id}"
+        return {"tunnels": tunnels, "cursor": since}
+
+
 @admin.get("/tunnel/{tunnel_id}")
 def get_one_tunnel(tunnel_id: UUID4) -> Tunnel:
     with Session(engine) as sesh:
@@ -70,8 +104,25 @@ def post_tunnel_details(req: TunnelServerLaunchDetails):
         t.ts_public_ip = str(IPv4Address(req.ts_public_ip))  # type: ignore
         t.ts_wg_public_key = req.ts_wg_public_key
         t.ts_wg_port = req.ts_wg_port
+        tracing.record_state(req.tunnel_id, t.state, TunnelState.started)
         t.state = TunnelState.started
         t.support_secret_box = req.support_secret_box
+        t.ts_ready_seconds = req.ts_ready_seconds
+        t.ts_pooled = req.ts_pooled
+        t.ts_zone = req.ts_zone
+        sesh.add(t)
+        sesh.commit()
+    details_cache.invalidate(req.tunnel_id)
+
+
+@admin.post('/tunnel/telemetry')
+def set_tunnel_telemetry_from_admin(req: TunnelServerTelemetry):
+    """ This endpoint stores how the tunnel server's side of a tunnel is tuned, for
+        example once `fab gc` has matched its keepalive to the device's.
+    """
+    with Session(engine) as sesh:
+        t = get_tunnel(req.tunnel_id, sesh)
+        t.ts_keepalive = req.ts_keepalive
         sesh.add(t)
         sesh.commit()
 
@@ -81,9 +132,17 @@ def stop_tunnel(tunnel_id: UUID4):
     """ Sets the tunnel state to "completed" """
     with Session(engine) as sesh:
         t = get_tunnel(tunnel_id, sesh)
-        if t.expires < datetime.now():
-            t.state = TunnelState.timedout
-        else:
-            t.state = TunnelState.completed
+        state = TunnelState.timedout if t.expires < datetime.now() else TunnelState.completed
+        tracing.record_state(tunnel_id, t.state, state)
+        t.state = state
         sesh.add(t)
         sesh.commit()
+    details_cache.invalidate(tunnel_id)
+
+
+@admin.get('/cache/stats')
+def cache_stats() -> dict:
+    """ Hit rates and sizes of the API's in-process caches. Each API instance has
+        its own caches, so this only describes the instance that answers.
+    """
+    return {"tunnel_details": details_cache.stats()}
@@ -1,11 +1,13 @@
 import logging
 
-from fastapi import FastAPI, APIRouter
+from fastapi import FastAPI, APIRouter, Request
 
+from common import tracing
 from api.device import device
 from api.admin import admin
 
 logging.basicConfig(level=logging.INFO)
+tracing.set_service_name("support-tunnel-api")
 
 app = FastAPI()
 api = APIRouter(prefix="/v1")  # provides simple versioning
@@ -15,3 +17,19 @@ api.include_router(device)
 api.include_router(admin)
 
 app.include_router(api)
+
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """ Runs each request in a span, continuing the caller's trace if it sent one.
+        Routes tag the span with the tunnel they act on; see api.utils.get_tunnel.
+    """
+    parent = tracing.parse_traceparent(request.headers.get("traceparent"))
+    attributes = {"http.method": request.method, "http.target": request.url.path}
+    with tracing.span(f"{request.method} {request.url.path}", tracing.SPAN_KIND_SERVER, parent, **attributes) as s:
+        response = await call_next(request)
+        route = request.scope.get("route")
+        if route is not None:
+            s.name = f"{request.method} {route.path}"
+        s.attributes["http.status_code"] = response.status_code
+        return response
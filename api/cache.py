@@ -0,0 +1,85 @@
+""" In-process caching of hot, rarely changing API responses.
+
+    Devices poll GET /device/tunnel/details far more often than a tunnel's row ever
+    changes, so its responses are cached here by tunnel_id. Every route that
+    changes what that endpoint returns invalidates the tunnel's entry. The cache is
+    per process, so with several API instances, one instance's writes don't reach
+    the others' caches; the TTL bounds how stale they can get.
+"""
+from os import getenv
+from threading import Lock
+from time import monotonic
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+# seconds a cached tunnel details response may be served for; 0 turns caching off
+DETAILS_CACHE_TTL = float(getenv("DETAILS_CACHE_TTL", 30))
+# the most tunnels whose details are cached at once; the least recently used go first
+DETAILS_CACHE_SIZE = int(getenv("DETAILS_CACHE_SIZE", 10000))
+
+
+class TTLCache:
+    """ A thread safe LRU cache whose entries also expire `ttl` seconds after being
+        stored. Counts its hits and misses.
+
+        A value read from the database just before a write, but stored just after
+        the write invalidated it, must not be served; so readers note `version()`
+        before reading, and `put()` drops the value if anything was invalidated
+        since.
+    """
+    def __init__(self, ttl: float, size: int):
+        self.ttl = ttl
+        self.size = size
+        self.entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.lock = Lock()
+        self.invalidations = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def version(self) -> int:
+        return self.invalidations
+
+    def put(self, key: Hashable, value: Any, version: int):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            if version != self.invalidations:
+                return
+            self.entries[key] = (monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        with self.lock:
+            self.invalidations += 1
+            self.entries.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "entries": len(self.entries),
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "ttl_seconds": self.ttl,
+                "size": self.size,
+            }
+
+
+details_cache = TTLCache(DETAILS_CACHE_TTL, DETAILS_CACHE_SIZE)
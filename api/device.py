@@ -3,21 +3,26 @@ import logging
 
 from os import getenv
 from uuid import UUID
+from typing import List
 from datetime import datetime
 
 from fastapi import Depends, APIRouter, HTTPException, status
 from fastapi.security import OAuth2AuthorizationCodeBearer
 from pydantic import UUID4
-from sqlmodel import Session
+from sqlmodel import Session, select, col
 from jose import JWTError, jwt
 
+from common import tracing
 from api.utils import get_tunnel
+from api.cache import details_cache
 from api.models import engine, Tunnel
 from common.util import expiry_datetime
-from common.models import TunnelServerLaunchDetailsResponse, TunnelRequest, Token, TunnelRequestTokenData, TunnelState, DeviceTunnelLaunchDetails
+from common.models import TunnelServerLaunchDetailsResponse, TunnelRequest, Token, TunnelRequestTokenData, TunnelState, DeviceTunnelLaunchDetails, DeviceTunnelTelemetry, TunnelStatusesRequest
 
 JWT_SECRET = getenv("JWT_SECRET")
 JWT_ALGO = "HS256"
+# the most tunnels a device may ask about in one /tunnel/statuses call
+MAX_STATUS_TOKENS = 100
 assert JWT_SECRET
 
 oauth2_scheme = OAuth2AuthorizationCodeBearer(
@@ -35,6 +40,19 @@ def create_oauth_token(tunnel_id: UUID4):
     return jwt.encode(to_encode.dict(), JWT_SECRET, algorithm=JWT_ALGO)
 
 
+def tunnel_id_from_token(token: str) -> UUID:
+    """ Validates a JWT and returns the `tunnel_id` from its claims. Raises JWTError
+        if the token is invalid or expired.
+    """
+    assert JWT_SECRET
+    payload = TunnelRequestTokenData(
+        **jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGO]))
+    prefix_len = len("tunnel_id:")
+    tunnel_id_str = payload.sub[prefix_len:]
+    logging.debug(f"tunnel_id_str: {tunnel_id_str}")
+    return UUID(hex=tunnel_id_str)
+
+
 def get_tunnel_id(token: str = Depends(oauth2_scheme)) -> UUID:
     """ A FastAPI authentication dependency that produces the tunnel_id.
 
@@ -46,14 +64,8 @@ def get_tunnel_id(token: str = Depends(oauth2_scheme)) -> UUID:
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    assert JWT_SECRET
     try:
-        payload = TunnelRequestTokenData(
-            **jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGO]))
-        prefix_len = len("tunnel_id:")
-        tunnel_id_str = payload.sub[prefix_len:]
-        logging.debug(f"tunnel_id_str: {tunnel_id_str}")
-        tunnel_id = UUID(hex=tunnel_id_str)
+        tunnel_id = tunnel_id_from_token(token)
     except JWTError:
         raise credentials_exception
     # TODO: maybe validate this UUID is actually in the db?
@@ -73,6 +85,7 @@ def request_tunnel(req: TunnelRequest) -> Token:
         claim about which tunnel_id this is.
     """
     t = Tunnel(tunnel_id=uuid.uuid4(), **req.dict())
+    tracing.record_state(t.tunnel_id, None, t.state)
     token = create_oauth_token(t.tunnel_id)
     with Session(engine) as sesh:
         sesh.add(t)
@@ -88,10 +101,42 @@ def get_tunnel_details(tunnel_id: UUID4 = Depends(get_tunnel_id)) -> TunnelServe
       * tunnel pubkey after service launch
       * tunnel public ip
       * a support-locked secretbox containing an ssh authorized_keys entry
+
+        Devices poll this, so responses are cached; see api.cache.
     """
+    cached = details_cache.get(tunnel_id)
+    tracing.set_attributes(tunnel_id=str(tunnel_id), **{"cache.hit": cached is not None})
+    if cached is not None:
+        return cached
+    version = details_cache.version()
     with Session(engine) as sesh:
         t = get_tunnel(tunnel_id, sesh)
-        return TunnelServerLaunchDetailsResponse(**t.dict())
+        details = TunnelServerLaunchDetailsResponse(**t.dict())
+    details_cache.put(tunnel_id, details, version)
+    return details
+
+@device.post('/tunnel/statuses')
+def get_tunnel_statuses(req: TunnelStatusesRequest) -> List[TunnelServerLaunchDetailsResponse]:
+    """ Returns the same details as GET /tunnel/details, for several tunnels at once.
+
+        Each tunnel is authenticated by its own token in the request body. Tokens that
+        don't validate, for example because they have expired, are skipped.
+    """
+    if len(req.tokens) > MAX_STATUS_TOKENS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"At most {MAX_STATUS_TOKENS} tokens may be sent at once")
+
+    tunnel_ids = []
+    for token in req.tokens:
+        try:
+            tunnel_ids.append(tunnel_id_from_token(token))
+        except JWTError:
+            logging.info("skipping a token that did not validate")
+
+    with Session(engine) as sesh:
+        stmt = select(Tunnel).where(col(Tunnel.tunnel_id).in_(tunnel_ids))
+        return [TunnelServerLaunchDetailsResponse(**t.dict()) for t in sesh.exec(stmt).all()]
 
 # step #7
 
@@ -102,8 +147,25 @@ def set_tunnel_details_from_device(req: DeviceTunnelLaunchDetails, tunnel_id: UU
     with Session(engine) as sesh:
         t = get_tunnel(tunnel_id, sesh)
         assert t.state == TunnelState.started
+        tracing.record_state(tunnel_id, t.state, TunnelState.running)
         t.support_user = req.support_user
         t.state = TunnelState.running
+        t.mtu = req.mtu
+        t.keepalive = req.keepalive
+        sesh.add(t)
+        sesh.commit()
+    details_cache.invalidate(tunnel_id)
+
+
+@device.post('/tunnel/telemetry')
+def set_tunnel_telemetry_from_device(req: DeviceTunnelTelemetry, tunnel_id: UUID4 = Depends(get_tunnel_id)):
+    """ This endpoint stores how the device has tuned its tunnel, for example after
+        adaptive keepalive has settled on an interval.
+    """
+    with Session(engine) as sesh:
+        t = get_tunnel(tunnel_id, sesh)
+        t.mtu = req.mtu
+        t.keepalive = req.keepalive
         sesh.add(t)
         sesh.commit()
 
@@ -123,7 +185,9 @@ def stop_tunnel(tunnel_id: UUID4 = Depends(get_tunnel_id)):
     # if it caught its own timedout sooner than we did.
     with Session(engine) as sesh:
         t = get_tunnel(tunnel_id, sesh)
+        tracing.record_state(tunnel_id, t.state, TunnelState.completed)
         t.state = TunnelState.completed
         t.stopped_at = datetime.now()
         sesh.add(t)
         sesh.commit()
+    details_cache.invalidate(tunnel_id)
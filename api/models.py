@@ -10,7 +10,7 @@ from sqlmodel import Field, SQLModel, create_engine
 
 from api.sql import get_sql_conn
 from common.models import TunnelState
-from common.util import expiry_datetime
+from common.util import expiry_datetime, add_missing_columns
 
 # the default here is for the cloud environment.
 SQL_URI = getenv("SQL_URI", "mysql+pymysql://")
@@ -35,17 +35,33 @@ class Tunnel(SQLModel, table=True):
         default_factory=expiry_datetime
     )
     stopped_at: Optional[datetime.datetime]
+    # bumped on every write; admin CLIs sync their local mirror from it. Rows from
+    # before this column existed have none, and count as changed when created.
+    updated_at: Optional[datetime.datetime] = Field(
+        default_factory=datetime.datetime.now,
+        sa_column_kwargs={"onupdate": datetime.datetime.now},
+    )
 
     support_user: Optional[str]
     device_wg_public_key: str
+    location_hint: Optional[str]
 
     ts_instance_id: Optional[str]
     ts_wg_public_key: Optional[str]
     ts_public_ip: Optional[IPv4Address]
     ts_wg_port: Optional[int]
+    ts_ready_seconds: Optional[float]
+    ts_pooled: Optional[bool]
+    ts_zone: Optional[str]
 
     network: IPv4Network
 
+    # tunnel telemetry, as reported by the device
+    mtu: Optional[int]
+    keepalive: Optional[int]
+    # the keepalive `fab gc` last applied on the tunnel server's side
+    ts_keepalive: Optional[int]
+
     # The below secret box is encrypted using the device pubkey +
     # the admin privkey. This gets us integrity and authenticity.
     # The fact that it gets us privacy is unintentional and just a
@@ -69,3 +85,4 @@ else:
     engine = create_engine(SQL_URI, creator=get_sql_conn, echo=True)
 
 SQLModel.metadata.create_all(engine)
+add_missing_columns(engine, Tunnel.__table__)  # type: ignore
@@ -1,9 +1,12 @@
 from sqlmodel import Session, select
 from pydantic import UUID4
 
+from common import tracing
 from api.models import Tunnel
 
 
 def get_tunnel(tunnel_id: UUID4, sesh: Session) -> Tunnel:
+    """ Looks up a tunnel, tagging the request's span with it. """
+    tracing.set_attributes(tunnel_id=str(tunnel_id))
     stmt = select(Tunnel).where(Tunnel.tunnel_id == tunnel_id)
     return sesh.exec(stmt).one()
@@ -0,0 +1,167 @@
+""" An offline benchmark of tunnel server provisioning and garbage collection at scale.
+
+    Runs the real admin.cloud code against admin.fake_compute, seeded with any number
+    of simulated tunnel servers, with per-call latencies and failure rates set to
+    taste. Measures how long concurrent creates take, how long listing all tunnel
+    servers takes, and how quickly `fab gc`'s deletion path clears them all.
+
+    Needs nothing but the Python dependencies. Example:
+        python3 -m bench.cloud --instances 5000 --creates 200 \
+            --latency insert=40,delete=30,aggregated_list=2 --time-scale 0.01 --failure-rate 0.02
+"""
+import os
+import json
+import math
+import uuid
+import logging
+import argparse
+
+from time import monotonic
+from statistics import median
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from common.constants import INSTANCE_NAME_PREFIX
+
+DEFAULT_ZONES = "us-central1-b,us-east1-b,europe-west1-b"
+
+
+def seed(count: int, zones: List[str]):
+    """ Adds `count` running tunnel servers, spread over `zones`, without waiting on anything. """
+    from google.cloud import compute_v1
+    from admin import cloud
+
+    instances = {}
+    for n in range(count):
+        tunnel_id = str(uuid.uuid4())
+        zone = zones[n % len(zones)]
+        i = compute_v1.Instance(
+            name=f"{INSTANCE_NAME_PREFIX}-{tunnel_id}",
+            id=n,
+            zone=f"https://www.googleapis.com/compute/v1/projects/bench/zones/{zone}",
+            status="RUNNING",
+            labels={cloud.TUNNEL_ID_LABEL: tunnel_id},
+        )
+        instances[(zone, i.name)] = i
+    # the fake, underneath admin.cloud's instrumentation
+    cloud.instances_client()._client.add_instances(instances)
+
+
+def p95(durations: List[float]) -> float:
+    """ The 95th percentile, by nearest rank; statistics.quantiles() needs Python 3.8. """
+    ordered = sorted(durations)
+    return ordered[max(math.ceil(len(ordered) * 0.95) - 1, 0)]
+
+
+def summarize(durations: List[float], failures: int, wall: float) -> dict:
+    ok = len(durations)
+    return {
+        "ok": ok,
+        "failed": failures,
+        "wall_seconds": round(wall, 2),
+        "per_second": round(ok / wall, 1) if wall else None,
+        "median_seconds": round(median(durations), 3) if durations else None,
+        "p95_seconds": round(p95(durations), 3) if len(durations) > 1 else None,
+    }
+
+
+def bench_create(count: int, parallelism: int, zones: List[str]) -> dict:
+    """ Creates `count` tunnel servers, `parallelism` at a time. """
+    from admin.provider import cloud_provider
+
+    provider = cloud_provider()
+
+    def create(n: int) -> Optional[float]:
+        start = monotonic()
+        try:
+            provider.create(uuid.uuid4(), zones[n % len(zones)])
+            return monotonic() - start
+        except Exception:
+            return None
+
+    start = monotonic()
+    with ThreadPoolExecutor(max_workers=parallelism) as pool:
+        results = [d for d in pool.map(create, range(count))]
+    durations = [d for d in results if d is not None]
+    return summarize(durations, len(results) - len(durations), monotonic() - start)
+
+
+def bench_list() -> dict:
+    from admin.provider import cloud_provider
+
+    start = monotonic()
+    instances = cloud_provider().list()
+    return {"instances": len(instances), "seconds": round(monotonic() - start, 3)}
+
+
+def bench_gc(parallelism: int) -> dict:
+    """ Deletes every tunnel server, the way `fab gc` does. """
+    from admin.provider import cloud_provider
+
+    provider = cloud_provider()
+    start = monotonic()
+    results = provider.destroy(provider.list(), parallelism=parallelism)
+    wall = monotonic() - start
+    failed = sum(1 for error in results.values() if error)
+    return {
+        "deleted": len(results) - failed,
+        "failed": failed,
+        "wall_seconds": round(wall, 2),
+        "per_second": round((len(results) - failed) / wall, 1) if wall else None,
+    }
+
+
+def run(instances: int, creates: int, parallelism: int, latency: Dict[str, float], time_scale: float,
+        failure_rate: float, zones: List[str]) -> dict:
+    """ Runs the whole benchmark against the fake cloud. Returns the results.
+        This configures the fake through the environment, so it must run before
+        anything else imports admin.cloud.
+    """
+    os.environ["FAKE_COMPUTE"] = "1"
+    os.environ.setdefault("PROJECT_ID", "bench")
+    os.environ["FAKE_COMPUTE_LATENCY"] = ",".join(f"{method}={seconds * time_scale}" for method, seconds in latency.items())
+    os.environ["FAKE_COMPUTE_FAILURE_RATE"] = str(failure_rate)
+    from admin import cloud
+
+    seed(instances, zones)
+
+    results = {
+        "config": {
+            "instances": instances,
+            "creates": creates,
+            "parallelism": parallelism,
+            "latency": latency,
+            "time_scale": time_scale,
+            "failure_rate": failure_rate,
+            "zones": zones,
+        },
+        "create": bench_create(creates, parallelism, zones),
+        "list": bench_list(),
+        "gc": bench_gc(parallelism),
+    }
+    results["cloud_api_calls"] = {call: len(times) for call, times in sorted(cloud.cloud_api_calls.items())}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--instances", type=int, default=1000, help="tunnel servers to start with")
+    parser.add_argument("--creates", type=int, default=100, help="tunnel servers to create")
+    parser.add_argument("--parallelism", type=int, default=8, help="concurrent creates, and concurrent delete requests in gc")
+    parser.add_argument("--latency", default="insert=40,delete=30,get=0.2,aggregated_list=1.5,get_guest_attributes=0.2",
+                        help="mean seconds per call, by client method")
+    parser.add_argument("--time-scale", type=float, default=0.01, help="multiplies every latency, to keep runs short")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="chance an insert or delete fails")
+    parser.add_argument("--zones", default=DEFAULT_ZONES, help="comma separated zones to spread instances over")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.CRITICAL)
+    latency = {method: float(seconds) for method, _, seconds in (pair.partition("=") for pair in args.latency.split(","))}
+    results = run(args.instances, args.creates, args.parallelism, latency, args.time_scale,
+                  args.failure_rate, [z.strip() for z in args.zones.split(",") if z.strip()])
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+""" An offline simulation of whole tunnel lifecycles, from the device's request to it
+    reporting the tunnel up.
+
+    Serves the real API (api.app) over HTTP on localhost, backed by a temporary
+    SQLite database, and drives it with the real `device.cli` and `admin.cli` task
+    logic: the device requests a tunnel (step #1 in api/device.py), the admin creates
+    its tunnel server, and the device fetches the server's details (step #5) and
+    reports back once connected (step #7). Only what can't run offline is stubbed:
+    the cloud runs on admin.fake_compute, and commands that would run on the device
+    (useradd, systemctl, ...) or over SSH on the tunnel server return canned output
+    after an optional delay.
+
+    Lifecycles run `--tunnels` at a time per concurrency level, and the wall time of
+    each step is summarized per level. Example:
+        python3 -m bench.lifecycle --tunnels 64 --concurrency 1,8,32 --ssh-latency 0.05
+"""
+import os
+import io
+import json
+import socket
+import logging
+import sqlite3
+import argparse
+import tempfile
+import threading
+
+from uuid import UUID
+from time import sleep, monotonic
+from contextlib import redirect_stdout
+from statistics import median
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import IPv4Address, IPv4Network
+
+from invoke import Context
+from invoke.runners import Result
+
+from bench.cloud import p95
+
+ADMIN_AUTH_TOKEN = "bench-admin-token"
+# what `cat` of a freshly made SSH public key returns on the simulated tunnel server
+FAKE_SSH_PUBKEY = "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIBenchBenchBenchBenchBenchBenchBenchBenchBen bench"
+
+
+class StubContext(Context):
+    """ Stands in for the invoke contexts and fabric connections the CLIs run
+        commands through. Nothing is run; each command takes `latency` seconds and
+        succeeds with empty output, bar the few whose output the CLIs parse.
+    """
+    def __init__(self, original_context: Optional[Context] = None, latency: float = 0):
+        super().__init__(config=original_context.config if original_context else None)
+        self.latency = getattr(original_context, "latency", latency)
+
+    def run(self, command: str, **kwargs) -> Result:  # type: ignore[override]
+        sleep(self.latency)
+        stdout = FAKE_SSH_PUBKEY if command.startswith("cat ") and command.endswith(".pub") else ""
+        return Result(stdout=stdout, command=command, exited=0)
+
+    def put(self, local, remote, preserve_mode=True):
+        sleep(self.latency)
+
+
+class StepTimer:
+    """ Collects the wall time of each call to the functions it wraps, by step. """
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def wrap(self, step: str, f: Callable) -> Callable:
+        def timed(*args, **kwargs):
+            start = monotonic()
+            result = f(*args, **kwargs)
+            with self.lock:
+                self.durations[step].append(monotonic() - start)
+            return result
+        return timed
+
+    def reset(self):
+        with self.lock:
+            self.durations.clear()
+
+
+def summarize(durations: List[float]) -> dict:
+    return {
+        "count": len(durations),
+        "median_seconds": round(median(durations), 4) if durations else None,
+        "p95_seconds": round(p95(durations), 4) if len(durations) > 1 else None,
+        "max_seconds": round(max(durations), 4) if durations else None,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve_api(port: int):
+    """ Serves api.app on localhost in a background thread, returning once it's up. """
+    import uvicorn
+    from api.app import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", access_log=False))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        sleep(0.05)
+
+
+def configure(workdir: str, port: int, ssh_latency: float):
+    """ Points the API, the device and the admin CLI at throwaway state and at each
+        other, and stubs out what can't run offline. This sets the environment the
+        modules read at import time, so it must run before anything imports them.
+    """
+    os.environ.update({
+        "ENV": "bench",
+        "PROJECT_ID": "bench",
+        "JWT_SECRET": "bench-jwt-secret",
+        "ADMIN_AUTH_TOKEN": ADMIN_AUTH_TOKEN,
+        "SQL_URI": f"sqlite:///{workdir}/api.db",
+        "SQLITE_DB": f"{workdir}/device.db",
+        "SUPPORT_TUNNEL_API": f"http://127.0.0.1:{port}/v1",
+        "FAKE_COMPUTE": "1",
+    })
+    # the API's models carry these types, which MySQL drivers take as strings but sqlite3 doesn't
+    sqlite3.register_adapter(IPv4Network, str)
+    sqlite3.register_adapter(IPv4Address, str)
+
+    from admin import cli as admin_cli, cloud
+    from device import cli as device_cli
+
+    admin_cli.auth_header = lambda: {"admin-auth-token": ADMIN_AUTH_TOKEN}
+    admin_cli.ts_connection = lambda c, host: StubContext(latency=ssh_latency)
+    cloud.ssh_answers = lambda host, port=22, timeout=5: True
+    device_cli.LocalContext = StubContext  # type: ignore[misc, assignment]
+
+
+def lifecycle(timer: StepTimer, command_latency: float) -> None:
+    """ Takes one tunnel from request to connected, the way a device and an admin would. """
+    from sqlmodel import Session
+
+    from admin import cli as admin_cli
+    from device import cli as device_cli
+    from device.models import get_engine
+
+    device_context = StubContext(latency=command_latency)
+    tunnel_id = device_cli.request.body(device_context)
+    with Session(get_engine()) as sesh:
+        preshared_key = device_cli.get_device_tunnel(tunnel_id, sesh).wg_preshared_key
+
+    timer.wrap("create", admin_cli.create.body)(StubContext(), UUID(str(tunnel_id)), preshared_key)
+
+    if device_cli.connect.body(device_context, tunnel_id) == 1:
+        raise RuntimeError(f"device could not fetch details for {tunnel_id}")
+
+
+def run(tunnels: int, concurrency: List[int], command_latency: float, ssh_latency: float) -> dict:
+    """ Runs `tunnels` lifecycles at each concurrency level. Returns the results. """
+    workdir = tempfile.mkdtemp(prefix="st-bench-")
+    port = free_port()
+    configure(workdir, port, ssh_latency)
+    serve_api(port)
+
+    from device import cli as device_cli
+    from device.models import get_engine
+
+    # create the device's schema now, rather than racing to from the first lifecycles
+    get_engine()
+
+    timer = StepTimer()
+    device_cli.request.body = timer.wrap("step #1 request", device_cli.request.body)
+    device_cli.request_tunnel_server_details = timer.wrap("step #5 details", device_cli.request_tunnel_server_details)
+    device_cli.send_connected_status_to_api = timer.wrap("step #7 connected", device_cli.send_connected_status_to_api)
+
+    results: dict = {
+        "config": {
+            "tunnels": tunnels,
+            "concurrency": concurrency,
+            "command_latency": command_latency,
+            "ssh_latency": ssh_latency,
+            "workdir": workdir,
+        },
+        "levels": [],
+    }
+    for level in concurrency:
+        timer.reset()
+        errors: List[str] = []
+
+        def one(_) -> None:
+            start = monotonic()
+            try:
+                lifecycle(timer, command_latency)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+                return
+            with timer.lock:
+                timer.durations["lifecycle"].append(monotonic() - start)
+
+        start = monotonic()
+        # the CLIs narrate what they do; keep that out of the results
+        with redirect_stdout(io.StringIO()), ThreadPoolExecutor(max_workers=level) as pool:
+            for _ in pool.map(one, range(tunnels)):
+                pass
+        wall = monotonic() - start
+        ok = len(timer.durations["lifecycle"])
+        results["levels"].append({
+            "concurrency": level,
+            "ok": ok,
+            "failed": len(errors),
+            "errors": sorted(set(errors))[:5],
+            "wall_seconds": round(wall, 2),
+            "lifecycles_per_second": round(ok / wall, 1) if wall else None,
+            "steps": {step: summarize(d) for step, d in sorted(timer.durations.items())},
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tunnels", type=int, default=32, help="lifecycles to run at each concurrency level")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated numbers of lifecycles to run at once")
+    parser.add_argument("--command-latency", type=float, default=0, help="seconds each stubbed command on the device takes")
+    parser.add_argument("--ssh-latency", type=float, default=0, help="seconds each stubbed command over SSH on the tunnel server takes")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.CRITICAL)
+    results = run(args.tunnels, [int(n) for n in args.concurrency.split(",") if n.strip()],
+                  args.command_latency, args.ssh_latency)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+""" A local WireGuard data-plane benchmark.
+
+    Builds two network namespaces joined by a veth pair, brings up a tunnel between
+    them from `WireguardTunnel.to_WireguardConfig()` output (one device side, one
+    tunnel server side), and measures throughput, latency and small-packet rate
+    across it. Everything runs offline on a single Linux box.
+
+    Needs root, wireguard-tools, iperf3 and ping. Example:
+        sudo python3 -m bench.wireguard --mtu 1380 --underlay-mtu 1492 --delay-ms 20
+"""
+import json
+import random
+import logging
+import argparse
+import tempfile
+
+from time import sleep
+from pathlib import Path
+from typing import Any, Optional
+from ipaddress import IPv4Address, IPv4Network
+
+from invoke import Context
+from wireguard_tools import WireguardKey
+
+from common.models import WireguardTunnel, WireguardPeer
+from common.constants import WG_DEFAULT_KEEPALIVE
+from common.tunnel import device_ip, server_ip
+
+DEVICE_NS = "st-bench-device"
+SERVER_NS = "st-bench-server"
+# the "internet" between the two namespaces; TEST-NET-1 so it can't clash with anything real
+DEVICE_UNDERLAY_IP = IPv4Address("192.0.2.1")
+SERVER_UNDERLAY_IP = IPv4Address("192.0.2.2")
+TUNNEL_NETWORK = IPv4Network("10.254.254.0/28")
+INTERFACE = "support-bench"
+
+
+def build_tunnels(mtu: Optional[int], keepalive: Optional[int]):
+    """ Returns a (device, server) pair of WireguardTunnels, built the same way
+        `device.models.DeviceTunnel` and `admin.cli.create` build theirs.
+    """
+    device_key = WireguardKey.generate()
+    server_key = WireguardKey.generate()
+    preshared_key = WireguardKey.generate()
+    server_port = random.randint(20000, 65534)
+
+    device = WireguardTunnel(
+        interface=INTERFACE,
+        my_ip=device_ip(TUNNEL_NETWORK),
+        network=TUNNEL_NETWORK,
+        public_key=device_key.public_key(),
+        private_key=device_key,
+        preshared_key=preshared_key,
+        port=random.randint(20000, 65534),
+        peers=[WireguardPeer(
+            public_key=server_key.public_key(),
+            allowed_ip=server_ip(TUNNEL_NETWORK),
+            port=server_port,
+            public_ip=SERVER_UNDERLAY_IP,
+        )],
+        mtu=mtu,
+        persistent_keepalive=keepalive,
+    )
+    server = WireguardTunnel(
+        interface=INTERFACE,
+        my_ip=server_ip(TUNNEL_NETWORK),
+        network=TUNNEL_NETWORK,
+        public_key=server_key.public_key(),
+        private_key=server_key,
+        preshared_key=preshared_key,
+        port=server_port,
+        peers=[WireguardPeer(
+            public_key=device_key.public_key(),
+            allowed_ip=device_ip(TUNNEL_NETWORK),
+        )],
+        mtu=mtu,
+        persistent_keepalive=keepalive,
+    )
+    return device, server
+
+
+def netns(ns: str, command: str) -> str:
+    """ Prefixes a command so it runs inside a namespace. """
+    return f"sudo ip netns exec {ns} {command}"
+
+
+def setup_namespaces(c: Context, underlay_mtu: int, delay_ms: float):
+    """ Creates both namespaces and the veth pair between them. """
+    for ns in (DEVICE_NS, SERVER_NS):
+        c.run(f"sudo ip netns add {ns}")
+        c.run(netns(ns, "ip link set lo up"))
+    c.run(f"sudo ip link add st-bench-d netns {DEVICE_NS} type veth peer name st-bench-s netns {SERVER_NS}")
+    for ns, iface, ip in ((DEVICE_NS, "st-bench-d", DEVICE_UNDERLAY_IP), (SERVER_NS, "st-bench-s", SERVER_UNDERLAY_IP)):
+        c.run(netns(ns, f"ip addr add {ip}/30 dev {iface}"))
+        c.run(netns(ns, f"ip link set {iface} mtu {underlay_mtu} up"))
+        if delay_ms:
+            # half the delay each way, so the round trip adds up to delay_ms
+            c.run(netns(ns, f"tc qdisc add dev {iface} root netem delay {delay_ms / 2}ms"))
+
+
+def teardown_namespaces(c: Context):
+    """ Deletes both namespaces, and with them the veth pair and tunnels. """
+    for ns in (DEVICE_NS, SERVER_NS):
+        c.run(f"sudo ip netns del {ns}", warn=True, hide="both")
+
+
+def start_tunnel(c: Context, ns: str, t: WireguardTunnel, conf_dir: Path):
+    """ Writes a wg-quick config for a tunnel and brings it up inside a namespace. """
+    conf = conf_dir / f"{ns}" / f"{t.interface}.conf"
+    conf.parent.mkdir()
+    conf.write_text(t.to_WireguardConfig().to_wgconfig(wgquick_format=True))
+    conf.chmod(0o600)
+    c.run(netns(ns, f"wg-quick up {conf}"), hide="both")
+
+
+def run_iperf(c: Context, client_args: str) -> dict:
+    """ Runs a one-shot iperf3 server in the server namespace and a client against it. """
+    # asynchronous runs return a Promise, which invoke's annotations don't reflect
+    server: Any = c.run(netns(SERVER_NS, f"iperf3 -s -1 -B {server_ip(TUNNEL_NETWORK).ip}"), asynchronous=True, hide="both")
+    sleep(0.5)  # give the server a moment to bind
+    try:
+        res = c.run(netns(DEVICE_NS, f"iperf3 -J -c {server_ip(TUNNEL_NETWORK).ip} {client_args}"), hide="both")
+    finally:
+        server.join()
+    assert res
+    return json.loads(res.stdout)
+
+
+def bench_throughput(c: Context, seconds: int) -> dict:
+    """ Bulk TCP throughput, device to server and back. """
+    upload = run_iperf(c, f"-t {seconds}")["end"]
+    download = run_iperf(c, f"-t {seconds} -R")["end"]
+    return {
+        "upload_mbps": round(upload["sum_received"]["bits_per_second"] / 1e6, 1),
+        "download_mbps": round(download["sum_received"]["bits_per_second"] / 1e6, 1),
+        "retransmits": upload["sum_sent"].get("retransmits", 0) + download["sum_sent"].get("retransmits", 0),
+    }
+
+
+def bench_latency(c: Context, count: int) -> dict:
+    """ Round trip times of pings through the tunnel. """
+    res = c.run(netns(DEVICE_NS, f"ping -q -c {count} -i 0.2 {server_ip(TUNNEL_NETWORK).ip}"), hide="both")
+    assert res
+    # the last line looks like "rtt min/avg/max/mdev = 0.041/0.052/0.078/0.010 ms"
+    rtt_min, rtt_avg, rtt_max, rtt_mdev = res.stdout.strip().splitlines()[-1].split("=")[1].split()[0].split("/")
+    return {"min_ms": float(rtt_min), "avg_ms": float(rtt_avg), "max_ms": float(rtt_max), "mdev_ms": float(rtt_mdev)}
+
+
+def bench_small_packets(c: Context, seconds: int, size: int) -> dict:
+    """ Unthrottled stream of small UDP datagrams, like interactive SSH traffic. """
+    result = run_iperf(c, f"-u -b 0 -l {size} -t {seconds}")["end"]["sum"]
+    return {
+        "packets_per_second": round(result["packets"] / result["seconds"]),
+        "lost_percent": round(result["lost_percent"], 2),
+        "jitter_ms": round(result["jitter_ms"], 3),
+    }
+
+
+def run(mtu: Optional[int], keepalive: Optional[int], underlay_mtu: int, delay_ms: float, seconds: int, pings: int, small_packet_size: int) -> dict:
+    """ Runs the whole benchmark, cleaning up after itself. Returns the results. """
+    c = Context()
+    device, server = build_tunnels(mtu, keepalive)
+    teardown_namespaces(c)  # in case a previous run was interrupted
+    try:
+        setup_namespaces(c, underlay_mtu, delay_ms)
+        with tempfile.TemporaryDirectory() as conf_dir:
+            start_tunnel(c, SERVER_NS, server, Path(conf_dir))
+            start_tunnel(c, DEVICE_NS, device, Path(conf_dir))
+        return {
+            "config": {
+                "mtu": mtu,
+                "keepalive": keepalive,
+                "underlay_mtu": underlay_mtu,
+                "delay_ms": delay_ms,
+            },
+            "latency": bench_latency(c, pings),
+            "throughput": bench_throughput(c, seconds),
+            "small_packets": bench_small_packets(c, seconds, small_packet_size),
+        }
+    finally:
+        teardown_namespaces(c)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mtu", type=int, default=None, help="tunnel MTU; by default wg-quick picks one")
+    parser.add_argument("--keepalive", type=int, default=WG_DEFAULT_KEEPALIVE, help="persistent keepalive, in seconds")
+    parser.add_argument("--underlay-mtu", type=int, default=1500, help="MTU of the link between the namespaces, e.g. 1492 for PPPoE")
+    parser.add_argument("--delay-ms", type=float, default=0, help="round trip delay to add to the underlay")
+    parser.add_argument("--seconds", type=int, default=10, help="duration of each throughput test")
+    parser.add_argument("--pings", type=int, default=50, help="number of pings for the latency test")
+    parser.add_argument("--small-packet-size", type=int, default=64, help="UDP payload size for the small packet test")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+    results = run(args.mtu, args.keepalive, args.underlay_mtu, args.delay_ms, args.seconds, args.pings, args.small_packet_size)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,3 +5,14 @@ TUNNEL_EXPIRY_MINS = int(
     getenv("TUNNEL_EXPIRY_MINS", 60*24*14))  # default is 14 days
 INSTANCE_NAME_PREFIX = "support-tunnel"
 SSH_KEYFILE_PATH=Path("/var/lib/support_tunnel/ssh_key")
+# WireGuard's per-packet overhead with an IPv4 outer header (20 bytes of IP, 8 of
+# UDP and 32 of WireGuard); tunnels only ever run over IPv4.
+WG_MTU_OVERHEAD = 60
+WG_MIN_MTU = 576  # the IPv4 minimum every host must accept
+WG_DEFAULT_KEEPALIVE = 14  # seconds; short enough for nearly any NAT
+WG_MAX_KEEPALIVE = 600  # the longest interval adaptive keepalive will settle on
+# adaptive keepalive uses this fraction of the measured NAT binding lifetime
+WG_KEEPALIVE_SAFETY_FACTOR = 0.8
+# tunnel servers echo UDP datagrams back after a requested delay on this port, so
+# devices can measure their NAT's binding lifetime; WireGuard ports stay below it
+NAT_PROBE_PORT = 65534
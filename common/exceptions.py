@@ -9,3 +9,9 @@ class InvalidTunnelStateException(Exception):
 
     def __init__(self, msg: str = ""):
         self.msg = msg
+
+class ApiUnavailableException(Exception):
+    msg: str
+
+    def __init__(self, msg: str = ""):
+        self.msg = msg
@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import Optional, List, Union
+from typing import Dict, Optional, List, Union
 from typing_extensions import Annotated
 from ipaddress import IPv4Address, IPv4Network, IPv4Interface
 
@@ -9,6 +9,8 @@ from pydantic import UUID4, field_serializer
 from pydantic.functional_validators import AfterValidator
 from wireguard_tools import WireguardConfig, WireguardKey
 
+from common.constants import WG_DEFAULT_KEEPALIVE
+
 
 class TunnelState(int, Enum):
     """ Describes a tunnel state. Behind the scenes, this is represented with integers;
@@ -47,6 +49,9 @@ class WireguardTunnel(SQLModel):
     preshared_key: WireguardKey
     port: int
     peers: List[WireguardPeer]
+    mtu: Optional[int] = None  # if unset, wg-quick derives one from the route MTU
+    persistent_keepalive: Optional[int] = WG_DEFAULT_KEEPALIVE
+    relay: bool = False  # route between this tunnel's peers, e.g. an admin workstation and the device
 
     # The below permits us to use WireguardKey types.
     model_config = SQLModelConfig(arbitrary_types_allowed=True)
@@ -57,20 +62,48 @@ class WireguardTunnel(SQLModel):
     def serialize_key(self, k: WireguardKey, _info):
         return str(k)
 
+    def relay_rules(self) -> Dict[str, List[str]]:
+        """ wg-quick hooks that let peers of a relaying tunnel reach one another, and
+            nothing else: packets arriving on the interface are routed by a table of
+            their own (numbered after the port, which is unique on the host), which
+            only knows about this tunnel's network.
+        """
+        table = self.port
+        return {
+            "postup": [
+                "sysctl -w net.ipv4.conf.%i.forwarding=1",
+                f"ip route add {self.network} dev %i table {table}",
+                f"ip route add unreachable default table {table}",
+                f"ip rule add iif %i lookup {table}",
+            ],
+            "postdown": [
+                f"ip rule del iif %i lookup {table}",
+                f"ip route flush table {table}",
+            ],
+        }
+
     def to_WireguardConfig(self) -> WireguardConfig:
         """ Returns this to a generic WireguardConfig """
+        def allowed_ips(p: WireguardPeer) -> list:
+            if not self.relay:
+                return [self.network]  # TODO: lock this down
+            # peers of a relay have to be told apart by their address
+            return [IPv4Network(getattr(p.allowed_ip, "ip", p.allowed_ip))]
+
         c = {
             "private_key": self.private_key,
             "addresses": [self.my_ip],
             "listen_port": self.port,
+            "mtu": self.mtu,
             "peers": [{
                 "public_key": p.public_key,
                 "preshared_key": self.preshared_key,
                 "endpoint_host": p.public_ip,
                 "endpoint_port": p.port,
-                "persistent_keepalive": 14,
-                "allowed_ips": [self.network]  # TODO: lock this down
-            } for p in self.peers]
+                "persistent_keepalive": self.persistent_keepalive,
+                "allowed_ips": allowed_ips(p)
+            } for p in self.peers],
+            **(self.relay_rules() if self.relay else {}),
         }
         return WireguardConfig.from_dict(c)
 
@@ -81,6 +114,7 @@ class TunnelRequest(SQLModel):
     """
     device_wg_public_key: str  # TODO: make this a WireguardKey
     network: IPv4Network
+    location_hint: Optional[str] = None  # a GCP region or zone, or an IANA timezone
 
     # The below permits us to use WireguardKey types.
     # model_config = SQLModelConfig(arbitrary_types_allowed=True)
@@ -109,7 +143,13 @@ class TunnelRequestTokenData(SQLModel):
     exp: int  # this is actually a epoch timestamp
 
 
-class DeviceTunnelLaunchDetails(SQLModel):
+class DeviceTunnelTelemetry(SQLModel):
+    """ Data sent from the device to the API describing how its tunnel is tuned. """
+    mtu: Optional[int] = None
+    keepalive: Optional[int] = None
+
+
+class DeviceTunnelLaunchDetails(DeviceTunnelTelemetry):
     """ Data sent from the device to the API, indicating its tunnel has launched
         and what support user is being used.
     """
@@ -127,6 +167,9 @@ class TunnelServerLaunchDetails(SQLModel):
     ts_instance_id: str
     ts_public_ip: IPv4Address
     support_secret_box: str
+    ts_ready_seconds: Optional[float] = None  # from launch (or claim) until it could be configured
+    ts_pooled: Optional[bool] = None  # whether it was claimed from the warm pool
+    ts_zone: Optional[str] = None
 
     # The below permits us to use WireguardKey types.
     model_config = SQLModelConfig(arbitrary_types_allowed=True)
@@ -136,6 +179,14 @@ class TunnelServerLaunchDetails(SQLModel):
         return str(k)
 
 
+class TunnelServerTelemetry(SQLModel):
+    """ Data sent from the support user's CLI to the API describing how the tunnel
+        server's side of a tunnel is tuned.
+    """
+    tunnel_id: UUID4
+    ts_keepalive: Optional[int] = None
+
+
 class TunnelServerLaunchDetailsResponse(SQLModel):
     """ Represents the data fetched from the API by the device, while it's
         polling for the tunnel server to be approved and come online.
@@ -148,6 +199,13 @@ class TunnelServerLaunchDetailsResponse(SQLModel):
     support_secret_box: Optional[str]
 
 
+class TunnelStatusesRequest(SQLModel):
+    """ Represents a device asking the API for the state of several of its tunnels
+        at once. Each token is the bearer token for one tunnel.
+    """
+    tokens: List[str]
+
+
 class SupportSecretBoxContents(SQLModel):
     """ Represents the contents of the secret box. Largely used to ensure that
         this data is somewhat sanitized.
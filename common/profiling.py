@@ -0,0 +1,130 @@
+""" Opt-in profiling of whole `inv` and `fab` task runs.
+
+    When a profile directory is configured, each task run is profiled with cProfile
+    and leaves two files behind: the raw profile (`.prof`, for pstats, snakeviz and
+    friends) and a JSON summary that splits the run's wall time between HTTP,
+    subprocesses and SSH, the database and crypto, and lists the most expensive
+    functions. The summary alone is usually enough to tell why a run was slow.
+
+    Only the outermost task of a run is profiled; tasks calling other tasks are
+    part of it.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import logging
+
+from time import perf_counter, strftime
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Functions where time spent enters each category, as (path fragment, function
+# name) pairs; a name of None takes every function under that path. A call from
+# one entry point of a category to another is only counted once.
+CATEGORIES: Dict[str, List[Tuple[str, Optional[str]]]] = {
+    "http": [
+        ("requests/sessions.py", "request"),
+    ],
+    "subprocess_ssh": [
+        ("invoke/runners.py", "run"),
+        ("subprocess.py", "run"),
+        ("subprocess.py", "call"),
+        ("subprocess.py", "check_call"),
+        ("subprocess.py", "check_output"),
+        ("paramiko/client.py", "connect"),
+        ("fabric/transfer.py", "get"),
+        ("fabric/transfer.py", "put"),
+    ],
+    "db": [
+        ("sqlalchemy/orm/session.py", "execute"),
+        ("sqlalchemy/orm/session.py", "commit"),
+        ("sqlalchemy/orm/session.py", "refresh"),
+        ("sqlalchemy/engine/create.py", "create_engine"),
+        ("sqlalchemy/sql/schema.py", "create_all"),
+        ("sqlite3.Connection", None),
+    ],
+    "crypto": [
+        ("common/crypto.py", None),
+        ("nacl/", None),
+        ("jose/", None),
+        ("wireguard_tools/wireguard_key.py", None),
+    ],
+}
+TOP_FUNCTIONS = 25
+
+_active = False
+
+
+def _matches(func: tuple, entry_points: List[Tuple[str, Optional[str]]]) -> bool:
+    filename, _, name = func
+    return any(fragment in (filename if filename != "~" else name) and (want is None or name == want)
+               for fragment, want in entry_points)
+
+
+def split_wall_time(stats: dict) -> Dict[str, float]:
+    """ Returns the seconds spent in each category, from pstats' raw stats. """
+    split = {}
+    for category, entry_points in CATEGORIES.items():
+        seconds = 0.0
+        for func, (_, _, _, _, callers) in stats.items():
+            if not _matches(func, entry_points):
+                continue
+            for caller, (_, _, _, cumulative) in callers.items():
+                if not _matches(caller, entry_points):
+                    seconds += cumulative
+        split[category] = round(seconds, 4)
+    return split
+
+
+def summarize(stats: dict, wall: float) -> dict:
+    split = split_wall_time(stats)
+    split["other"] = round(max(wall - sum(split.values()), 0), 4)
+    top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+    return {
+        "wall_seconds": round(wall, 4),
+        "split_seconds": split,
+        "top_cumulative": [{
+            "function": f"{filename}:{line}({name})",
+            "calls": calls,
+            "own_seconds": round(own, 4),
+            "cumulative_seconds": round(cumulative, 4),
+        } for (filename, line, name), (_, calls, own, cumulative, _) in top],
+    }
+
+
+@contextmanager
+def profiled(name: str, directory: Optional[str]) -> Iterator[None]:
+    """ Profiles the body into `directory` as `<name>-<time>-<pid>.prof` and `.json`,
+        if a directory is given and nothing is being profiled already.
+    """
+    global _active
+    if not directory or _active:
+        yield
+        return
+
+    import cProfile
+    import pstats
+
+    _active = True
+    profile = cProfile.Profile()
+    start = perf_counter()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        wall = perf_counter() - start
+        _active = False
+        try:
+            os.makedirs(directory, exist_ok=True)
+            base = os.path.join(directory, f"{name}-{strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+            profile.dump_stats(f"{base}.prof")
+            summary = summarize(pstats.Stats(profile).stats, wall)  # type: ignore[attr-defined]
+            with open(f"{base}.json", "w") as f:
+                json.dump({"task": name, "argv": sys.argv, **summary}, f, indent=2)
+            split = ", ".join(f"{category} {seconds:.2f}s" for category, seconds in summary["split_seconds"].items())
+            print(f"{name}: {wall:.2f}s ({split}); profile in {base}.prof", file=sys.stderr)
+        except OSError as e:
+            logging.warning(f"could not write the profile for {name}: {e}")
@@ -0,0 +1,146 @@
+import logging
+
+from threading import Lock
+from time import sleep, monotonic
+from urllib.parse import urlsplit
+from typing import Dict, Optional, NamedTuple
+
+from requests import Session, Response
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout
+
+from common import tracing
+from common.exceptions import ApiUnavailableException
+
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+class RetryPolicy(NamedTuple):
+    """ How hard to try a class of API calls before giving up. """
+    deadline: float  # seconds for the whole call, retries and backoff included
+    retries: int  # the retry budget: attempts beyond the first
+    backoff_factor: float = 1  # sleep backoff_factor * 2**(retry - 1) between attempts
+    attempt_timeout: float = 30  # seconds for a single attempt, if the caller sets no timeout
+    breaker_threshold: int = 3  # consecutive failures that open the circuit
+    breaker_cooldown: float = 30  # seconds the circuit stays open before letting a call through
+
+    def backoff(self, retry: int) -> float:
+        return self.backoff_factor * 2 ** (retry - 1)
+
+
+# Device cron jobs poll on a schedule; if this attempt fails, the next tick will try again.
+POLL = RetryPolicy(deadline=30, retries=2, attempt_timeout=10)
+# Someone is waiting at a terminal; fail fast and let them rerun the command.
+INTERACTIVE = RetryPolicy(deadline=20, retries=2, attempt_timeout=10)
+# Reports that follow expensive or hard to repeat work, like launching a tunnel server.
+CRITICAL = RetryPolicy(deadline=300, retries=8, backoff_factor=2, attempt_timeout=60, breaker_threshold=8)
+DEFAULT = RetryPolicy(deadline=60, retries=3, backoff_factor=2)
+
+
+class CircuitBreaker:
+    """ Tracks consecutive failures against a host, so that once it is known to be
+        down we stop waiting on it until a cooldown has passed. After the cooldown
+        one call is let through; if it succeeds, the circuit closes again.
+    """
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.lock = Lock()
+
+    def allow(self, policy: RetryPolicy) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if monotonic() - self.opened_at >= policy.breaker_cooldown:
+                # half-open: let this call through; a failure re-opens the circuit
+                self.opened_at = monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self, policy: RetryPolicy):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= policy.breaker_threshold:
+                self.opened_at = monotonic()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+
+class ApiSession(Session):
+    """ A requests Session that retries failed calls according to a RetryPolicy,
+        within the policy's deadline, and trips a per-host circuit breaker when
+        the API is down. Pass `policy=` to any request to pick its call class.
+        Each call is a span that carries its trace context to the API; see
+        common.tracing.
+    """
+    def __init__(self, default_policy: RetryPolicy = DEFAULT):
+        super().__init__()
+        self.default_policy = default_policy
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        host = urlsplit(url).netloc
+        return self.breakers.setdefault(host, CircuitBreaker())
+
+    def request(self, method, url, *args, policy: Optional[RetryPolicy] = None, **kwargs) -> Response:  # type: ignore[override]
+        attributes = {"http.method": method, "http.url": url}
+        with tracing.span(f"{method} {urlsplit(url).path}", tracing.SPAN_KIND_CLIENT, **attributes) as s:
+            kwargs["headers"] = tracing.inject(kwargs.get("headers"))
+            res = self.request_with_retries(method, url, *args, policy=policy or self.default_policy, **kwargs)
+            s.attributes["http.status_code"] = res.status_code
+            return res
+
+    def request_with_retries(self, method, url, *args, policy: RetryPolicy, **kwargs) -> Response:
+        breaker = self.breaker(url)
+        if not breaker.allow(policy):
+            raise ApiUnavailableException(f"{urlsplit(url).netloc} is unavailable; not calling {method} {url}")
+
+        start = monotonic()
+        deadline = start + policy.deadline
+        requested_timeout = kwargs.pop("timeout", None) or policy.attempt_timeout
+        retry = 0
+        while True:
+            kwargs["timeout"] = max(min(requested_timeout, deadline - monotonic()), 0.1)
+            try:
+                res = super().request(method, url, *args, **kwargs)
+                error: Optional[Exception] = None
+            except (RequestsConnectionError, Timeout) as e:
+                res = None
+                error = e
+
+            if res is not None and res.status_code not in RETRY_STATUSES:
+                breaker.record_success()
+                if retry:
+                    logging.warning(f"{method} {url} succeeded after {retry} retries and {monotonic() - start:.1f}s")
+                return res
+
+            breaker.record_failure(policy)
+            retry += 1
+            failure = error or f"HTTP {res.status_code if res is not None else '?'}"
+            delay = policy.backoff(retry)
+            if retry > policy.retries or monotonic() + delay >= deadline or breaker.is_open:
+                logging.warning(f"{method} {url} failed ({failure}); gave up after {retry - 1} retries and {monotonic() - start:.1f}s")
+                if res is not None:
+                    return res  # let the caller raise_for_status() as usual
+                assert error
+                raise error
+            logging.info(f"{method} {url} failed ({failure}); retry {retry}/{policy.retries} in {delay:.1f}s")
+            tracing.add_event("retry", retry=retry, failure=str(failure), delay=delay)
+            sleep(delay)
+
+    # The below mirror requests.Session's helpers, but accept `policy=`.
+    def get(self, url, **kwargs) -> Response:  # type: ignore[override]
+        kwargs.setdefault("allow_redirects", True)
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs) -> Response:  # type: ignore[override]
+        return self.request("POST", url, data=data, json=json, **kwargs)
+
+    def delete(self, url, **kwargs) -> Response:  # type: ignore[override]
+        return self.request("DELETE", url, **kwargs)
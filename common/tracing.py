@@ -0,0 +1,228 @@
+""" Lightweight, OpenTelemetry compatible tracing, shared by the device, the API and
+    the admin CLI, so that one tunnel's journey through all three can be followed.
+
+    Spans nest through a context variable, and cross process boundaries as a W3C
+    `traceparent` header on calls through common.session. Each span may carry a
+    `tunnel_id` attribute and `tunnel.state` events for the state transitions made
+    within it.
+
+    Nothing is exported unless configured. Set TRACE_FILE to append spans to a file
+    as OTLP/JSON lines (which the OpenTelemetry Collector's otlpjsonfile receiver
+    and most trace viewers import), and/or OTEL_EXPORTER_OTLP_ENDPOINT to send them
+    to an OTLP/HTTP collector. This module sticks to the standard library (plus
+    requests, for OTLP) so that devices, which run Python 3.7 and import this on
+    every `inv`, don't pay for an OpenTelemetry SDK.
+"""
+from __future__ import annotations
+
+import os
+import re
+import json
+import atexit
+import logging
+import threading
+
+from os import getenv
+from time import sleep, time_ns
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+# where to append finished spans, as OTLP/JSON lines
+TRACE_FILE = getenv("TRACE_FILE")
+# an OTLP/HTTP collector to send finished spans to, e.g. http://localhost:4318
+OTLP_ENDPOINT = getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+# spans are batched up for the collector for at most this many seconds
+OTLP_FLUSH_SECONDS = float(getenv("OTLP_FLUSH_SECONDS", 5))
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+STATUS_ERROR = 2
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+service_name = getenv("OTEL_SERVICE_NAME", "support-tunnel")
+
+
+class Span:
+    """ A unit of work, as OTLP describes one. """
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None,
+                 kind: int = SPAN_KIND_INTERNAL, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.events: List[dict] = []
+        self.error: Optional[str] = None
+        self.start = time_ns()
+        self.end: Optional[int] = None
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_otlp(self) -> dict:
+        otlp = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end or time_ns()),
+            "attributes": _otlp_attributes(self.attributes),
+            "events": [{"timeUnixNano": str(e["time"]), "name": e["name"], "attributes": _otlp_attributes(e["attributes"])}
+                       for e in self.events],
+        }
+        if self.parent_id:
+            otlp["parentSpanId"] = self.parent_id
+        if self.error:
+            otlp["status"] = {"code": STATUS_ERROR, "message": self.error}
+        return otlp
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[dict]:
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items() if v is not None]
+
+
+def set_service_name(name: str):
+    """ Names the process in exported traces, unless OTEL_SERVICE_NAME already has. """
+    global service_name
+    if not getenv("OTEL_SERVICE_NAME"):
+        service_name = name
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[Span]:
+    """ Returns a stand-in for the remote span a `traceparent` header names, or None
+        if it's missing or malformed.
+    """
+    match = TRACEPARENT.match((header or "").strip())
+    if not match:
+        return None
+    remote = Span("remote", match.group(1))
+    remote.span_id = match.group(2)
+    return remote
+
+
+@contextmanager
+def span(name: str, kind: int = SPAN_KIND_INTERNAL, parent: Optional[Span] = None, **attributes) -> Iterator[Span]:
+    """ Runs the body in a new span, a child of `parent` or else of the current span.
+        An exception escaping the body marks the span as failed.
+    """
+    parent = parent or _current_span.get()
+    s = Span(name, parent.trace_id if parent else os.urandom(16).hex(), parent.span_id if parent else None,
+             kind, attributes)
+    token = _current_span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        s.end = time_ns()
+        export(s)
+
+
+def set_attributes(**attributes):
+    """ Adds attributes to the current span, if there is one. """
+    s = _current_span.get()
+    if s:
+        s.attributes.update(attributes)
+
+
+def add_event(name: str, **attributes):
+    s = _current_span.get()
+    if s:
+        s.events.append({"time": time_ns(), "name": name, "attributes": attributes})
+
+
+def _state_name(state: Any) -> Any:
+    return getattr(state, "name", state)
+
+
+def record_state(tunnel_id: Any, old: Any, new: Any):
+    """ Tags the current span with a tunnel and records its move between states. """
+    set_attributes(tunnel_id=str(tunnel_id), **{"tunnel.state": _state_name(new)})
+    add_event("tunnel.state", tunnel_id=str(tunnel_id), **{"from": _state_name(old), "to": _state_name(new)})
+
+
+def inject(headers: Optional[dict]) -> dict:
+    """ Returns `headers` with the current span's context added, for an outgoing request. """
+    s = _current_span.get()
+    if not s:
+        return headers or {}
+    return {**(headers or {}), "traceparent": s.traceparent}
+
+
+class _Exporter:
+    """ Writes spans to TRACE_FILE as they finish, and batches them up for the OTLP
+        collector, flushing from a background thread and at exit.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending: List[Span] = []
+        self.flusher: Optional[threading.Thread] = None
+
+    def batch(self, spans: List[Span]) -> dict:
+        return {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": service_name, "process.pid": os.getpid()})},
+            "scopeSpans": [{"scope": {"name": "support_tunnel"}, "spans": [s.to_otlp() for s in spans]}],
+        }]}
+
+    def export(self, s: Span):
+        if TRACE_FILE:
+            line = json.dumps(self.batch([s]))
+            with self.lock, open(TRACE_FILE, "a") as f:
+                f.write(line + "\n")
+        if OTLP_ENDPOINT:
+            with self.lock:
+                self.pending.append(s)
+                if not self.flusher:
+                    self.flusher = threading.Thread(target=self.flush_periodically, daemon=True)
+                    self.flusher.start()
+                    atexit.register(self.flush)
+
+    def flush_periodically(self):
+        while True:
+            sleep(OTLP_FLUSH_SECONDS)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            spans, self.pending = self.pending, []
+        if not spans:
+            return
+        # not through common.session: that would trace itself, and a collector
+        # being down shouldn't trip the API's circuit breaker
+        import requests
+        try:
+            requests.post(f"{OTLP_ENDPOINT.rstrip('/')}/v1/traces", json=self.batch(spans), timeout=5)  # type: ignore[union-attr]
+        except Exception as e:
+            logging.debug(f"could not export {len(spans)} spans: {e}")
+
+
+_exporter = _Exporter()
+
+
+def export(s: Span):
+    if TRACE_FILE or OTLP_ENDPOINT:
+        _exporter.export(s)
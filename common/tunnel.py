@@ -1,20 +1,25 @@
 import io
 import random
+import select
 import socket
 import logging
 
-from typing import List, Union
-from ipaddress import IPv4Network, IPv4Interface
+from time import monotonic
+from typing import Dict, List, Set, Union, Optional, TYPE_CHECKING
+from ipaddress import IPv4Address, IPv4Network, IPv4Interface
 
-from pyroute2 import IPRoute
-from fabric import Connection as FabricConnection
-
-from common.models import WireguardTunnel
 from device.local_context import LocalContext
+from common.constants import WG_MTU_OVERHEAD, WG_MIN_MTU, WG_MAX_KEEPALIVE, NAT_PROBE_PORT
+
+if TYPE_CHECKING:
+    from fabric import Connection as FabricConnection
+    from common.models import WireguardTunnel
 
 
 def get_current_routes() -> List[IPv4Network]:
     """ Return the current routes on a device. """
+    from pyroute2 import IPRoute
+
     ipr = IPRoute()
     current_routes = ipr.get_routes(family=socket.AF_INET)
     # pyroute2's representation of routes is closer to the OS than
@@ -66,7 +71,88 @@ def allocate_address_space() -> IPv4Network:
     raise Exception("No usable networks found.")
 
 
-def write_wireguard_config(c: Union[LocalContext, FabricConnection], t: WireguardTunnel):
+def probe_path_mtu(c: Union[LocalContext, "FabricConnection"], host: IPv4Address, low: int = WG_MIN_MTU, high: int = 1500) -> Optional[int]:
+    """ Finds the largest IPv4 packet that reaches `host` without fragmenting,
+        by binary searching over don't-fragment pings. Returns None if not even
+        `low` gets through, for example because ICMP is filtered somewhere.
+    """
+    def fits(size: int) -> bool:
+        # 28 bytes of IPv4 + ICMP headers on top of the ping payload
+        res = c.run(f"ping -M do -c 1 -W 1 -s {size - 28} {host}", warn=True, hide="both")
+        return bool(res and res.ok)
+
+    if not fits(low):
+        logging.warning(f"path MTU probe to {host} failed at {low} bytes; is ICMP filtered?")
+        return None
+    while low < high:
+        mid = (low + high + 1) // 2
+        if fits(mid):
+            low = mid
+        else:
+            high = mid - 1
+    logging.debug(f"path MTU to {host}: {low}")
+    return low
+
+
+def tunnel_mtu(path_mtu: int) -> int:
+    """ Returns the WireGuard interface MTU to use over a path with the given MTU. """
+    return max(WG_MIN_MTU, path_mtu - WG_MTU_OVERHEAD)
+
+
+def probe_nat_binding_lifetime(ts_public_ip: IPv4Address, max_seconds: int = WG_MAX_KEEPALIVE, step_seconds: int = 30, port: int = NAT_PROBE_PORT, grace_seconds: int = 5) -> int:
+    """ Measures how long the NAT in front of this host keeps an idle UDP binding
+        open, against the echo service on a tunnel server. Returns seconds, capped at
+        `max_seconds`.
+
+        Each candidate lifetime gets a socket, and so a binding, of its own: we send
+        one datagram asking to have it echoed back after that many seconds, and the
+        echo only gets back in if the binding outlived the wait. All candidates are
+        probed at once. The tunnel's own WireGuard traffic, keepalives from either
+        end included, travels on another binding and can't refresh these. Echoes
+        more than `grace_seconds` late count as lost.
+    """
+    delays = [0] + list(range(step_seconds, max_seconds, step_seconds)) + [max_seconds]
+    sockets: Dict[socket.socket, int] = {}
+    echoed: Set[int] = set()
+    try:
+        for delay in delays:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setblocking(False)
+            sockets[s] = delay
+            message = f"st-nat-probe {delay} {random.getrandbits(64):x}".encode()
+            # twice, so a single lost datagram isn't mistaken for an expired binding
+            s.sendto(message, (str(ts_public_ip), port))
+            s.sendto(message, (str(ts_public_ip), port))
+        start = monotonic()
+        while True:
+            missing = [d for d in delays if d not in echoed]
+            # the shortest wait to go unanswered settles it; longer ones can't count
+            if not missing or monotonic() - start > missing[0] + grace_seconds:
+                break
+            waiting = [s for s, d in sockets.items() if d not in echoed]
+            readable, _, _ = select.select(waiting, [], [], max(start + missing[0] + grace_seconds - monotonic(), 0))
+            for s in readable:
+                try:
+                    s.recv(64)
+                except OSError:
+                    continue
+                echoed.add(sockets[s])
+    finally:
+        for s in sockets:
+            s.close()
+
+    if 0 not in echoed:
+        raise RuntimeError(f"no answer from the NAT probe echo service on {ts_public_ip}:{port}")
+    lifetime = 0
+    for delay in delays:
+        if delay not in echoed:
+            break
+        lifetime = delay
+    logging.debug(f"NAT binding lifetime towards {ts_public_ip}: at least {lifetime}s")
+    return lifetime
+
+
+def write_wireguard_config(c: Union[LocalContext, "FabricConnection"], t: "WireguardTunnel"):
     """ Writes a wireguard config to disk. """
     logging.debug(
         f"writing wireguard config for interface {t.interface} to disk...")
@@ -81,7 +167,7 @@ def write_wireguard_config(c: Union[LocalContext, FabricConnection], t: Wireguar
     c.run(f"sudo chmod 0500 /etc/wireguard/{t.interface}.conf")
 
 
-def start_wireguard_tunnel(c: Union[LocalContext, FabricConnection], t: WireguardTunnel):
+def start_wireguard_tunnel(c: Union[LocalContext, "FabricConnection"], t: "WireguardTunnel"):
     """ Starts a wireguard tunnel using an invoke context. The
         invoke context allows this to be run on local or remote.
         This assumes the host in question has a local wireguard config already.
@@ -120,3 +206,10 @@ def server_ip(net: IPv4Network) -> IPv4Interface:
         the second host address.
     """
     return host_in_network(1, net)
+
+
+def admin_ip(net: IPv4Network) -> IPv4Interface:
+    """ Returns the address of an admin workstation that joins the tunnel as a peer
+        of the server; the third host address.
+    """
+    return host_in_network(2, net)
@@ -6,27 +6,27 @@ from pathlib import Path
 from functools import lru_cache
 from secrets import token_hex as secret_token
 from datetime import datetime, timezone, timedelta
+from typing import Union, Optional, TYPE_CHECKING
 
-from urllib3.util import Retry
-from requests import Session
-from requests.adapters import HTTPAdapter
-from fabric.connection import Connection
-from typing import Union, Optional
-
-from common.models import SupportUser
+from common.session import ApiSession
 from device.local_context import LocalContext
 from common.constants import TUNNEL_EXPIRY_MINS, SSH_KEYFILE_PATH
 
-api = Session()
-retries = Retry(
-    total=10,
-    backoff_factor=2,
-    status_forcelist=[500, 502, 503, 504],
-    allowed_methods=None,  # TODO: strive towards idempotency
-)
-api.mount("https://", HTTPAdapter(max_retries=retries))
-
-def create_group(c: Union[LocalContext, Connection], group_name: str = "support"):
+# Fabric (and through it paramiko) and the pydantic models are expensive to
+# import; devices import this module on every `inv` run, so only pull them in
+# where they are actually used.
+if TYPE_CHECKING:
+    from fabric.connection import Connection
+    from common.models import SupportUser
+    from sqlalchemy import Table
+    from sqlalchemy.engine import Engine
+
+# Shared by the device and admin CLIs. Retries, deadlines and circuit breaking are
+# governed by the RetryPolicy passed with each call; see common.session.
+# TODO: strive towards idempotency; POSTs are retried too.
+api = ApiSession()
+
+def create_group(c: Union[LocalContext, "Connection"], group_name: str = "support"):
     """ Creates a group for the support user(s). """
     logging.debug(f"creating a Unix group: {group_name}")
     # -f allows this command to complete successfully if this group already exists.
@@ -34,7 +34,7 @@ def create_group(c: Union[LocalContext, Connection], group_name: str = "support"
     # exist.
     c.run(f"sudo groupadd -f {group_name}")
 
-def create_sshkey(c: Union[LocalContext, Connection], dest: Path = SSH_KEYFILE_PATH) -> str:
+def create_sshkey(c: Union[LocalContext, "Connection"], dest: Path = SSH_KEYFILE_PATH) -> str:
     """ Creates an SSH pub/priv keypair and places them at the specified destination. Returns the pubkey"""
     c.run(f"sudo mkdir -p {str(dest.parent)}")
     c.run(f"sudo chmod 0777 {str(dest.parent)}")
@@ -44,8 +44,10 @@ def create_sshkey(c: Union[LocalContext, Connection], dest: Path = SSH_KEYFILE_P
     assert pubkey
     return pubkey.stdout
 
-def create_user(c: Union[LocalContext, Connection], username: Optional[str] = None, username_prefix: str = "support", group_name: str = "support") -> SupportUser:
+def create_user(c: Union[LocalContext, "Connection"], username: Optional[str] = None, username_prefix: str = "support", group_name: str = "support") -> "SupportUser":
     """ Creates a user for support to use. """
+    from common.models import SupportUser
+
     logging.debug("creating a Unix user")
     if username:
         name = username
@@ -68,7 +70,7 @@ def create_user(c: Union[LocalContext, Connection], username: Optional[str] = No
     return SupportUser(username=name, group=group_name)
 
 
-def delete_user(c: Union[LocalContext, Connection], username: str):
+def delete_user(c: Union[LocalContext, "Connection"], username: str):
     """ Deletes a user. """
     logging.debug(f"deleting user {username}")
 
@@ -81,7 +83,7 @@ def delete_user(c: Union[LocalContext, Connection], username: str):
     c.run(f"sudo userdel -rf {username}", warn=True)
 
 
-def add_authorized_key(c: Union[LocalContext, Connection], user: SupportUser, authorized_key: str):
+def add_authorized_key(c: Union[LocalContext, "Connection"], user: "SupportUser", authorized_key: str):
     """ Add an authorized key to a user. """
     c.run(f"sudo mkdir -p /home/{user.username}/.ssh")
     c.run(
@@ -91,6 +93,22 @@ def add_authorized_key(c: Union[LocalContext, Connection], user: SupportUser, au
     c.run(f"sudo chmod 0600 /home/{user.username}/.ssh/authorized_keys")
 
 
+def add_missing_columns(engine: "Engine", table: "Table"):
+    """ `create_all()` only creates missing tables, and databases outlive upgrades.
+        Add any (nullable) columns that were introduced since the table was first
+        created.
+    """
+    from sqlalchemy import inspect, text
+
+    existing = {c['name'] for c in inspect(engine).get_columns(table.name)}
+    with engine.begin() as conn:
+        for column in table.columns:
+            if column.name not in existing:
+                logging.info(f"adding column {column.name} to {table.name}")
+                column_type = column.type.compile(engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+
 def expiry_datetime():
     """ returns a datetime representing an expiry time TUNNEL_EXPIRY_MINS in the the future """
     return datetime.now(timezone.utc) + timedelta(minutes=TUNNEL_EXPIRY_MINS)
@@ -1,33 +1,42 @@
+from __future__ import annotations
+
 import os
+import sys
 import json
 import random
 import logging
 import subprocess
 import configparser
 
-from jose import jwt
 from os import getenv
 from uuid import UUID
-from time import sleep
+from time import sleep, perf_counter
 from pathlib import Path
 from datetime import datetime
-from ipaddress import IPv4Network
+from functools import lru_cache
+from ipaddress import IPv4Address, IPv4Network
+from typing import Optional, TYPE_CHECKING
 
-from invoke import task
-from pydantic import UUID4
-from systemd import journal
-from requests import HTTPError
-from sqlmodel import Session, select
-from wireguard_tools import WireguardKey
+from invoke import task, Task
 
+from common import tracing
+from common.profiling import profiled
 from common.tunnel import device_ip
-from common.crypto import open_secret_box
 from device.local_context import LocalContext
-from device.models import DeviceTunnel, engine
 from common.exceptions import TunnelExpiredException, InvalidTunnelStateException
+from common.session import POLL, CRITICAL
 from common.util import api, create_user, delete_user, add_authorized_key
-from common.tunnel import allocate_address_space, write_wireguard_config, start_wireguard_tunnel
-from common.models import TunnelRequest, TunnelRequestTokenData, Token, TunnelServerLaunchDetailsResponse, DeviceTunnelLaunchDetails, TunnelState
+
+# Every cron tick and updater action runs `inv`, so this module is imported far
+# more often than any one task actually runs. Anything heavy (pydantic/sqlmodel,
+# jose, wireguard_tools, pyroute2, the systemd journal and the database itself)
+# is imported inside the tasks that need it; see `startup_profile` and
+# `startup_budget` to keep an eye on this.
+if TYPE_CHECKING:
+    from pydantic import UUID4
+    from sqlmodel import Session
+    from device.models import DeviceTunnel
+    from common.models import TunnelServerLaunchDetailsResponse, TunnelState
 
 config = configparser.ConfigParser()
 potential_config_files = [
@@ -62,12 +71,44 @@ SUPPORT_TUNNEL_API = getenv(
 
 DEBUG = getenv("DEBUG", config['device'].getboolean('debug', False))
 
-logging_handlers = [
-  journal.JournalHandler(SYSLOG_IDENTIFIER='support_tunnel'),
-  logging.StreamHandler()
-]
+# Where to write a profile of every task run, if set; see common.profiling.
+PROFILE_DIR = getenv("PROFILE_DIR", config['device'].get('profile-dir', None))
+
+# The maximum time, in milliseconds, that a cold `inv --list` may take; see `startup_budget`.
+STARTUP_BUDGET_MS = int(getenv(
+    "STARTUP_BUDGET_MS",
+    config['device'].getint('startup-budget-ms', 1500)
+))
+
+
+@lru_cache(1)
+def setup_logging():
+    """ Configures logging to the journal and stdout. This is called when a task
+        first runs rather than at import time, since importing the systemd journal
+        bindings isn't free.
+    """
+    from systemd import journal
+
+    logging_handlers = [
+      journal.JournalHandler(SYSLOG_IDENTIFIER='support_tunnel'),
+      logging.StreamHandler()
+    ]
+
+    logging.basicConfig(level=logging.DEBUG if DEBUG else logging.INFO, handlers=logging_handlers)
+
+
+class DeviceTask(Task):
+    """ An invoke Task that performs the device's one-time setup before running its
+        body, and traces the body; see common.tracing. With PROFILE_DIR set, the
+        body is profiled too; see common.profiling.
+    """
+    def __call__(self, *args, **kwargs):
+        setup_logging()
+        tracing.set_service_name("support-tunnel-device")
+        with tracing.span(f"inv {self.name}", tunnel_id=kwargs.get("tunnel_id")), \
+                profiled(f"inv-{self.name}", PROFILE_DIR):
+            return super().__call__(*args, **kwargs)
 
-logging.basicConfig(level=logging.DEBUG if DEBUG else logging.INFO, handlers=logging_handlers)
 
 def print_log_error(e: Exception, msg: str):
     """ Little helper function to emit errors to both stdout and logging.
@@ -102,13 +143,58 @@ def run_script_hook(script_string: str, tunnel: DeviceTunnel):
         print_log_error(e, "failure running script hook")
 
 
+def choose_mtu(c: LocalContext, tunnel: DeviceTunnel) -> Optional[int]:
+    """ Picks the MTU for a tunnel's interface. An `mtu` set in the config file
+        wins; otherwise, if `probe-mtu` is enabled, measure the path MTU to the
+        tunnel server. Returns None to leave the choice to wg-quick.
+    """
+    from common.tunnel import probe_path_mtu, tunnel_mtu
+
+    if 'mtu' in config['device']:
+        return config['device'].getint('mtu')
+    if config['device'].getboolean('probe-mtu', False) and tunnel.ts_public_ip:
+        path_mtu = probe_path_mtu(c, tunnel.ts_public_ip)
+        if path_mtu:
+            return tunnel_mtu(path_mtu)
+    return None
+
+
+def adaptive_keepalive() -> bool:
+    """ Whether keepalive intervals should be tuned to the local NAT; see `tune_keepalive`. """
+    return config['device'].get('keepalive', '').strip() == 'adaptive'
+
+
+def choose_keepalive() -> Optional[int]:
+    """ Returns the configured keepalive interval, or None to use the default.
+        In adaptive mode tunnels start with the default until they are tuned.
+    """
+    if 'keepalive' in config['device'] and not adaptive_keepalive():
+        return config['device'].getint('keepalive')
+    return None
+
+
+def location_hint() -> Optional[str]:
+    """ A hint about where this device is, so support can place its tunnel server
+        nearby: the configured location-hint, or else the local timezone.
+    """
+    if 'location-hint' in config['device']:
+        return config['device'].get('location-hint')
+    try:
+        return Path('/etc/timezone').read_text().strip() or None
+    except OSError:
+        return None
+
+
 def get_device_tunnel(tunnel_id: UUID4, sesh: Session) -> DeviceTunnel:
     """ Utility function to return a device tunnel instance from the DB """
+    from sqlmodel import select
+    from device.models import DeviceTunnel
+
     stmt = select(DeviceTunnel).where(DeviceTunnel.tunnel_id == tunnel_id)
     return sesh.exec(stmt).one()
 
 
-@task
+@task(klass=DeviceTask)
 def request(c) -> UUID4:
     """ Request a support tunnel
 
@@ -116,6 +202,15 @@ def request(c) -> UUID4:
 
         Returns the tunnel_id.
     """
+    from jose import jwt
+    from requests import HTTPError
+    from sqlmodel import Session
+    from wireguard_tools import WireguardKey
+
+    from device.models import DeviceTunnel, get_engine
+    from common.tunnel import allocate_address_space
+    from common.models import TunnelRequest, TunnelRequestTokenData, Token
+
     try:
         logging.info("generating wireguard keys & allocating address space.")
         device_wg_private_key = WireguardKey.generate()
@@ -129,11 +224,13 @@ def request(c) -> UUID4:
         logging.info(f"sending tunnel request to {SUPPORT_TUNNEL_API}")
         post_data = TunnelRequest(
             device_wg_public_key=str(device_wg_public_key),
-            network=network
+            network=network,
+            location_hint=location_hint()
         ).model_dump_json()
         logging.debug(f"post_data: {post_data}")
         res = api.post(
-            f"{SUPPORT_TUNNEL_API}/device/tunnel/request", data=post_data, timeout=60)
+            f"{SUPPORT_TUNNEL_API}/device/tunnel/request", data=post_data,
+            headers={"Content-Type": "application/json"}, timeout=60)
         res.raise_for_status()
     except HTTPError as e:
         print_log_error(e, f"could not POST request: {res.reason}, {res.text}")
@@ -184,7 +281,8 @@ def request(c) -> UUID4:
             network=str(network),
             port=port
         )
-        with Session(engine) as sesh:
+        tracing.record_state(t.tunnel_id, None, t.state)
+        with Session(get_engine()) as sesh:
             sesh.add(t)
             sesh.commit()
             print(f"tunnel_id: {t.tunnel_id}")
@@ -197,17 +295,24 @@ def request(c) -> UUID4:
 
 def get_tunnel_details(tunnel: DeviceTunnel) -> TunnelServerLaunchDetailsResponse:
     """ Utility function to request tunnel details from upstream """
+    from common.models import TunnelServerLaunchDetailsResponse
+
     logging.info(f"get_tunnel_details() called for {tunnel.tunnel_id}")
     headers = {"Authorization": f"Bearer {tunnel.token}"}
     res = api.get(f"{SUPPORT_TUNNEL_API}/device/tunnel/details",
-                  headers=headers, timeout=60)
+                  headers=headers, timeout=60, policy=POLL)
     res.raise_for_status()
     logging.debug(f"get_tunnel_details: {res.text}")
     return TunnelServerLaunchDetailsResponse(**json.loads(res.text))
 
 def request_tunnel_server_details(tunnel_id: UUID4):
     """ Request tunnel server details. Bails if the tunnel server has not launched yet."""
-    with Session(engine) as sesh:
+    from sqlmodel import Session
+
+    from device.models import get_engine
+    from common.models import TunnelState
+
+    with Session(get_engine()) as sesh:
         t = get_device_tunnel(tunnel_id, sesh)
         tunnel_details = get_tunnel_details(t)
 
@@ -227,7 +332,7 @@ def request_tunnel_server_details(tunnel_id: UUID4):
     assert tunnel_details.ts_wg_port
     assert tunnel_details.support_secret_box
 
-    with Session(engine) as sesh:
+    with Session(get_engine()) as sesh:
         t = get_device_tunnel(tunnel_id, sesh)
         t.ts_wg_public_key = tunnel_details.ts_wg_public_key
         # We want to be explicit about checking our inputs as ipv4... but for whatever reason
@@ -241,18 +346,37 @@ def request_tunnel_server_details(tunnel_id: UUID4):
 
 def send_connected_status_to_api(t: DeviceTunnel):
     """ Send connection details back to API. """
+    from common.models import DeviceTunnelLaunchDetails
+
     post_data = DeviceTunnelLaunchDetails(**t.dict())
     auth_headers = {"Authorization": f"Bearer {t.token}"}
     res = api.post(f"{SUPPORT_TUNNEL_API}/device/tunnel/details",
-                   json=post_data.dict(), headers=auth_headers, timeout=60)
+                   json=post_data.dict(), headers=auth_headers, timeout=60, policy=CRITICAL)
+    res.raise_for_status()
+
+def send_telemetry_to_api(t: DeviceTunnel):
+    """ Send how the tunnel is tuned back to the API. """
+    from common.models import DeviceTunnelTelemetry
+
+    post_data = DeviceTunnelTelemetry(**t.dict())
+    auth_headers = {"Authorization": f"Bearer {t.token}"}
+    res = api.post(f"{SUPPORT_TUNNEL_API}/device/tunnel/telemetry",
+                   json=post_data.dict(), headers=auth_headers, timeout=60, policy=POLL)
     res.raise_for_status()
 
-@task
+@task(klass=DeviceTask)
 def connect(original_context, tunnel_id: UUID4):
     """ Creates a support user and connects to the specified tunnel
         over Wireguard. We use two SQL sessions here in case we end up
         bailing halfway through, and need to clean up user accounts later.
     """
+    from sqlmodel import Session
+
+    from device.models import get_engine
+    from common.models import TunnelState
+    from common.crypto import open_secret_box
+    from common.tunnel import write_wireguard_config, start_wireguard_tunnel
+
     # create our own local context; this permits us to `.put` on localhost,
     # without using Fabric.
     c = LocalContext(original_context)
@@ -269,7 +393,7 @@ def connect(original_context, tunnel_id: UUID4):
     # Begin spinning up all our local config. Create a user.
     try:
         user = create_user(c)
-        with Session(engine) as sesh:
+        with Session(get_engine()) as sesh:
             t1 = get_device_tunnel(tunnel_id, sesh)
             t1.support_user = user.username
             sesh.add(t1)
@@ -286,9 +410,13 @@ def connect(original_context, tunnel_id: UUID4):
             add_authorized_key(c, user, sb.support_ssh_pubkey)
 
         # ... and finally write our tunnel config and start it.
-        with Session(engine) as sesh:
+        with Session(get_engine()) as sesh:
             t2 = get_device_tunnel(tunnel_id, sesh)
 
+            t2.mtu = choose_mtu(c, t2)
+            logging.info(f"using MTU {t2.mtu or 'chosen by wg-quick'} for {t2.interface}")
+            t2.keepalive = choose_keepalive()
+
             # run pre-up script
             if 'pre-up-script' in config['device']:
                 run_script_hook(config['device']['pre-up-script'], t2)
@@ -299,6 +427,7 @@ def connect(original_context, tunnel_id: UUID4):
             # and start it
             start_wireguard_tunnel(c, t2.to_WireguardTunnel())
 
+            tracing.record_state(tunnel_id, t2.state, TunnelState.running)
             t2.state = TunnelState.running
             sesh.add(t2)
             sesh.commit()
@@ -316,26 +445,41 @@ def connect(original_context, tunnel_id: UUID4):
         logging.error("exiting.")
         raise e
 
-@task
-def stop(c, tunnel_id: UUID4, tunnel_state: TunnelState = TunnelState.completed):
-    """ Stops & cleans up device-side resources associated with a tunnel """
-    with Session(engine) as sesh:
-        t = get_device_tunnel(tunnel_id, sesh)
+def stop_local_resources(c, t: DeviceTunnel, tunnel_state: TunnelState):
+    """ Removes a tunnel's support user and WireGuard interface, and marks it stopped.
+        The caller is responsible for committing `t`.
+    """
+    # run pre-down script
+    if 'pre-down-script' in config['device']:
+        run_script_hook(config['device']['pre-down-script'], t)
 
-        # run pre-down script
-        if 'pre-down-script' in config['device']:
-            run_script_hook(config['device']['pre-down-script'], t)
+    if t.support_user:
+        delete_user(c, t.support_user)
 
-        if t.support_user:
-            delete_user(c, t.support_user)
+    if t.interface:
+        c.run(f"sudo systemctl stop wg-quick@{t.interface}", warn=True)
+        c.run(f"sudo systemctl disable wg-quick@{t.interface}", warn=True)
+        c.run(f"sudo rm -f /etc/wireguard/{t.interface}.conf", warn=True)
 
-        if t.interface:
-            c.run(f"sudo systemctl stop wg-quick@{t.interface}", warn=True)
-            c.run(f"sudo systemctl disable wg-quick@{t.interface}", warn=True)
-            c.run(f"sudo rm -f /etc/wireguard/{t.interface}.conf", warn=True)
+    tracing.record_state(t.tunnel_id, t.state, tunnel_state)
+    t.state = tunnel_state
+    t.stopped_at = datetime.now()
 
-        t.state = tunnel_state
-        t.stopped_at = datetime.now()
+
+@task(klass=DeviceTask)
+def stop(c, tunnel_id: UUID4, tunnel_state: Optional[int] = None):
+    """ Stops & cleans up device-side resources associated with a tunnel """
+    from sqlmodel import Session
+
+    from device.models import get_engine
+    from common.models import TunnelState
+
+    if tunnel_state is None:
+        tunnel_state = TunnelState.completed
+
+    with Session(get_engine()) as sesh:
+        t = get_device_tunnel(tunnel_id, sesh)
+        stop_local_resources(c, t, TunnelState(tunnel_state))
         sesh.add(t)
         sesh.commit()
 
@@ -355,7 +499,58 @@ def stop(c, tunnel_id: UUID4, tunnel_state: TunnelState = TunnelState.completed)
 
 
 
-@task
+@task(klass=DeviceTask)
+def tune_keepalive(original_context, tunnel_id: Optional[UUID4] = None):
+    """ Backs a tunnel's keepalive off as far as the local NAT allows.
+
+        This measures how long the NAT keeps a UDP binding open while idle, against
+        the tunnel server's echo service, and settles on a fraction of that; the
+        tunnel server follows suit on the admin's next `fab tune-keepalive` or
+        `fab connect`. This takes up to WG_MAX_KEEPALIVE seconds per tunnel. Without a
+        tunnel_id, tunes every running tunnel that has not been tuned yet, if
+        `keepalive=adaptive` is configured.
+    """
+    from sqlmodel import Session, select
+
+    from common.models import TunnelState
+    from device.models import DeviceTunnel, get_engine
+    from common.tunnel import probe_nat_binding_lifetime, write_wireguard_config
+    from common.constants import WG_DEFAULT_KEEPALIVE, WG_MAX_KEEPALIVE, WG_KEEPALIVE_SAFETY_FACTOR
+
+    c = LocalContext(original_context)
+    with Session(get_engine()) as sesh:
+        if tunnel_id:
+            tunnels = [get_device_tunnel(tunnel_id, sesh)]
+        elif adaptive_keepalive():
+            stmt = select(DeviceTunnel)\
+                .where(DeviceTunnel.state == TunnelState.running)\
+                .where(DeviceTunnel.keepalive == None)  # noqa: E711
+            tunnels = list(sesh.exec(stmt).all())
+        else:
+            logging.debug("adaptive keepalive is not configured; nothing to tune")
+            return
+
+        for t in tunnels:
+            try:
+                lifetime = probe_nat_binding_lifetime(IPv4Address(t.ts_public_ip))
+                keepalive = int(lifetime * WG_KEEPALIVE_SAFETY_FACTOR)
+                t.keepalive = min(max(keepalive, WG_DEFAULT_KEEPALIVE), WG_MAX_KEEPALIVE)
+                logging.info(f"NAT binding for {t.interface} lasts {lifetime}s; keepalive set to {t.keepalive}s")
+
+                wg_tunnel = t.to_WireguardTunnel()
+                c.run(f"sudo wg set {t.interface} peer {t.ts_wg_public_key} persistent-keepalive {t.keepalive}")
+                # keep the on-disk config in step, so the interval survives a restart
+                write_wireguard_config(c, wg_tunnel)
+                sesh.add(t)
+                sesh.commit()
+                sesh.refresh(t)
+
+                send_telemetry_to_api(t)
+            except Exception as e:
+                print_log_error(e, f"unable to tune keepalive for tunnel {t.tunnel_id}")
+
+
+@task(klass=DeviceTask)
 def request_and_connect(c):
     """ Request a support tunnel, and wait until connected. """
     print("requesting a tunnel...")
@@ -364,20 +559,29 @@ def request_and_connect(c):
     connect(c, tunnel_id)
 
 
-@task
+@task(klass=DeviceTask)
 def list_all_tunnels(c):
     """ Lists all tunnel IDs in the local database. Returns a tunnel ID per line. """
-    with Session(engine) as sesh:
+    from sqlmodel import Session, select
+
+    from device.models import DeviceTunnel, get_engine
+
+    with Session(get_engine()) as sesh:
         stmt = select(DeviceTunnel)
         raw_tunnels = sesh.exec(stmt).all()
         for t in raw_tunnels:
             print(f"{t.tunnel_id}")
 
 
-@task
+@task(klass=DeviceTask)
 def list_running_tunnels(c):
     """ Lists all tunnels whose state is not completed or timedout. """
-    with Session(engine) as sesh:
+    from sqlmodel import Session, select
+
+    from common.models import TunnelState
+    from device.models import DeviceTunnel, get_engine
+
+    with Session(get_engine()) as sesh:
         stmt = select(DeviceTunnel)\
             .where(DeviceTunnel.state != TunnelState.completed)\
             .where(DeviceTunnel.state != TunnelState.timedout)
@@ -386,13 +590,17 @@ def list_running_tunnels(c):
             print(f"{t.tunnel_id} {t.state}")
 
 
-@task
+@task(klass=DeviceTask)
 def detail_all_tunnels(c):
     """ Dumps all tunnel details in the local database. Returns JSON. """
+    from sqlmodel import Session, select
+
+    from device.models import DeviceTunnel, get_engine
+
     # This is a hack; Pydantic is capable of serializing more things than
     # json.dumps(), btu because we can only dump one thing at a time
     # we cast back & forth to produce raw JSON to the console.
-    with Session(engine) as sesh:
+    with Session(get_engine()) as sesh:
         stmt = select(DeviceTunnel)
         raw_tunnels = sesh.exec(stmt).all()
         tunnels = []
@@ -401,34 +609,87 @@ def detail_all_tunnels(c):
         print(json.dumps(tunnels))
 
 
-def update_local_tunnel_statuses():
-    """ Updates local tunnel statuses from upstream
-    TODO: implement this
-    with Session(engine) as sesh:
-        t = get_device_tunnel(tunnel_id, sesh)
-        tunnel_details = get_tunnel_details(t)
+@task(klass=DeviceTask)
+def update_local_tunnel_statuses(c):
+    """ Updates local tunnel statuses from upstream, in a single request.
+
+        Tunnels that upstream has completed or timed out (for example, an admin
+        ran `fab stop`) are torn down locally. Tunnels still pending locally are
+        left for `connect_approved_tunnels` to pick up.
     """
-    pass
+    from sqlmodel import Session, select
+
+    from common.models import TunnelState, TunnelStatusesRequest, TunnelServerLaunchDetailsResponse
+    from device.models import DeviceTunnel, get_engine
+
+    with Session(get_engine()) as sesh:
+        stmt = select(DeviceTunnel)\
+            .where(DeviceTunnel.expires > datetime.now())\
+            .where(DeviceTunnel.state < TunnelState.completed)
+        tunnels = {t.tunnel_id: t for t in sesh.exec(stmt).all()}
+        if not tunnels:
+            return
+
+        post_data = TunnelStatusesRequest(tokens=[t.token for t in tunnels.values()])
+        res = api.post(f"{SUPPORT_TUNNEL_API}/device/tunnel/statuses",
+                       json=post_data.dict(), timeout=60, policy=POLL)
+        res.raise_for_status()
+
+        for details in json.loads(res.text):
+            upstream = TunnelServerLaunchDetailsResponse(**details)
+            t = tunnels[upstream.tunnel_id]
+            if upstream.state in [TunnelState.completed, TunnelState.timedout]:
+                logging.info(f"tunnel {t.tunnel_id} is {upstream.state.name} upstream; stopping it")
+                stop_local_resources(c, t, upstream.state)
+            elif t.state >= TunnelState.running and upstream.state > t.state:
+                tracing.record_state(t.tunnel_id, t.state, upstream.state)
+                t.state = upstream.state
+            else:
+                continue
+            sesh.add(t)
+            sesh.commit()
+
+            if upstream.state in [TunnelState.completed, TunnelState.timedout] \
+                    and 'post-down-script' in config['device']:
+                run_script_hook(config['device']['post-down-script'], t)
 
 
-@task
+@task(klass=DeviceTask)
 def gc(c):
     """ Garbage collects all resources associated with old tunnels. """
+    from sqlmodel import Session, select
+
+    from common.models import TunnelState
+    from device.models import DeviceTunnel, get_engine
+
     # add just a bit of jitter so we don't blast the API service with a ton of cronjobs
     sleep(random.randint(0,20))
-    with Session(engine) as sesh:
+
+    # pick up tunnels that were stopped upstream; local expiry below still applies
+    # if the API can't be reached.
+    try:
+        update_local_tunnel_statuses(c)
+    except Exception as e:
+        print_log_error(e, "unable to sync tunnel statuses from upstream")
+
+    with Session(get_engine()) as sesh:
         stmt = select(DeviceTunnel).where(
             DeviceTunnel.expires < datetime.now())
         tunnels = sesh.exec(stmt).all()
         for t in tunnels:
             stop(c, t.tunnel_id, TunnelState.timedout)
 
-@task
+@task(klass=DeviceTask)
 def connect_approved_tunnels(c):
     """ Connects all tunnels that are requested locally and approved+running remotely. """
+    from sqlmodel import Session, select
+
+    from common.models import TunnelState
+    from device.models import DeviceTunnel, get_engine
+
     # add just a bit of jitter so we don't blast the API service with a ton of cronjobs
     sleep(random.randint(0,20))
-    with Session(engine) as sesh:
+    with Session(get_engine()) as sesh:
         stmt = select(DeviceTunnel)\
             .where(DeviceTunnel.expires > datetime.now())\
             .where(DeviceTunnel.state == TunnelState.pending)
@@ -438,3 +699,64 @@ def connect_approved_tunnels(c):
                 connect(c, t.tunnel_id)
             except Exception as e:
                 logging.error(str(e))
+
+
+# Modules that must not be imported just by loading the task collection.
+HEAVY_IMPORTS = ["sqlmodel", "jose", "systemd", "wireguard_tools", "pyroute2", "fabric", "nacl"]
+
+
+def _run_python(*args: str) -> subprocess.CompletedProcess:
+    """ Runs a fresh interpreter from the repository root, so each run pays a cold start. """
+    return subprocess.run(
+        [sys.executable, *args],
+        cwd=Path(__file__).resolve().parent.parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+@task(klass=DeviceTask)
+def startup_profile(c, top: int = 20):
+    """ Prints the modules that take the longest to import when `inv` loads its tasks. """
+    res = _run_python("-X", "importtime", "-c", "import tasks")
+    # lines look like "import time:      1234 |      5678 | package.module"
+    timings = []
+    for line in res.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not line.startswith("import time:"):
+            continue
+        try:
+            cumulative_us = int(parts[1])
+        except ValueError:
+            continue  # the header line
+        timings.append((cumulative_us, parts[2].strip()))
+
+    for cumulative_us, module in sorted(timings, reverse=True)[:top]:
+        print(f"{cumulative_us / 1000:8.1f} ms  {module}")
+
+
+@task(klass=DeviceTask)
+def startup_budget(c, runs: int = 5, budget_ms: int = STARTUP_BUDGET_MS):
+    """ Fails if `inv` takes longer than the startup budget to load its tasks.
+
+        This also fails if loading the tasks pulls in any of the heavy modules
+        that should only be imported by the tasks that use them.
+    """
+    from invoke.exceptions import Exit
+
+    res = _run_python("-c", f"import sys, tasks; print(' '.join(m for m in {HEAVY_IMPORTS!r} if m in sys.modules))")
+    eager = res.stdout.split()
+    if eager:
+        raise Exit(f"modules imported at startup that should be lazy: {', '.join(eager)}", code=1)
+
+    durations = []
+    for _ in range(runs):
+        start = perf_counter()
+        _run_python("-c", "import tasks")
+        durations.append((perf_counter() - start) * 1000)
+    median_ms = sorted(durations)[len(durations) // 2]
+
+    print(f"cold start: median {median_ms:.0f} ms over {runs} runs (budget {budget_ms} ms)")
+    if median_ms > budget_ms:
+        raise Exit(f"cold start of {median_ms:.0f} ms exceeds the {budget_ms} ms budget", code=1)
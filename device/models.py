@@ -8,11 +8,16 @@ import common.models
 from grp import getgrnam
 from pydantic import UUID4
 from typing import Optional
+from functools import lru_cache
 from sqlalchemy.types import Text
+from sqlalchemy.engine import Engine
 from wireguard_tools import WireguardKey
 from ipaddress import IPv4Address, IPv4Network
 from sqlmodel import Field, SQLModel, create_engine
 
+from common.util import add_missing_columns
+from common.constants import WG_DEFAULT_KEEPALIVE
+
 class DeviceTunnel(SQLModel, table=True):
     """ Represents the database table on a device, where each row
         contains details about one tunnel.
@@ -37,6 +42,8 @@ class DeviceTunnel(SQLModel, table=True):
     stopped_at: Optional[datetime.datetime]
     expires: datetime.datetime
     support_secret_box: Optional[str] = Field(sa_type=Text)
+    mtu: Optional[int] = None
+    keepalive: Optional[int] = None  # None uses WG_DEFAULT_KEEPALIVE
 
     def to_WireguardTunnel(self) -> common.models.WireguardTunnel:
         """ Creates a common.models.WireguardTunnel representation,
@@ -60,21 +67,33 @@ class DeviceTunnel(SQLModel, table=True):
             private_key=WireguardKey(self.device_wg_private_key),
             preshared_key=WireguardKey(self.wg_preshared_key),
             peers=peers,
+            mtu=self.mtu,
+            persistent_keepalive=self.keepalive or WG_DEFAULT_KEEPALIVE,
         )
 
 SQLITE_DB = os.getenv("SQLITE_DB", "/var/lib/support_tunnel/device.db")
 SQL_URI = f"sqlite:///{SQLITE_DB}"
 
-engine = create_engine(SQL_URI)
-SQLModel.metadata.create_all(engine)
 
-try:
-    stat_result = os.stat(SQLITE_DB)
-    gid = getgrnam("support").gr_gid
-    if stat_result.st_gid != gid:
-        os.chown(SQLITE_DB, -1, gid)
-    if stat.filemode(stat_result.st_mode) != '-rw-rw----':
-        os.chmod(SQLITE_DB, 0o0660)
-except Exception as e:
-    error_msg = f"unable to set permissions on {SQLITE_DB}: {e}"
-    logging.warning(error_msg)
+@lru_cache(1)
+def get_engine() -> Engine:
+    """ Returns the device database engine, creating the schema and fixing up
+        file permissions the first time it is called. This is deferred until a
+        task actually needs the database, so that `inv` stays cheap to start.
+    """
+    engine = create_engine(SQL_URI)
+    SQLModel.metadata.create_all(engine)
+    add_missing_columns(engine, DeviceTunnel.__table__)  # type: ignore
+
+    try:
+        stat_result = os.stat(SQLITE_DB)
+        gid = getgrnam("support").gr_gid
+        if stat_result.st_gid != gid:
+            os.chown(SQLITE_DB, -1, gid)
+        if stat.filemode(stat_result.st_mode) != '-rw-rw----':
+            os.chmod(SQLITE_DB, 0o0660)
+    except Exception as e:
+        error_msg = f"unable to set permissions on {SQLITE_DB}: {e}"
+        logging.warning(error_msg)
+
+    return engine
@@ -36,3 +36,15 @@ resource "google_compute_firewall" "allow_ssh" {
     ports    = ["22"]
   }
 }
+
+# permits devices to measure the path MTU to tunnel servers before bringing a tunnel up
+resource "google_compute_firewall" "allow_icmp" {
+  name          = "allow-icmp-${var.env}"
+  direction     = "INGRESS"
+  network       = google_compute_network.network.id
+  source_ranges = ["0.0.0.0/0"]
+  target_tags   = ["support-tunnel"]
+  allow {
+    protocol = "icmp"
+  }
+}
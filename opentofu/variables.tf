@@ -15,6 +15,12 @@ variable "region" {
   default     = "us-central1"
 }
 
+variable "ts_regions" {
+  description = "Regions other than var.region that tunnel servers may be placed in; see TS_ZONES in admin/cloud.py"
+  type        = list(string)
+  default     = []
+}
+
 variable "repo_name" {
   description = "The repo name to use for setting up OIDC auth between Github <-> Google Cloud for deploys. ex: micro-nova/support_tunnel"
   type        = string
@@ -27,6 +27,15 @@ resource "google_compute_subnetwork" "ts_subnet" {
   network       = google_compute_network.network.id
 }
 
+# tunnel server subnets in other regions, for placing tunnel servers near devices
+resource "google_compute_subnetwork" "ts_subnet_regional" {
+  for_each      = toset(var.ts_regions)
+  name          = "ts-${var.env}"
+  region        = each.value
+  ip_cidr_range = "10.0.${3 + index(var.ts_regions, each.value)}.0/24"
+  network       = google_compute_network.network.id
+}
+
 resource "google_compute_router" "router" {
   name    = "router-${var.env}"
   network = google_compute_network.network.name